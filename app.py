@@ -1,12 +1,12 @@
 import traceback
-from flask import render_template, request, redirect, url_for
+from flask import render_template, request, redirect, url_for, jsonify
 import logging.config
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 import pandas as pd
 import os
 from sqlalchemy.util import OrderedSet
-from src.recommender_db import Recommendation
+from src.app_index import RecommendationIndex, PARTNERS_PER_ITEM
 
 
 # Initialize the Flask application
@@ -25,15 +25,10 @@ logger.debug('Test log')
 db = SQLAlchemy(app)
 basket = OrderedSet()
 
-# Connect to RDS or local database and query all data
+# Connect to RDS or local database and build an in-memory index of all recommendations, a watcher thread swaps in
+# a new index whenever a new version of the recommendation table is stored
 logger.info('Connecting to '+ app.config['SQLALCHEMY_DATABASE_URI'])
-recommendations = db.session.query(Recommendation).all()
-
-# Generate list of items in database so that we can fetch corresponding recommendations later
-item_ls = []
-for i in range(len(recommendations)):
-    # Make sure recommendations show up no matter user input's in lower or upper case
-    item_ls.append(recommendations[i].item_name.lower())
+rec_index = RecommendationIndex(app.config['SQLALCHEMY_DATABASE_URI'], app.config['INDEX_RELOAD_SECONDS']).start()
 
 
 @app.route('/')
@@ -51,6 +46,9 @@ def index():
 def add_thing():
     """ Display top 5 recommendations with a new item input, no matter from textbox or checkbox.
 
+    Recommendations merge partners of every item in the basket (leaving out items already in it) if ranked rules
+    are stored, otherwise they're the top 5 of the new item;
+
     If an item only has less than 5 recommendations, only display those available;
 
     If an item is not found in database or there's invalid input, return error page.
@@ -62,17 +60,17 @@ def add_thing():
         rec5 = OrderedSet()
         # Store user input data
         fetch_items = request.form['items'].lower()
-        # Take the newly added item, search through list, and fetch corresponding recommendations
-        # Make sure recommendations show up no matter user input's in lower or upper case by matching with item list
-        idx = item_ls.index(fetch_items)
+        # Take the newly added item and look up its recommendations in the index
+        # Make sure recommendations show up no matter user input's in lower or upper case, index is keyed by lower case name
+        rec5 = rec_index.lookup(fetch_items)
+        if rec5 is None:
+            raise KeyError(fetch_items)
         basket.add(fetch_items.title())
-        rec5 = [recommendations[idx].recommendation1, recommendations[idx].recommendation2, recommendations[idx].recommendation3, recommendations[idx].recommendation4, recommendations[idx].recommendation5]
-        # If an item only has less than 5 recommendations, only display those available
-        for i in range(len(rec5)):
-            if rec5[i] == "nan":
-                rec5 = rec5[:i]
-                return render_template('index.html', basket = basket, recommendations = rec5)
-        # if it does have top 5 recommendations, display them all
+        # Recommend partners of all basket items together, merging their lifts, if ranked rules are stored
+        basket_recs = rec_index.recommend_basket(basket, 5, app.config['BASKET_MERGE'])
+        if len(basket_recs) > 0:
+            rec5 = [name for name, lift in basket_recs]
+        # If an item only has less than 5 recommendations, only those available are in the index
         return render_template('index.html', basket = basket, recommendations = rec5)
     except:
         # If an item is not found in database or there's invalid input, return error page
@@ -80,6 +78,34 @@ def add_thing():
         return render_template('error.html')
 
 
+@app.route('/api/recommendations', methods=['POST'])
+def api_recommendations():
+    """ Recommend for many items in one request, as JSON.
+
+    Request body: {"items": [item names or ids], "top_n": 5, "merge": "sum"}, top_n and merge are optional.
+
+    The whole batch is looked up in one pass over the in-memory index, response has top_n recommendations of each
+    item and of all found items together as a basket.
+
+    Returns: JSON response, or JSON error with status 400 if the request is invalid.
+
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('items'), list):
+        return jsonify(error='Request body has to be a JSON object with a list of items'), 400
+    items = payload['items']
+    if len(items) > app.config['MAX_BATCH_ITEMS']:
+        return jsonify(error='At most ' + str(app.config['MAX_BATCH_ITEMS']) + ' items per request'), 400
+    top_n = payload.get('top_n', 5)
+    if not isinstance(top_n, int) or isinstance(top_n, bool) or top_n < 1 or top_n > PARTNERS_PER_ITEM:
+        return jsonify(error='top_n has to be an integer from 1 to ' + str(PARTNERS_PER_ITEM)), 400
+    merge = payload.get('merge', app.config['BASKET_MERGE'])
+    if merge not in ('sum', 'max'):
+        return jsonify(error="merge has to be 'sum' or 'max'"), 400
+    logger.debug("Batch of " + str(len(items)) + " items requested")
+    return jsonify(rec_index.recommend_batch(items, top_n, merge))
+
+
 @app.route('/reset-basket/', methods=['POST'])
 def reset_basket():
     """ Empty the basket whenever user hit reset button, so that they can create a new grocery list.
@@ -8,6 +8,9 @@ SQLALCHEMY_TRACK_MODIFICATIONS = True
 HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False  # If true, SQL for queries made will be printed
 MAX_ROWS_SHOW = 100
+INDEX_RELOAD_SECONDS = 30  # Seconds between checks for a new version of the recommendation table, 0 disables reloading
+BASKET_MERGE = 'sum'  # How lifts of a partner are merged over basket items, 'sum' or 'max'
+MAX_BATCH_ITEMS = 1000  # Maximum number of items in one request to the JSON API
 
 # Connection string
 DB_HOST = os.environ.get('MYSQL_HOST')
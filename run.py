@@ -1,10 +1,19 @@
+import sys
 import argparse
 import logging
 
+import src.data_cache as dc
+import src.evaluation as ev
+import src.synthetic_data as sd
+import src.benchmark as bm
+import src.instrumentation as ins
+import src.stage_cache as scache
 import src.download_s3 as d3
 import src.market_basket_analysis as mba
+import src.fpgrowth as fp
 import src.scores as sc
 import src.recommender_db as db
+import src.pipeline as pl
 import src.upload_s3 as u3
 
 logging.basicConfig(format='%(name)-12s %(levelname)-8s %(message)s', level=logging.DEBUG)
@@ -13,7 +22,17 @@ logger = logging.getLogger('run-reproducibility')
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Acquire, generate rules, test scores, and store to RDS from orders data")
-    subparsers = parser.add_subparsers()
+    parser.add_argument('--report', default=None,
+                        help='if given, save wall time, CPU time, peak memory and row count of each step as json run report')
+    parser.add_argument('--profile', default=None,
+                        help='if given, run the step with this name (e.g. count_pairs) under cProfile, needs --report')
+    parser.add_argument('--profile_output', default='profile.prof', help='profile statistics of profiled step')
+    parser.add_argument('--stage_cache', default=None,
+                        help='if given, skip stages whose inputs, parameters and code are unchanged, '
+                             'restoring their outputs from this folder')
+    parser.add_argument('--cache_budget', type=float, default=scache.CACHE_BUDGET,
+                        help='disk budget of stage cache in MB, least recently used outputs are evicted above it')
+    subparsers = parser.add_subparsers(dest='command')
 
     # Upload data to S3 bucket
     sb_upload = subparsers.add_parser("upload", description="upload data to S3")
@@ -33,32 +52,197 @@ if __name__ == '__main__':
     sb_dataset.add_argument('--output3', default=None, help='products data')
     sb_dataset.set_defaults(func=d3.download_s3)
 
+    # Convert acquired datasets into columnar cache so that later stages don't parse csv files again
+    sb_cache = subparsers.add_parser("cache", description="convert datasets into columnar cache")
+    sb_cache.add_argument('--input1', default=None, help='prior orders data')
+    sb_cache.add_argument('--input2', default=None, help='orders data')
+    sb_cache.add_argument('--input3', default=None, help='products data')
+    sb_cache.add_argument('--cache_dir', default='data/cache', help='folder of columnar cache')
+    sb_cache.set_defaults(func=dc.run_cache)
+
     # Generate recommendation table based association rules of market basket analysis on all data
     sb_rules = subparsers.add_parser("generate_rules", description="generate rules")
     sb_rules.add_argument('--input1', default=None, help='prior orders data')
     sb_rules.add_argument('--input2', default=None, help='products data')
     sb_rules.add_argument('--output', default=None, help='recommendations generated')
+    sb_rules.add_argument('--min_support', type=float, default=0.01, help='minimum support of rules (%%)')
+    sb_rules.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                          help='pair counting engine, sparse counts pairs with a sparse matrix product, '
+                               'approx estimates frequent pairs in fixed memory')
+    sb_rules.add_argument('--stream', action='store_true',
+                          help='read prior orders in bounded chunks instead of loading the whole file')
+    sb_rules.add_argument('--memory_budget', type=float, default=256,
+                          help='memory budget in MB for each chunk read in streaming mode, running item and pair '
+                               'counts are kept in full on top of it')
+    sb_rules.add_argument('--workers', type=int, default=1,
+                          help='number of worker processes counting item pairs')
+    sb_rules.add_argument('--state', default=None,
+                          help='if given, save item and pair counts to this state file for update_rules')
+    sb_rules.add_argument('--top_k', type=int, default=5, help='number of recommendations for each item')
+    sb_rules.add_argument('--rules_output', default=None,
+                          help='if given, save all partners of each item with rank, lift and confidence for store_RDS')
+    sb_rules.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
     sb_rules.set_defaults(func=mba.run_analysis)
 
+    # Update recommendation table with newly arrived orders, starting from counts saved by generate_rules
+    sb_update = subparsers.add_parser("update_rules", description="update rules with new orders")
+    sb_update.add_argument('--state', default=None, help='state file saved by generate_rules, updated in place')
+    sb_update.add_argument('--input1', default=None, help='new prior orders data')
+    sb_update.add_argument('--input2', default=None, help='products data')
+    sb_update.add_argument('--output', default=None, help='recommendations generated')
+    sb_update.add_argument('--engine', default='counter', choices=['counter', 'sparse'],
+                           help='pair counting engine, sparse counts pairs with a sparse matrix product')
+    sb_update.add_argument('--workers', type=int, default=1,
+                           help='number of worker processes counting item pairs')
+    sb_update.add_argument('--top_k', type=int, default=5, help='number of recommendations for each item')
+    sb_update.add_argument('--rules_output', default=None,
+                           help='if given, save all partners of each item with rank, lift and confidence for store_RDS')
+    sb_update.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_update.set_defaults(func=mba.run_update)
+
+    # Generate rules of frequent itemsets with 3 or more items with FP-growth
+    sb_itemsets = subparsers.add_parser("generate_itemsets", description="generate rules of itemsets with FP-growth")
+    sb_itemsets.add_argument('--input1', default=None, help='prior orders data')
+    sb_itemsets.add_argument('--input2', default=None, help='products data')
+    sb_itemsets.add_argument('--output', default=None, help='itemset rules generated')
+    sb_itemsets.add_argument('--min_support', type=float, default=0.01, help='minimum support of itemsets (%%)')
+    sb_itemsets.add_argument('--min_len', type=int, default=3, help='minimum number of items in an itemset')
+    sb_itemsets.add_argument('--max_len', type=int, default=3, help='maximum number of items in an itemset')
+    sb_itemsets.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_itemsets.set_defaults(func=fp.run_itemsets)
+
     # Evaluate scores of recommendation model on test data (after generating rules from train data)
     sb_scores = subparsers.add_parser("get_scores", description="calculate test scores on rules generated")
     sb_scores.add_argument('--input1', default=None, help='prior orders data')
     sb_scores.add_argument('--input2', default=None, help='orders data')
     sb_scores.add_argument('--input3', default=None, help='products data')
     sb_scores.add_argument('--output', default=None, help='recommendations generated')
+    sb_scores.add_argument('--min_support', type=float, default=0.01, help='minimum support of rules (%%)')
+    sb_scores.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                           help='pair counting engine, sparse counts pairs with a sparse matrix product, '
+                                'approx estimates frequent pairs in fixed memory')
+    sb_scores.add_argument('--stream', action='store_true',
+                           help='read prior orders in bounded chunks instead of loading the whole file')
+    sb_scores.add_argument('--memory_budget', type=float, default=256,
+                           help='memory budget in MB for each chunk read in streaming mode, running item and pair '
+                                'counts are kept in full on top of it')
+    sb_scores.add_argument('--workers', type=int, default=1,
+                           help='number of worker processes counting item pairs')
+    sb_scores.add_argument('--score_workers', type=int, default=1, help='number of worker processes scoring test orders')
+    sb_scores.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
     sb_scores.set_defaults(func=sc.run_scores)
 
+    # Evaluate recommendations with time based or k-fold splits, with rules of each fold cached
+    sb_eval = subparsers.add_parser("evaluate", description="evaluate recommendations on time based or k-fold splits")
+    sb_eval.add_argument('--input1', default=None, help='prior orders data')
+    sb_eval.add_argument('--input2', default=None, help='orders data')
+    sb_eval.add_argument('--output', default=None, help='metrics of each fold (csv)')
+    sb_eval.add_argument('--split', default='time', choices=['time', 'kfold'],
+                         help='time tests the last orders of each user, kfold tests each of k folds of orders')
+    sb_eval.add_argument('--test_orders', type=int, default=1, help='number of last orders of each user to test on')
+    sb_eval.add_argument('--folds', type=int, default=5, help='number of folds of kfold split')
+    sb_eval.add_argument('--seed', type=int, default=0, help='seed of random assignment of orders to folds')
+    sb_eval.add_argument('--k', type=int, default=5, help='number of recommendations for precision@k and recall@k')
+    sb_eval.add_argument('--min_support', type=float, default=0.01, help='minimum support of rules (%%)')
+    sb_eval.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                         help='pair counting engine')
+    sb_eval.add_argument('--workers', type=int, default=1, help='number of worker processes counting item pairs')
+    sb_eval.add_argument('--rules_cache', default=None, help='if given, rules of each fold are cached in this folder')
+    sb_eval.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_eval.set_defaults(func=ev.run_evaluation)
+
+    # Compare rules and scores of several min support thresholds, counting item pairs only once
+    sb_sweep = subparsers.add_parser("sweep", description="compare min support thresholds from one counting pass")
+    sb_sweep.add_argument('--input1', default=None, help='prior orders data')
+    sb_sweep.add_argument('--input2', default=None, help='products data')
+    sb_sweep.add_argument('--output', default=None, help='comparison table of thresholds (csv)')
+    sb_sweep.add_argument('--thresholds', type=float, nargs='+', default=[0.005, 0.01, 0.02, 0.05],
+                          help='min support thresholds to compare (%%)')
+    sb_sweep.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                          help='pair counting engine')
+    sb_sweep.add_argument('--workers', type=int, default=1, help='number of worker processes counting item pairs')
+    sb_sweep.add_argument('--rules_dir', default=None, help='if given, save rules table of each threshold in this folder')
+    sb_sweep.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_sweep.set_defaults(func=ev.run_sweep)
+
+    # Generate synthetic dataset in the layout of Instacart data
+    sb_synthetic = subparsers.add_parser("synthetic", description="generate synthetic orders and products data")
+    sb_synthetic.add_argument('--output_dir', default='data/synthetic', help='folder to write synthetic csv files')
+    sb_synthetic.add_argument('--rows', type=int, default=100000, help='number of rows of prior orders')
+    sb_synthetic.add_argument('--products', type=int, default=49688, help='number of products')
+    sb_synthetic.add_argument('--seed', type=int, default=0, help='random seed')
+    sb_synthetic.set_defaults(func=sd.run_synthetic)
+
+    # Benchmark mining and scoring stages on synthetic datasets of several sizes
+    sb_bench = subparsers.add_parser("benchmark", description="benchmark stages on synthetic datasets")
+    sb_bench.add_argument('--sizes', nargs='+', default=['100K', '1M'],
+                          help='dataset sizes in rows of prior orders, full suite is 100K 1M 10M 32M')
+    sb_bench.add_argument('--stages', nargs='+', default=bm.STAGES, choices=bm.STAGES, help='stages to run')
+    sb_bench.add_argument('--data_dir', default='data/synthetic', help='folder of synthetic datasets')
+    sb_bench.add_argument('--output', default='benchmarks/results.json', help='benchmark results (json)')
+    sb_bench.add_argument('--baseline', default=None, help='if given, compare results with this results file')
+    sb_bench.add_argument('--min_support', type=float, default=0.01, help='minimum support of rules (%%)')
+    sb_bench.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                          help='pair counting engine')
+    sb_bench.add_argument('--workers', type=int, default=1, help='number of worker processes counting item pairs')
+    sb_bench.add_argument('--seed', type=int, default=0, help='random seed of synthetic data')
+    sb_bench.set_defaults(func=bm.run_benchmark)
+
     # Store generated recommendations into RDS
     sb_rds = subparsers.add_parser("store_RDS", description="store recommendations table into RDS")
     sb_rds.add_argument('--input', default=None, help='recommendation table') # 'data/external/recommendations.csv
+    sb_rds.add_argument('--rules', default=None,
+                        help='if given, also store ranked rules saved by generate_rules --rules_output into Item and Rule tables')
     sb_rds.add_argument("--truncate", "-t", default=False,
-                        help="If given, delete current records from recommendation table so that table can be recreated without problem with unique id ")
+                        help="No longer needed, new recommendation table is loaded into a shadow table and swapped in")
     sb_rds.add_argument("--rds", "-r", default=True,
                         help="If true, store table into RDS database, otherwise the database would be created locally ")
+    sb_rds.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_rds.add_argument('--batch_size', type=int, default=db.BATCH_SIZE,
+                        help='number of rows inserted and committed at a time')
+    sb_rds.add_argument('--rollback', action='store_true',
+                        help='if given, swap the previous version of recommendation table back in instead of loading')
     sb_rds.set_defaults(func=db.create_rec_db)
 
+    # Mine, score and store recommendations in one process, reading datasets once
+    sb_pipeline = subparsers.add_parser("pipeline", description="mine, score and store recommendations in one process")
+    sb_pipeline.add_argument('--input1', default=None, help='prior orders data')
+    sb_pipeline.add_argument('--input2', default=None, help='orders data')
+    sb_pipeline.add_argument('--input3', default=None, help='products data')
+    sb_pipeline.add_argument('--output', default=None,
+                             help='if given, also save recommendation table, or the table to store if mining is skipped')
+    sb_pipeline.add_argument('--rules_output', default=None, help='if given, also save ranked rules')
+    sb_pipeline.add_argument('--score_output', default=None, help='if given, save test score to this file')
+    sb_pipeline.add_argument('--skip', nargs='*', default=[], choices=pl.STAGES, help='stages to skip')
+    sb_pipeline.add_argument('--min_support', type=float, default=0.01, help='minimum support of rules (%%)')
+    sb_pipeline.add_argument('--engine', default='counter', choices=['counter', 'sparse', 'approx'],
+                             help='pair counting engine')
+    sb_pipeline.add_argument('--workers', type=int, default=1, help='number of worker processes counting item pairs')
+    sb_pipeline.add_argument('--score_workers', type=int, default=1,
+                             help='number of worker processes scoring test orders')
+    sb_pipeline.add_argument('--top_k', type=int, default=5, help='number of recommendations for each item')
+    sb_pipeline.add_argument('--store_rules', action='store_true',
+                             help='if given, also store ranked rules into Item and Rule tables')
+    sb_pipeline.add_argument("--rds", "-r", default=True,
+                             help="If true, store table into RDS database, otherwise the database would be created locally ")
+    sb_pipeline.add_argument('--batch_size', type=int, default=db.BATCH_SIZE,
+                             help='number of rows inserted and committed at a time')
+    sb_pipeline.add_argument('--cache_dir', default=None, help='if given, load datasets from columnar cache in this folder')
+    sb_pipeline.set_defaults(func=pl.run_pipeline)
+
 
     args = parser.parse_args()
-    args.func(args)
+    if args.report:
+        ins.start_report(args.profile, args.profile_output)
+    try:
+        with ins.stage(args.command):
+            if args.stage_cache is not None and args.command in scache.CACHED_COMMANDS:
+                scache.run_cached(args)
+            else:
+                args.func(args)
+    finally:
+        # Steps of a failed run are reported too, up to the step that failed
+        if args.report:
+            ins.write_report(args.report, ' '.join(sys.argv))
 
 
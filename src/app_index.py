@@ -0,0 +1,279 @@
+import heapq
+import logging
+import threading
+import sqlalchemy as sql
+from sqlalchemy.orm import aliased, sessionmaker
+from src.recommender_db import Recommendation, RecommendationVersion, Item, Rule
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for a new version of the recommendation table
+RELOAD_SECONDS = 30
+# Number of top partners of each item kept for basket recommendations
+PARTNERS_PER_ITEM = 50
+
+
+def table_version(session):
+    """ Id of the last load or rollback of the recommendation table, so that any swap gives a new id
+    Inputs:
+        session: SQLAlchemy session
+    Returns:
+        id of last RecommendationVersion record, None if tables were stored before versions were logged
+    """
+    try:
+        return session.query(sql.func.max(RecommendationVersion.id)).scalar()
+    except Exception as e:
+        session.rollback()
+        return None
+
+
+def has_ranked_rules(session):
+    """ Check if the normalized Item and Rule tables are stored, databases created before them only hold the
+        recommendation table
+    Inputs:
+        session: SQLAlchemy session
+    Returns:
+        True if both Item and Rule tables exist
+    """
+    tables = sql.inspect(session.get_bind()).get_table_names()
+    return Item.__tablename__ in tables and Rule.__tablename__ in tables
+
+
+def build_index(session):
+    """ Build a dictionary from lower case item name to its recommendations
+    Inputs:
+        session: SQLAlchemy session
+    Returns:
+        index: dictionary of lower case item name and list of its recommendations, without missing ones
+    """
+    index = {}
+    for row in session.query(Recommendation).all():
+        recs = [row.recommendation1, row.recommendation2, row.recommendation3, row.recommendation4,
+                row.recommendation5]
+        # If an item only has less than 5 recommendations, only keep those available
+        if "nan" in recs:
+            recs = recs[:recs.index("nan")]
+        # Names that only differ in case keep the first one, same as a scan over all rows would find
+        index.setdefault(row.item_name.lower(), recs)
+    return index
+
+
+def build_partner_index(session, max_partners=PARTNERS_PER_ITEM):
+    """ Build partner vectors of each item from the normalized Item and Rule tables
+    Inputs:
+        session: SQLAlchemy session
+        max_partners: number of top partners kept for each item
+    Returns:
+        partners: dictionary of lower case item name and (lower case partner names, partner names, lifts) of its
+        top partners sorted by lift in descending order, empty if ranked rules weren't stored
+    """
+    if not has_ranked_rules(session):
+        return {}
+    seed, partner = aliased(Item), aliased(Item)
+    rows = session.query(Rule.item_id, seed.normalized_name, partner.normalized_name, partner.name, Rule.lift) \
+        .select_from(Rule) \
+        .join(seed, seed.id == Rule.item_id) \
+        .join(partner, partner.id == Rule.partner_id) \
+        .filter(Rule.rank <= max_partners) \
+        .order_by(Rule.item_id, Rule.rank).all()
+    partners, item_ids = {}, {}
+    for item_id, item, key, name, lift in rows:
+        # Names that only differ in case keep partners of the first item
+        if item_ids.setdefault(item, item_id) != item_id:
+            continue
+        keys, names, lifts = partners.setdefault(item, ([], [], []))
+        keys.append(key)
+        names.append(name)
+        lifts.append(lift)
+    return {item: tuple(tuple(values) for values in vectors) for item, vectors in partners.items()}
+
+
+def build_item_ids(session):
+    """ Build a dictionary from item id to its name, so that items can be looked up by id
+    Inputs:
+        session: SQLAlchemy session
+    Returns:
+        item_ids: dictionary of item id and (lower case name, name), empty if ranked rules weren't stored
+    """
+    if not has_ranked_rules(session):
+        return {}
+    return {item_id: (key, name) for item_id, key, name in
+            session.query(Item.id, Item.normalized_name, Item.name).all()}
+
+
+def merge_partners(vectors, exclude, top_n=5, merge='sum'):
+    """ Merge partner vectors of basket items with a heap based k-way merge, in descending order of lift
+    Inputs:
+        vectors: list of (lower case partner names, partner names, lifts) of each basket item, sorted by lift
+        exclude: set of lower case names that aren't recommended, i.e. items already in the basket
+        top_n: number of recommendations
+        merge: 'sum' adds up lifts of a partner over basket items, 'max' takes its highest lift
+    Returns:
+        recs: list of (partner name, merged lift) sorted by merged lift in descending order
+    """
+    if merge not in ('sum', 'max'):
+        raise ValueError('Unknown merge: ' + str(merge))
+    heap = [(-lifts[0], i, 0) for i, (keys, names, lifts) in enumerate(vectors) if len(lifts) > 0]
+    heapq.heapify(heap)
+    scores, first_name = {}, {}
+    while heap:
+        neg_lift, i, pos = heapq.heappop(heap)
+        keys, names, lifts = vectors[i]
+        key = keys[pos]
+        if key not in exclude:
+            if key not in scores:
+                first_name[key] = names[pos]
+                scores[key] = -neg_lift
+                # Partners come out in descending lift, so the first lift of a partner is its max
+                if merge == 'max' and len(scores) == top_n:
+                    break
+            elif merge == 'sum':
+                scores[key] += -neg_lift
+        if pos + 1 < len(lifts):
+            heapq.heappush(heap, (-lifts[pos + 1], i, pos + 1))
+    # Ties keep the order partners came out of the merge
+    top = heapq.nlargest(top_n, scores.items(), key=lambda item: item[1])
+    return [(first_name[key], score) for key, score in top]
+
+
+class RecommendationIndex:
+    """
+    In-memory index of the recommendation table, looked up in O(1) by lower case item name, with partner vectors
+    of ranked rules for basket recommendations
+
+    A watcher thread checks the version log of the recommendation table and builds a new index when a new version
+    is swapped in, the new index replaces the old one in a single assignment so requests never see a half built index
+    """
+
+    def __init__(self, engine_string, reload_seconds=RELOAD_SECONDS):
+        self.engine_string = engine_string
+        self.reload_seconds = reload_seconds
+        # One engine and its connection pool serve every reload, until the index is stopped
+        self.engine = sql.create_engine(engine_string)
+        self.Session = sessionmaker(bind=self.engine)
+        # Version, index, partner vectors and item ids are kept in one tuple so that they're always replaced together
+        self.snapshot = (None, {}, {}, {})
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.snapshot[1])
+
+    @property
+    def version(self):
+        return self.snapshot[0]
+
+    def lookup(self, item_name):
+        """ Find recommendations of an item
+        Inputs:
+            item_name: item name, in lower or upper case
+        Returns:
+            list of recommendations, None if item isn't in the index
+        """
+        return self.snapshot[1].get(item_name.lower())
+
+    def recommend_basket(self, basket, top_n=5, merge='sum'):
+        """ Recommend partners of all items of a basket, leaving out items already in it
+        Inputs:
+            basket: item names in the basket, in lower or upper case
+            top_n: number of recommendations
+            merge: 'sum' or 'max' of lifts of a partner over basket items
+        Returns:
+            recs: list of (partner name, merged lift), empty if no basket item has ranked rules
+        """
+        partners = self.snapshot[2]
+        # Basket order is kept so that ties come out in the same order for the same basket
+        keys = list(dict.fromkeys(name.lower() for name in basket))
+        vectors = [partners[key] for key in keys if key in partners]
+        return merge_partners(vectors, set(keys), top_n, merge)
+
+    def recommend_batch(self, items, top_n=5, merge='sum'):
+        """ Recommend top N partners of each of many items and of all of them as a basket, in one pass over
+            one version of the index
+        Inputs:
+            items: list of item names (in lower or upper case) or item ids, as integers or strings of digits
+            top_n: number of recommendations for each item and for the basket
+            merge: 'sum' or 'max' of lifts of a partner over items of the basket
+        Returns:
+            dictionary with table version, list of recommendations of each item (with lift if ranked rules are stored,
+            items that aren't found have found False) and basket recommendations
+        """
+        version, index, partners, item_ids = self.snapshot
+        results, keys = [], []
+        for query in items:
+            key = str(query).strip().lower()
+            if isinstance(query, int) and not isinstance(query, bool):
+                key = item_ids.get(query, (None, None))[0]
+            elif key.isdigit() and int(key) in item_ids:
+                # Ids sent as strings are looked up as ids, names that are only digits still work if no item has that id
+                key = item_ids[int(key)][0]
+            if key in partners:
+                _, names, lifts = partners[key]
+                recs = [{'name': name, 'lift': lift} for name, lift in zip(names[:top_n], lifts[:top_n])]
+            elif key in index:
+                recs = [{'name': name, 'lift': None} for name in index[key][:top_n]]
+            else:
+                recs = None
+            results.append({'query': query, 'found': recs is not None, 'recommendations': recs or []})
+            if recs is not None:
+                keys.append(key)
+        keys = list(dict.fromkeys(keys))
+        basket = merge_partners([partners[key] for key in keys if key in partners], set(keys), top_n, merge)
+        return {'version': version, 'items': results,
+                'basket': [{'name': name, 'lift': lift} for name, lift in basket]}
+
+    def reload(self, force=False):
+        """ Build a new index if the recommendation table has a new version
+        Inputs:
+            force: build the index even if the version didn't change
+        Returns:
+            True if a new index was swapped in
+        """
+        session = self.Session()
+        try:
+            version = table_version(session)
+            if not force and version is not None and version == self.version:
+                return False
+            index = build_index(session)
+            partners = build_partner_index(session)
+            item_ids = build_item_ids(session)
+        finally:
+            session.close()
+        self.snapshot = (version, index, partners, item_ids)
+        logger.info("Recommendation index built with " + str(len(index)) + " items and partner vectors of "
+                    + str(len(partners)) + " items, table version " + str(version))
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.reload_seconds):
+            try:
+                self.reload()
+            except Exception as e:
+                # Keep serving the current index, try again at the next check
+                logger.warning("Could not reload recommendation index: " + str(e))
+
+    def start(self):
+        """ Build the index and start the watcher thread
+        Inputs:
+            None
+        Returns:
+            self
+        """
+        self.reload(force=True)
+        if self.reload_seconds > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='recommendation-index-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the watcher thread and close connections of the engine
+        Inputs:
+            None
+        Returns:
+            None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.engine.dispose()
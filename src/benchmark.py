@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import logging
+import platform
+import datetime
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from src.synthetic_data import write_dataset, N_PRODUCTS
+from src.stream_orders import read_orders, read_products
+from src.market_basket_analysis import association_rules, run_analysis
+from src.scores import index_rules, get_scores
+from src.instrumentation import peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+# Version of the results file layout
+RESULTS_VERSION = 1
+# Dataset sizes of the full suite, in rows of prior orders (Instacart prior orders data has 32M rows)
+SIZES = {'100K': 100000, '1M': 1000000, '10M': 10000000, '32M': 32000000}
+STAGES = ['generate_data', 'read_orders', 'association_rules', 'run_analysis', 'get_scores']
+
+
+def parse_size(size):
+    """ Convert a dataset size like '100K' or '1M' into number of rows
+    Inputs:
+        size: size label with K or M suffix, or number of rows
+    Returns:
+        number of rows
+    """
+    try:
+        size = str(size).upper()
+        if size in SIZES:
+            return SIZES[size]
+        if size.endswith('K'):
+            return int(float(size[:-1]) * 1000)
+        if size.endswith('M'):
+            return int(float(size[:-1]) * 1000000)
+        return int(size)
+    except Exception as e:
+        logger.warning('Could not parse dataset size: ' + str(size))
+        raise Exception('Invalid input')
+
+
+def _split_rules(paths, options):
+    """ Inputs of get_scores stage: training rules and test orders of an 80:20 split, same as get_scores command
+    Inputs:
+        paths: paths of synthetic dataset
+        options: dictionary of benchmark options
+    Returns:
+        test_order: test data with item names
+        train_rules_final: rules of training data looked up in both directions
+    """
+    prior = read_orders(paths['prior'])
+    products = read_products(paths['products'])
+    train = prior.head(int(len(prior) * (80 / 100))).set_index('order_id')['product_id'].rename('item_id')
+    rules = association_rules(train, options['min_support'], options['engine'], options['workers'])
+    train_rules_final = index_rules(rules, products).sort_values('lift', ascending=False)
+    test_order = pd.merge(prior[len(train):], products.rename(columns={'product_name': 'item_name'}), how='left',
+                          on='product_id')
+    return test_order, train_rules_final
+
+
+def _run_stage(stage, paths, options):
+    """ Run one stage in a fresh worker process and measure it
+    Inputs:
+        stage: name of stage in STAGES
+        paths: paths of synthetic dataset
+        options: dictionary of benchmark options
+    Returns:
+        result: dictionary with wall and cpu seconds, number of rows, and peak resident memory of the process
+    """
+    base_rss = peak_rss_mb()
+    # Inputs of a stage are prepared before timing starts
+    if stage == 'generate_data':
+        run, rows = lambda: write_dataset(paths['dir'], options['rows'], options['products'], options['seed']), \
+            options['rows']
+    elif stage == 'read_orders':
+        run, rows = lambda: read_orders(paths['prior']), None
+    elif stage == 'association_rules':
+        items = read_orders(paths['prior']).set_index('order_id')['product_id'].rename('item_id')
+        run, rows = lambda: association_rules(items, options['min_support'], options['engine'], options['workers']), \
+            len(items)
+    elif stage == 'run_analysis':
+        args = argparse.Namespace(input1=paths['prior'], input2=paths['products'],
+                                  output=os.path.join(paths['dir'], 'recommendations.csv'), stream=False,
+                                  memory_budget=256, engine=options['engine'], workers=options['workers'],
+                                  state=None, top_k=5, min_support=options['min_support'], cache_dir=None,
+                                  rules_output=None)
+        run, rows = lambda: run_analysis(args), None
+    elif stage == 'get_scores':
+        test_order, train_rules_final = _split_rules(paths, options)
+        run, rows = lambda: get_scores(test_order, train_rules_final), len(test_order)
+    else:
+        raise ValueError('Unknown stage: ' + str(stage))
+    setup_rss = peak_rss_mb()
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    output = run()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+    if rows is None:
+        rows = len(output)
+    return {'stage': stage, 'rows': int(rows), 'wall_seconds': wall, 'cpu_seconds': cpu,
+            'base_rss_mb': base_rss, 'setup_rss_mb': setup_rss, 'peak_rss_mb': peak_rss_mb()}
+
+
+def _stage_process(stage, paths, options, conn):
+    """ Run one stage in a child process and send its result back to the parent
+    Inputs:
+        stage: name of stage in STAGES
+        paths: paths of synthetic dataset
+        options: dictionary of benchmark options
+        conn: sending end of a pipe to the parent process
+    Returns:
+        None, ('ok', result) or ('error', message) is sent through conn
+    """
+    try:
+        conn.send(('ok', _run_stage(stage, paths, options)))
+    except Exception as e:
+        conn.send(('error', repr(e)))
+    finally:
+        conn.close()
+
+
+def run_stage_process(stage, paths, options):
+    """ Run one stage in a fresh forked process, which isn't daemonic so that the stage can start its own
+        worker processes (e.g. with workers > 1)
+    Inputs:
+        stage: name of stage in STAGES
+        paths: paths of synthetic dataset
+        options: dictionary of benchmark options
+    Returns:
+        result: result dictionary of the stage from _run_stage
+    """
+    context = multiprocessing.get_context('fork')
+    reader, writer = context.Pipe(duplex=False)
+    process = context.Process(target=_stage_process, args=(stage, paths, options, writer))
+    process.start()
+    # Only the child keeps the sending end open, so recv fails instead of hanging if the child dies
+    writer.close()
+    try:
+        status, result = reader.recv()
+    except EOFError:
+        status, result = 'error', 'stage process exited with code ' + str(process.exitcode)
+    finally:
+        reader.close()
+        process.join()
+    if status != 'ok':
+        raise RuntimeError('Stage ' + stage + ' failed: ' + str(result))
+    return result
+
+
+def benchmark_size(label, data_dir, stages=STAGES, min_support=0.01, engine='counter', workers=1, seed=0,
+                   n_products=N_PRODUCTS):
+    """ Benchmark stages on a synthetic dataset of one size, each stage in its own forked process
+        so that peak memory of a stage isn't hidden by an earlier one
+    Inputs:
+        label: dataset size, e.g. '100K' or '1M'
+        data_dir: folder of synthetic datasets, the dataset of this size is generated into data_dir/label
+        stages: stages to run, in order
+        min_support: minimum support of rules
+        engine: pair counting engine
+        workers: number of worker processes counting pairs
+        seed: random seed of synthetic data
+        n_products: number of products of synthetic data
+    Returns:
+        results: list of result dictionaries of each stage
+    """
+    try:
+        folder = os.path.join(data_dir, label)
+        paths = {'dir': folder, 'prior': os.path.join(folder, 'order_products__prior.csv'),
+                 'orders': os.path.join(folder, 'orders.csv'), 'products': os.path.join(folder, 'products.csv')}
+        options = {'rows': parse_size(label), 'products': n_products, 'seed': seed, 'min_support': min_support,
+                   'engine': engine, 'workers': workers}
+        if 'generate_data' not in stages and not os.path.exists(paths['prior']):
+            stages = ['generate_data'] + list(stages)
+
+        results = []
+        for stage in stages:
+            logger.info("Running stage " + stage + " on " + label + " rows")
+            result = run_stage_process(stage, paths, options)
+            result['size'] = label
+            logger.info(stage + " on " + label + ": " + str(round(result['wall_seconds'], 2)) + " s, peak RSS "
+                        + str(round(result['peak_rss_mb'], 1)) + " MB")
+            results.append(result)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return results
+
+
+def compare_results(baseline, results, tolerance=1.2):
+    """ Compare wall time and peak memory of stages with a baseline results file
+    Inputs:
+        baseline: results dictionary loaded from a previous benchmark
+        results: list of result dictionaries of current benchmark
+        tolerance: ratio to baseline above which a stage counts as a regression
+    Returns:
+        comparison: dataframe with baseline and current wall time and peak memory of each stage and size
+    """
+    try:
+        keys = ['size', 'stage']
+        old = pd.DataFrame(baseline['results'])[keys + ['wall_seconds', 'peak_rss_mb']]
+        new = pd.DataFrame(results)[keys + ['wall_seconds', 'peak_rss_mb']]
+        comparison = old.merge(new, on=keys, suffixes=('_baseline', ''))
+        comparison['wall_ratio'] = comparison['wall_seconds'] / comparison['wall_seconds_baseline']
+        comparison['rss_ratio'] = comparison['peak_rss_mb'] / comparison['peak_rss_mb_baseline']
+        for row in comparison[(comparison['wall_ratio'] > tolerance) | (comparison['rss_ratio'] > tolerance)].itertuples():
+            logger.warning("Regression in " + row.stage + " on " + row.size + ": wall time x"
+                           + str(round(row.wall_ratio, 2)) + ", peak RSS x" + str(round(row.rss_ratio, 2)))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return comparison
+
+
+def run_benchmark(args):
+    """ Benchmark mining and scoring stages on synthetic datasets of several sizes and save results as json
+    Inputs:
+        args that contain sizes, stages, synthetic data folder, rule mining options, output and baseline paths
+    Returns:
+        report: dictionary saved to the output json
+    """
+    try:
+        results = []
+        for label in args.sizes:
+            results += benchmark_size(label, args.data_dir, args.stages, args.min_support, args.engine, args.workers,
+                                      args.seed)
+        report = {'version': RESULTS_VERSION,
+                  'created': datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                  'python': platform.python_version(), 'platform': platform.platform(),
+                  'cpus': multiprocessing.cpu_count(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                  'options': {'min_support': args.min_support, 'engine': args.engine, 'workers': args.workers,
+                              'seed': args.seed},
+                  'results': results}
+        output_dir = os.path.dirname(args.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("Benchmark results saved to file: " + args.output)
+
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                compare_results(json.load(f), results)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return report
@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Version of the cache layout, caches written with another version are rebuilt
+CACHE_VERSION = 1
+
+
+def source_fingerprint(path):
+    """ Describe a source file so that a cache can tell when it changed
+    Inputs:
+        path: path to source csv
+    Returns:
+        dictionary with size and modification time of the file
+    """
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def cache_folder(path, cache_dir):
+    """ Folder holding cached columns of a source file
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+    Returns:
+        path to cache folder of the source file, named after the file and a hash of its absolute path so that files
+        with the same name in different folders get their own cache
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '-' + digest)
+
+
+def read_manifest(path, cache_dir):
+    """ Read manifest of a cached source file
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+    Returns:
+        manifest dictionary, None if there's no cache
+    """
+    manifest_path = os.path.join(cache_folder(path, cache_dir), 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def is_valid(path, cache_dir, encoding=None):
+    """ Check if cache of a source file is up to date
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+        encoding: encoding the source file has to be read with
+    Returns:
+        True if cache was built from current version of the source file
+    """
+    manifest = read_manifest(path, cache_dir)
+    return manifest is not None and manifest['version'] == CACHE_VERSION and manifest['encoding'] == encoding \
+        and manifest['source'] == source_fingerprint(path)
+
+
+def build_cache(path, cache_dir, encoding=None):
+    """ Parse a csv file once and save each column as a typed, memory-mappable .npy file
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+        encoding: encoding to read the source file with
+    Returns:
+        manifest dictionary of the cache
+    """
+    try:
+        fingerprint = source_fingerprint(path)
+        df = pd.read_csv(path, encoding=encoding)
+        # Unnamed index column written with the csv is not needed
+        df = df.loc[:, ~df.columns.str.startswith('Unnamed')]
+        folder = cache_folder(path, cache_dir)
+        os.makedirs(folder, exist_ok=True)
+
+        columns = {}
+        for col in df.columns:
+            values = df[col]
+            null = values.isnull().values
+            if values.dtype == object:
+                # Strings are saved as utf-8 bytes, missing values in a separate mask
+                arr = np.array(values.fillna('').str.encode('utf-8').tolist(), dtype=bytes)
+                kind = 'str'
+            elif np.issubdtype(values.dtype, np.integer) and len(values) > 0 \
+                    and values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+                arr = values.values.astype(np.int32)
+                kind = 'num'
+            else:
+                arr = values.values
+                kind = 'num'
+            np.save(os.path.join(folder, col + '.npy'), arr)
+            if kind == 'str' and null.any():
+                np.save(os.path.join(folder, col + '.null.npy'), null)
+            columns[col] = {'kind': kind, 'has_null': bool(kind == 'str' and null.any())}
+
+        manifest = {'version': CACHE_VERSION, 'encoding': encoding, 'source': fingerprint, 'rows': len(df),
+                    'columns': columns}
+        # Manifest is written last, a cache stopped half way is never taken as valid
+        tmp_path = os.path.join(folder, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(folder, 'manifest.json'))
+        logger.info("Cache built for " + path + " with " + str(len(df)) + " rows in " + folder)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return manifest
+
+
+def load_table(path, cache_dir, columns=None, start=0, stop=None, encoding=None):
+    """ Load columns of a csv file from its cache, the cache is built or rebuilt first if source file changed
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+        columns: columns to load, all columns if None
+        start, stop: range of rows to load, all rows if stop is None
+        encoding: encoding to read the source file with when building the cache
+    Returns:
+        df: dataframe with columns loaded
+    """
+    try:
+        if not is_valid(path, cache_dir, encoding):
+            logger.info("Cache missing or outdated for " + path)
+            build_cache(path, cache_dir, encoding)
+        manifest = read_manifest(path, cache_dir)
+        folder = cache_folder(path, cache_dir)
+        data = {}
+        for col in columns or list(manifest['columns']):
+            # Only rows in range are read from the memory-mapped file
+            arr = np.load(os.path.join(folder, col + '.npy'), mmap_mode='r')[start:stop]
+            if manifest['columns'][col]['kind'] == 'str':
+                values = pd.Series(np.asarray(arr)).str.decode('utf-8')
+                if manifest['columns'][col]['has_null']:
+                    null = np.load(os.path.join(folder, col + '.null.npy'), mmap_mode='r')[start:stop]
+                    values[np.asarray(null)] = np.nan
+                data[col] = values.values
+            else:
+                data[col] = np.asarray(arr)
+        df = pd.DataFrame(data)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return df
+
+
+def count_cached_rows(path, cache_dir):
+    """ Number of rows of a cached csv file, the cache is built first if needed
+    Inputs:
+        path: path to source csv
+        cache_dir: root folder of the cache
+    Returns:
+        number of data rows
+    """
+    if not is_valid(path, cache_dir):
+        build_cache(path, cache_dir)
+    return read_manifest(path, cache_dir)['rows']
+
+
+def run_cache(args):
+    """ Convert acquired csv files into columnar cache, so that later stages don't parse them again
+    Inputs:
+        args that contain paths of prior orders, orders, products csv and cache folder
+    Returns:
+        None
+    """
+    for path in [args.input1, args.input2, args.input3]:
+        if path is None:
+            continue
+        if is_valid(path, args.cache_dir):
+            logger.info("Cache is up to date for " + path)
+        else:
+            build_cache(path, args.cache_dir)
@@ -0,0 +1,265 @@
+import os
+import time
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from src.market_basket_analysis import association_rules, sweep_rules
+from src.stream_orders import read_orders, read_products
+from src.rule_index import RuleIndex
+from src.scores import index_rules, get_scores, recommendation_lookup
+from src.data_cache import load_table
+
+logger = logging.getLogger(__name__)
+
+
+def time_split(items, orders, test_orders=1):
+    """ Split orders by time within each user, the last orders of a user are tested on rules mined from earlier ones
+    Inputs:
+        items: raw data of orders, with order_id as index and item_id as value
+        orders: orders dataframe with order_id, user_id and order_number
+        test_orders: number of last orders of each user in test set
+    Returns:
+        folds: list with one (name, test mask) over rows of items
+    """
+    try:
+        meta = orders.loc[orders['order_id'].isin(items.index), ['order_id', 'user_id', 'order_number']]
+        # Number of orders of the user placed after this one, 0 for the last order
+        meta = meta.assign(later=meta.groupby('user_id')['order_number'].rank(method='first', ascending=False) - 1,
+                           n_user=meta.groupby('user_id')['order_id'].transform('size'))
+        # A user needs at least one order left for training
+        test_ids = meta.loc[(meta['later'] < test_orders) & (meta['n_user'] > test_orders), 'order_id']
+        missing = items.index.nunique() - len(meta)
+        if missing > 0:
+            logger.warning(str(missing) + " orders have no user or order number, they're kept for training")
+        test_mask = items.index.isin(test_ids)
+        if not test_mask.any():
+            raise ValueError('No test orders, orders data has to cover orders of prior orders data')
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return [('time', test_mask)]
+
+
+def kfold_split(items, folds=5, seed=0):
+    """ Split orders into k folds, each fold is tested on rules mined from the other folds
+    Inputs:
+        items: raw data of orders, with order_id as index and item_id as value
+        folds: number of folds
+        seed: seed of random assignment of orders to folds
+    Returns:
+        folds: list of (name, test mask) over rows of items
+    """
+    try:
+        order_ids = items.index.unique().values
+        if folds < 2 or folds > len(order_ids):
+            raise ValueError('Number of folds has to be between 2 and number of orders')
+        # Orders are assigned to folds as a whole, so that no order is cut
+        fold_of = pd.Series(np.random.RandomState(seed).permutation(len(order_ids)) % folds, index=order_ids)
+        row_fold = fold_of.reindex(items.index).values
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return [('fold' + str(i + 1), row_fold == i) for i in range(folds)]
+
+
+def rules_key(train, min_support, engine):
+    """ Key of rules mined from training orders, same training data and parameters give the same key
+    Inputs:
+        train: training orders, with order_id as index and item_id as value
+        min_support: minimum support of rules
+        engine: pair counting engine
+    Returns:
+        hex digest of training data and parameters
+    """
+    digest = hashlib.sha1()
+    digest.update(train.index.values.astype(np.int64).tobytes())
+    digest.update(train.values.astype(np.int64).tobytes())
+    digest.update((str(min_support) + engine).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fold_rules(train, min_support, engine='counter', workers=1, rules_cache=None):
+    """ Mine rules of a fold, or load them from the rules cache if mined before
+    Inputs:
+        train: training orders, with order_id as index and item_id as value
+        min_support: minimum support of rules
+        engine: pair counting engine
+        workers: number of worker processes counting pairs
+        rules_cache: folder of mined rules, rules are always mined if None
+    Returns:
+        rules: association rules table
+    """
+    try:
+        path = None
+        if rules_cache is not None:
+            path = os.path.join(rules_cache, 'rules_' + rules_key(train, min_support, engine) + '.csv')
+            if os.path.exists(path):
+                logger.info("Rules loaded from cache: " + path)
+                # Lifts have to come back exactly, rules with equal lift are ordered by them
+                return pd.read_csv(path, float_precision='round_trip')
+        rules = association_rules(train, min_support, engine, workers)
+        if path is not None:
+            os.makedirs(rules_cache, exist_ok=True)
+            # Write to a temporary file first so a failed run never leaves half written rules behind
+            rules.to_csv(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            logger.info("Rules saved to cache: " + path)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rules
+
+
+def evaluate_fold(rules, test, k=5):
+    """ Compute precision@k, recall@k, hit rate and a get_scores style score in one pass over a test fold,
+        all of them from the same top k partners of each item
+        Every item of a test order with 2 or more items is a seed, its top k partners are hits if they are in the same order
+    Inputs:
+        rules: association rules mined from training orders
+        test: test orders, with order_id as index and item_id as value
+        k: number of recommendations of each seed item
+    Returns:
+        metrics: dictionary of precision, recall, hit_rate and score
+    """
+    try:
+        rows = test.reset_index()
+        rows.columns = ['order_id', 'item_id']
+        # Position of each item in its order, and last position of each item in its order
+        rows['pos'] = rows.groupby('order_id').cumcount()
+        last = rows.groupby(['order_id', 'item_id'])['pos'].max().rename('last_pos')
+        last.index.names = ['order_id', 'partner_id']
+        rows['first'] = ~rows.duplicated(['order_id', 'item_id'])
+        rows['size'] = rows['order_id'].map(rows[rows['first']].groupby('order_id').size())
+
+        # top k partners of each item, looked up from rules in both directions, with their last position in the order
+        top = RuleIndex.from_rules(rules).top_k(k)
+        recs = rows.merge(top[['item_id', 'partner_id']], on='item_id').join(last, on=['order_id', 'partner_id'])
+        recs['hit'] = recs['last_pos'].notna()
+        # An item bought twice in one order is a seed once
+        seeds = rows[rows['first'] & (rows['size'] >= 2)]
+        per_seed = recs[recs['first']].groupby(['order_id', 'item_id'])['hit'].agg(hits='sum', n_recs='size')
+        per_seed = seeds.set_index(['order_id', 'item_id']).join(per_seed).fillna({'hits': 0, 'n_recs': 0})
+
+        # Seeds without any recommendation count as misses for recall and hit rate
+        precision = per_seed['hits'].sum() / per_seed['n_recs'].sum() if per_seed['n_recs'].sum() > 0 else np.nan
+        recall = (per_seed['hits'] / (per_seed['size'] - 1)).mean()
+        hit_rate = (per_seed['hits'] > 0).mean()
+
+        # Score of get_scores from the same partners: every item with partners counts itself and each partner bought
+        # at or after its position, divided by number of recommendations that can match
+        scored = rows[rows['item_id'].isin(top['item_id'])]
+        num_item = scored.groupby('order_id').size()
+        hits = num_item.add(recs[recs['last_pos'] >= recs['pos']].groupby('order_id').size(), fill_value=0)
+        first_k = np.minimum(num_item, k)
+        count = np.maximum(num_item - k, 0) * k + first_k * (first_k + 1) // 2
+        score = (hits / count).mean() if len(num_item) > 0 else np.nan
+        metrics = {'precision': precision, 'recall': recall, 'hit_rate': hit_rate, 'score': score}
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return metrics
+
+
+def evaluate(items, folds, k=5, min_support=0.01, engine='counter', workers=1, rules_cache=None):
+    """ Evaluate rules on each test fold, mining rules from the rest of the orders
+    Inputs:
+        items: raw data of orders, with order_id as index and item_id as value
+        folds: list of (name, test mask) from time_split or kfold_split
+        k: number of recommendations of each seed item
+        min_support: minimum support of rules
+        engine: pair counting engine
+        workers: number of worker processes counting pairs
+        rules_cache: folder of mined rules, so that rules of a fold are mined only once
+    Returns:
+        results: dataframe with metrics of each fold, and their mean
+    """
+    try:
+        rows = []
+        for name, test_mask in folds:
+            train, test = items[~test_mask], items[test_mask]
+            rules = fold_rules(train, min_support, engine, workers, rules_cache)
+            metrics = evaluate_fold(rules, test, k)
+            logger.info("Evaluated " + name + ": " + str(metrics))
+            rows.append(dict({'fold': name, 'train_orders': train.index.nunique(), 'test_orders': test.index.nunique(),
+                              'rules': len(rules)}, **metrics))
+        results = pd.DataFrame(rows)
+        if len(results) > 1:
+            results = pd.concat([results, pd.DataFrame([dict(results.drop(columns='fold').mean(), fold='mean')])],
+                                ignore_index=True)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return results
+
+
+def run_evaluation(args):
+    """ Evaluate recommendations with time based or k-fold splits of prior orders
+       Inputs:
+           args that contain paths of prior orders and orders data, split and rule mining options
+       Returns:
+           results: metrics of each fold
+    """
+    try:
+        items = read_orders(args.input1, cache_dir=args.cache_dir)
+        items = items.set_index('order_id')['product_id'].rename('item_id')
+        if args.split == 'time':
+            if args.cache_dir is not None:
+                orders = load_table(args.input2, args.cache_dir)
+            else:
+                orders = pd.read_csv(args.input2)
+            folds = time_split(items, orders, args.test_orders)
+        else:
+            folds = kfold_split(items, args.folds, args.seed)
+
+        results = evaluate(items, folds, args.k, args.min_support, args.engine, args.workers, args.rules_cache)
+        results.to_csv(args.output, index=False)
+        logger.info("Evaluation results saved to file: " + args.output)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return results
+
+
+def run_sweep(args):
+    """ Compare rule count, coverage, test score and timing of several min support thresholds,
+        with item pairs of training data counted once at the lowest threshold
+       Inputs:
+           args that contain paths of prior orders and products data, thresholds and rule mining options
+       Returns:
+           results: comparison table with one row for each threshold
+    """
+    try:
+        prior = read_orders(args.input1, cache_dir=args.cache_dir)
+        products = read_products(args.input2, args.cache_dir)
+        # Same 80:20 train/test split as get_scores
+        train = prior.head(int(len(prior) * (80 / 100))).set_index('order_id')['product_id'].rename('item_id')
+        test_order = pd.merge(prior[len(train):], products.rename(columns={'product_name': 'item_name'}), how='left',
+                              on='product_id')
+        if args.rules_dir is not None:
+            os.makedirs(args.rules_dir, exist_ok=True)
+
+        rows = []
+        start = time.perf_counter()
+        for min_support, rules in sweep_rules(train, args.thresholds, args.engine, args.workers):
+            rules_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            train_rules_final = index_rules(rules, products).sort_values('lift', ascending=False)
+            lookup = recommendation_lookup(train_rules_final)
+            score = np.nanmean(get_scores(test_order, train_rules_final, lookup))
+            score_seconds = time.perf_counter() - start
+            # Share of test order items that get recommendations
+            coverage = test_order['item_name'].isin(lookup).mean()
+            rows.append({'min_support': min_support, 'rules': len(rules), 'items': len(lookup), 'coverage': coverage,
+                         'score': score, 'rules_seconds': rules_seconds, 'score_seconds': score_seconds})
+            logger.info("Min support " + str(min_support) + ": " + str(len(rules)) + " rules, score " + str(score))
+            if args.rules_dir is not None:
+                rules.to_csv(os.path.join(args.rules_dir, 'rules_' + str(min_support) + '.csv'), index=False)
+            start = time.perf_counter()
+        results = pd.DataFrame(rows)
+        results.to_csv(args.output, index=False)
+        logger.info("Sweep results saved to file: " + args.output)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return results
@@ -0,0 +1,196 @@
+import logging
+from collections import Counter
+import numpy as np
+import pandas as pd
+from src.market_basket_analysis import update_filter_support, freq
+from src.stream_orders import read_orders, read_products
+from src.instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+
+class FPNode:
+    """
+    Node of a FP-tree, holding an item and how many transactions share the path from root to this node
+    """
+    __slots__ = ('item', 'count', 'parent', 'children')
+
+    def __init__(self, item, parent):
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+
+
+def build_tree(transactions):
+    """ Build a FP-tree from transactions
+    Inputs:
+        transactions: list of (items, count), items of each transaction are in same global order
+    Returns:
+        header: dictionary of item to all tree nodes holding that item
+    """
+    root = FPNode(None, None)
+    header = {}
+    for items, count in transactions:
+        node = root
+        for item in items:
+            child = node.children.get(item)
+            if child is None:
+                child = FPNode(item, node)
+                node.children[item] = child
+                header.setdefault(item, []).append(child)
+            child.count += count
+            node = child
+    return header
+
+
+def mine_tree(header, is_frequent, suffix, max_len, found):
+    """ Find frequent itemsets of a FP-tree by growing suffixes with conditional FP-trees
+    Inputs:
+        header: header table of FP-tree from build_tree
+        is_frequent: function telling if a frequency count is above min support
+        suffix: itemset the FP-tree is conditioned on
+        max_len: maximum length of itemsets, no limit if None
+        found: dictionary of frozenset itemset to frequency, updated with itemsets found
+    Returns:
+        None
+    """
+    for item, nodes in header.items():
+        count = sum(node.count for node in nodes)
+        if not is_frequent(count):
+            continue
+        itemset = suffix + (item,)
+        found[frozenset(itemset)] = count
+        if max_len is not None and len(itemset) >= max_len:
+            continue
+
+        # Conditional pattern base: paths from root to each node of current item
+        paths = []
+        for node in nodes:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            if path:
+                paths.append((path[::-1], node.count))
+
+        # Keep items that are still frequent together with current itemset
+        cond_freq = Counter()
+        for path, path_count in paths:
+            for path_item in path:
+                cond_freq[path_item] += path_count
+        paths = [([i for i in path if is_frequent(cond_freq[i])], path_count) for path, path_count in paths]
+        paths = [(path, path_count) for path, path_count in paths if path]
+        if paths:
+            mine_tree(build_tree(paths), is_frequent, itemset, max_len, found)
+
+
+def frequent_itemsets(items, min_support, max_len=None):
+    """ Mine frequent itemsets of all lengths with FP-growth
+        Inputs:
+            items: raw data of orders
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            max_len: maximum length of itemsets, no limit if None
+        Returns:
+            itemsets: dataframe with itemset (tuple of sorted item ids), length, freq and support
+    """
+    try:
+        # Prune items below min support and orders that have less than 2 items, same as association_rules
+        items, filtered_orders = update_filter_support(items, min_support)
+        n_orders = len(filtered_orders)
+
+        def is_frequent(count):
+            return count / n_orders * 100 >= min_support
+
+        # Order items in each transaction by frequency, so that transactions share prefixes in the tree
+        by_freq = freq(items).sort_index().sort_values(ascending=False, kind='mergesort').index
+        rank = pd.Series(np.arange(len(by_freq)), index=by_freq)
+        ranked = pd.DataFrame({'order_id': items.index, 'rank': rank.reindex(items.values).values,
+                               'item_id': items.values}).drop_duplicates(['order_id', 'item_id'])
+        ranked = ranked.sort_values(['order_id', 'rank'], kind='mergesort')
+        # Identical transactions only need to be added to the tree once
+        transactions = Counter(ranked.groupby('order_id', sort=False)['item_id'].agg(tuple))
+        logger.info("Building FP-tree from " + str(len(transactions)) + " distinct transactions")
+
+        found = {}
+        mine_tree(build_tree(transactions.items()), is_frequent, (), max_len, found)
+
+        itemsets = pd.DataFrame({'itemset': [tuple(sorted(itemset)) for itemset in found],
+                                 'freq': list(found.values())})
+        itemsets['length'] = itemsets['itemset'].str.len()
+        itemsets['support'] = itemsets['freq'] / n_orders * 100
+        itemsets = itemsets[['itemset', 'length', 'freq', 'support']]
+        logger.info("Frequent itemsets found: " + str(len(itemsets)))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return itemsets
+
+
+def itemset_rules(itemsets, min_len=3):
+    """ Generate association rules 'antecedent -> consequent' from frequent itemsets,
+        with the consequent being one item of the itemset and the antecedent all the other items
+        Inputs:
+            itemsets: frequent itemsets of all lengths from frequent_itemsets
+            min_len: minimum length of itemsets to form rules from
+        Returns:
+            rules: rules table with antecedent, consequent, freq, support, confidence and lift in descending order of lift
+    """
+    try:
+        support = dict(zip(itemsets['itemset'], itemsets['support']))
+        rows = []
+        for itemset, itemset_freq, itemset_support in itemsets.loc[itemsets['length'] >= min_len,
+                                                                  ['itemset', 'freq', 'support']].values:
+            for consequent in itemset:
+                antecedent = tuple(item for item in itemset if item != consequent)
+                # all subsets of a frequent itemset are frequent, so their support is known
+                support_antecedent = support[antecedent]
+                support_consequent = support[(consequent,)]
+                rows.append([antecedent, consequent, itemset_freq, itemset_support,
+                             itemset_support / support_antecedent,
+                             itemset_support / (support_antecedent * support_consequent)])
+        rules = pd.DataFrame(rows, columns=['antecedent', 'consequent', 'freq', 'support', 'confidence', 'lift'])
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rules.sort_values('lift', ascending=False)
+
+
+def run_itemsets(args):
+    """ Create rules table of frequent itemsets with at least 3 items
+       Inputs:
+           orders: orders dataframe
+           products: products dataframe
+       Returns:
+           rules: rules table with item names
+    """
+    try:
+        with stage('read_orders') as step:
+            orders = read_orders(args.input1, cache_dir=args.cache_dir)
+            step['rows'] = len(orders)
+        with stage('read_products') as step:
+            products = read_products(args.input2, args.cache_dir)
+            step['rows'] = len(products)
+        logger.info("Datasets read in successfully")
+
+        # Convert from DataFrame to a Series, with order_id as index and item_id as value
+        orders = orders.set_index('order_id')['product_id'].rename('item_id')
+        with stage('frequent_itemsets') as step:
+            itemsets = frequent_itemsets(orders, args.min_support, args.max_len)
+            step['rows'] = len(itemsets)
+        with stage('itemset_rules') as step:
+            rules = itemset_rules(itemsets, args.min_len)
+            step['rows'] = len(rules)
+
+        with stage('write_table') as step:
+            names = products.set_index('product_id')['product_name']
+            rules['antecedent'] = [' & '.join(names.reindex(list(antecedent)).astype(str)) for antecedent in rules['antecedent']]
+            rules['consequent'] = names.reindex(rules['consequent'].values).values
+            rules.to_csv(args.output, index=False)
+            step['rows'] = len(rules)
+        logger.info("Itemset rules table generated successfully: " + str(len(rules)) + " rules")
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rules
@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import resource
+import datetime
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Version of the run report layout
+REPORT_VERSION = 1
+
+# Steps recorded since start_report, None while no report is being recorded
+_steps = None
+# Recorded steps by their path, so that a step run many times (e.g. once per chunk) is added up into one entry
+_step_index = {}
+# Names of steps currently running, outer step first
+_running = []
+# Step to profile: its name, where to save its profile and the profiler, shared by all runs of the step
+_profile = None
+
+
+def peak_rss_mb():
+    """ Peak resident memory of current process
+    Inputs:
+        None
+    Returns:
+        peak resident memory in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def start_report(profile_step=None, profile_output=None):
+    """ Start recording steps for a run report
+    Inputs:
+        profile_step: name of a step to run under cProfile, no step is profiled if None
+        profile_output: path to save profile statistics of that step (.prof)
+    Returns:
+        None
+    """
+    global _steps, _profile
+    _steps = []
+    _step_index.clear()
+    del _running[:]
+    _profile = {'step': profile_step, 'output': profile_output, 'profiler': cProfile.Profile()} \
+        if profile_step is not None else None
+
+
+@contextmanager
+def stage(name):
+    """ Record wall time, CPU time, peak memory and row count of a step, steps inside it are recorded as sub-steps,
+        runs of a step with the same path are added up into one entry with the number of runs
+    Inputs:
+        name: name of the step
+    Returns:
+        Use yield to give a dictionary of the run, set 'rows' in it to record number of rows the run handled
+    """
+    if _steps is None:
+        # Nothing is recorded unless a report was started
+        yield {}
+        return
+    path = '/'.join(_running + [name])
+    step = _step_index.get(path)
+    if step is None:
+        step = {'step': path, 'rows': None, 'runs': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0,
+                'peak_rss_increase_mb': 0.0}
+        # Steps are listed in order they first started
+        _steps.append(step)
+        _step_index[path] = step
+    run = {'rows': None}
+    _running.append(name)
+    profiler = _profile['profiler'] if _profile is not None and _profile['step'] == name else None
+    start_rss = peak_rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield run
+    except BaseException:
+        step['failed'] = True
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        step['runs'] += 1
+        step['wall_seconds'] += time.perf_counter() - start_wall
+        step['cpu_seconds'] += time.process_time() - start_cpu
+        step['peak_rss_mb'] = peak_rss_mb()
+        # How much runs of the step raised peak memory of the process
+        step['peak_rss_increase_mb'] += step['peak_rss_mb'] - start_rss
+        if run['rows'] is not None:
+            step['rows'] = (step['rows'] or 0) + run['rows']
+        _running.pop()
+
+
+def save_profile(profiler, path):
+    """ Save profile statistics of a step, added up over all runs of the step, and log its slowest functions
+    Inputs:
+        profiler: cProfile.Profile that ran the step
+        path: path to save profile statistics (.prof), readable with pstats or snakeviz
+    Returns:
+        None
+    """
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler)
+    top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:10]
+    for (filename, line, function), (_, _, _, cumtime, _) in top:
+        logger.info("Profile " + str(round(cumtime, 3)) + " s in " + function + " (" + os.path.basename(filename)
+                    + ":" + str(line) + ")")
+    logger.info("Profile saved to file: " + path)
+
+
+def write_report(path, command=None):
+    """ Write steps recorded since start_report as a json run report, and stop recording
+    Inputs:
+        path: path to run report (.json)
+        command: command line of the run
+    Returns:
+        report: dictionary saved to the file
+    """
+    global _steps, _profile
+    try:
+        if _profile is not None:
+            save_profile(_profile['profiler'], _profile['output'])
+        report = {'version': REPORT_VERSION,
+                  'created': datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+                  'command': command,
+                  'steps': _steps}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("Run report saved to file: " + path)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    finally:
+        _steps, _profile = None, None
+        _step_index.clear()
+    return report
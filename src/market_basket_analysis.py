@@ -1,7 +1,15 @@
 import pandas as pd
+import numpy as np
 import logging
 from itertools import combinations, groupby
 from collections import Counter
+from multiprocessing import Pool
+from scipy import sparse
+from src.stream_orders import read_orders, read_products, read_order_chunks, add_counts
+from src.rule_state import save_state, load_state
+from src.rule_index import RuleIndex
+from src.pair_sketch import PairSketch, BATCH_ROWS
+from src.instrumentation import stage
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +72,158 @@ def generate_pairs(df):
         raise Exception('Invalid input')
 
 
+def sparse_pairs(df):
+    """ Count pairs of items from a sparse order x item incidence matrix
+    Inputs:
+        df: orders dataframe
+    Returns:
+        item_pairs: dataframe of pair frequency 'freq_AB' indexed by item pair,
+        Co-occurrence counts of all pairs come from a single sparse matrix product instead of enumerating combinations per order,
+        each pair is kept once with the item that shows up first in the orders as item A
+    """
+    try:
+        # Map order ids and item ids to consecutive row and column numbers
+        order_codes, order_ids = pd.factorize(df.index)
+        item_codes, item_ids = pd.factorize(df.values)
+        incidence = sparse.csr_matrix((np.ones(len(df), dtype=np.int32), (order_codes, item_codes)),
+                                      shape=(len(order_ids), len(item_ids)))
+        # An item bought twice in one order still counts once for that order
+        incidence.data[:] = 1
+        # Entry (A, B) of the item x item product is the number of orders containing both A and B
+        co_occurrence = sparse.triu(incidence.T.dot(incidence).tocsr(), k=1).tocsr()
+        co_occurrence.sort_indices()
+        co_occurrence = co_occurrence.tocoo()
+        index = pd.MultiIndex.from_arrays([item_ids[co_occurrence.row], item_ids[co_occurrence.col]])
+        item_pairs = pd.DataFrame({'freq_AB': co_occurrence.data.astype(np.int64)}, index=index)
+    except Exception as e:
+        logger.warning('Could not count pairs due to invalid input')
+        raise Exception('Invalid input')
+    return item_pairs
+
+
+def sketch_pairs(df, sketch):
+    """ Add pairs of items to an approximate pair sketch, batch by batch of orders
+    Inputs:
+        df: orders dataframe, rows of an order have to be next to each other
+        sketch: PairSketch to update
+    Returns:
+        sketch: updated PairSketch, only pairs of one batch are held exactly in memory at once
+    """
+    try:
+        order_ids = df.index.values
+        order_starts = np.flatnonzero(np.r_[True, order_ids[1:] != order_ids[:-1]])
+        # Batches end on order boundaries so that no order is split
+        bounds = np.unique(np.r_[order_starts[np.searchsorted(order_starts, np.arange(0, len(df), BATCH_ROWS))],
+                                 len(df)])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            batch = sparse_pairs(df.iloc[start:end])
+            keys = sketch.pair_keys(batch.index.get_level_values(0).values, batch.index.get_level_values(1).values)
+            sketch.update(keys, batch['freq_AB'].values, len(np.unique(order_ids[start:end])))
+    except Exception as e:
+        logger.warning('Could not sketch pairs due to invalid input')
+        raise Exception('Invalid input')
+    return sketch
+
+
+def _count_shard(shard):
+    """ Count pairs of items for one shard of orders in a worker process
+    Inputs:
+        shard: tuple of order ids, item ids and pair counting engine
+    Returns:
+        item_pairs: dataframe of pair frequency 'freq_AB' indexed by item pair
+    """
+    order_ids, item_ids, engine = shard
+    return count_pairs(pd.Series(item_ids, index=order_ids, name='item_id'), engine)
+
+
+def parallel_pairs(df, workers, engine='counter'):
+    """ Count pairs of items in worker processes, each one counting a shard of orders
+    Inputs:
+        df: orders dataframe, rows of an order have to be next to each other
+        workers: number of worker processes
+        engine: 'counter' or 'sparse', see count_pairs
+    Returns:
+        item_pairs: dataframe of pair frequency 'freq_AB' indexed by item pair, same as counted in a single process
+    """
+    try:
+        order_ids = df.index.values
+        item_ids = df.values
+        # Split orders into contiguous shards of order_id with about the same number of rows
+        order_starts = np.flatnonzero(np.r_[True, order_ids[1:] != order_ids[:-1]])
+        targets = np.arange(1, workers) * len(df) // workers
+        bounds = np.unique(np.r_[0, order_starts[np.minimum(np.searchsorted(order_starts, targets),
+                                                            len(order_starts) - 1)], len(df)])
+        shards = [(order_ids[start:end], item_ids[start:end], engine) for start, end in zip(bounds[:-1], bounds[1:])]
+        logger.info("Counting pairs in " + str(len(shards)) + " shards of orders")
+
+        with Pool(workers) as pool:
+            partial_pairs = pool.map(_count_shard, shards)
+
+        # Merging shards in order keeps pairs in order of first appearance, same as a single 'Counter'
+        item_pairs = None
+        for pairs in partial_pairs:
+            item_pairs = add_counts(item_pairs, pairs)
+
+        if engine == 'sparse':
+            # Each shard puts the item seen first in the shard as item A, orient pairs by first appearance in all orders
+            unique_items = pd.unique(item_ids)
+            rank = pd.Series(np.arange(len(unique_items)), index=unique_items)
+            item_a = item_pairs.index.get_level_values(0).values
+            item_b = item_pairs.index.get_level_values(1).values
+            swap = rank[item_a].values > rank[item_b].values
+            index = pd.MultiIndex.from_arrays([np.where(swap, item_b, item_a), np.where(swap, item_a, item_b)])
+            item_pairs = pd.DataFrame({'freq_AB': item_pairs['freq_AB'].values}, index=index).groupby(level=[0, 1]).sum()
+            item_pairs = item_pairs.iloc[np.lexsort((rank[item_pairs.index.get_level_values(1)].values,
+                                                     rank[item_pairs.index.get_level_values(0)].values))]
+            item_pairs.index.names = [None, None]
+    except Exception as e:
+        logger.warning('Could not count pairs in parallel due to invalid input')
+        raise Exception('Invalid input')
+    return item_pairs
+
+
+def count_pairs(df, engine='counter', workers=1, min_support=0):
+    """ Count how many orders contain each pair of items
+    Inputs:
+        df: orders dataframe
+        engine: 'counter' to count pairs yielded by generate_pairs, 'sparse' to count them with one sparse matrix product,
+            or 'approx' to estimate counts of frequent pairs in fixed memory
+        workers: number of worker processes, pairs are counted in a single process if 1
+        min_support: minimum support of pairs kept by the 'approx' engine
+    Returns:
+        item_pairs: dataframe of pair frequency 'freq_AB' indexed by item pair,
+        with error bound of each estimate 'freq_AB_error' for the 'approx' engine
+    """
+    if engine == 'approx':
+        if workers > 1:
+            logger.info("Approximate pair counts are added to one sketch, counting in a single process")
+        item_pairs = sketch_pairs(df, PairSketch(min_support)).pairs()
+    elif workers > 1:
+        item_pairs = parallel_pairs(df, workers, engine)
+    elif engine == 'counter':
+        # 'Counter' keeps track of how many times equivalent values for pairs are added
+        item_pairs = pd.Series(Counter(generate_pairs(df))).rename("freq").to_frame("freq_AB")
+    elif engine == 'sparse':
+        item_pairs = sparse_pairs(df)
+    else:
+        logger.warning('Unknown pair counting engine: ' + str(engine))
+        raise Exception('Invalid input')
+    return item_pairs
+
+
+def item_stats_arrays(stats):
+    """ Store stats (frequency, support) of items in dense arrays indexed by remapped item id
+    Inputs:
+        stats: calculated frequency and support for items
+    Returns:
+        item_ids: sorted item ids, position of an item id in it is its remapped id
+        item_freq: frequency of each remapped item id
+        item_support: support of each remapped item id
+    """
+    order = np.argsort(stats.index.values, kind='mergesort')
+    return stats.index.values[order], stats['freq'].values[order], stats['support'].values[order]
+
+
 def merge_item_stats(item_pairs, stats):
     """ Append stats (frequency, support) to each associated item
     Inputs:
@@ -73,12 +233,26 @@ def merge_item_stats(item_pairs, stats):
         merge_df: merged dataframe of item pairs with stats
     """
     try:
-        merge_df = item_pairs.merge(stats.rename(columns = {'freq': 'freq_A', 'support': 'support_A'}),
-                                    left_on = 'itemA',
-                                    right_index = True)
-        merge_df = merge_df.merge(stats.rename(columns = {'freq': 'freq_B', 'support': 'support_B'}),
-                                    left_on = 'itemB',
-                                    right_index = True)
+        item_ids, item_freq, item_support = item_stats_arrays(stats)
+        if len(item_ids) == 0:
+            # No item has stats, so no pair is kept
+            return item_pairs.iloc[:0].assign(freq_A=item_freq, support_A=item_support, freq_B=item_freq,
+                                              support_B=item_support)
+        # Remap item ids of pairs and gather stats straight from arrays
+        pos_A = np.minimum(np.searchsorted(item_ids, item_pairs['itemA'].values), len(item_ids) - 1)
+        pos_B = np.minimum(np.searchsorted(item_ids, item_pairs['itemB'].values), len(item_ids) - 1)
+        # Pairs with an item missing from stats are dropped
+        found = (item_ids[pos_A] == item_pairs['itemA'].values) & (item_ids[pos_B] == item_pairs['itemB'].values)
+        pos_A, pos_B = pos_A[found], pos_B[found]
+        merge_df = item_pairs[found].copy()
+        merge_df['freq_A'] = item_freq[pos_A]
+        merge_df['support_A'] = item_support[pos_A]
+        merge_df['freq_B'] = item_freq[pos_B]
+        merge_df['support_B'] = item_support[pos_B]
+        # Group rows by item A, then by item B in order of first appearance, as joining on item A then item B did,
+        # so that rules with same lift keep coming out in same order
+        merge_df = merge_df.iloc[np.argsort(pd.factorize(merge_df['itemA'].values)[0], kind='stable')]
+        merge_df = merge_df.iloc[np.argsort(pd.factorize(merge_df['itemB'].values)[0], kind='stable')]
     except Exception as e:
         logger.warning('Could not append stats to items due to invalid input')
         raise Exception('Invalid input')
@@ -139,37 +313,161 @@ def update_filter_support(items, min_support):
     return items, filtered_orders
 
 
-def association_rules(items, min_support):
-    """ Generate associations rules for item pairs
+def count_itemsets(items, min_support, engine='counter', workers=1):
+    """ Count item and item pair frequencies of orders filtered by minimum support
         Inputs:
             items: raw data of orders
             min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            engine: pair counting engine, 'counter', 'sparse' or 'approx'
+            workers: number of worker processes counting pairs
         Returns:
-            filtered_pairs: rules table with lift for item pairs in descending order
+            stats: frequency and support of items in filtered orders
+            item_pairs: frequency of item pairs in filtered orders
+            n_orders: number of filtered orders
     """
     try:
-        items, filtered_orders = update_filter_support(items, min_support)
+        with stage('filter_support') as step:
+            items, filtered_orders = update_filter_support(items, min_support)
+            step['rows'] = len(items)
 
         # Recalculate frequency and support for items in filtered dataframe
-        stats = freq(items).to_frame("freq")
-        stats = support(items, stats)
+        with stage('item_stats') as step:
+            stats = freq(items).to_frame("freq")
+            stats = support(items, stats)
+            step['rows'] = len(stats)
 
         logger.info("Generating items pairs now ... ")
-        # Get item pairs generator
-        pairs_generated = generate_pairs(items)
-        # Calculate item pair frequency and support ('Counter' keeps track of how many times equivalent values for pairs are added)
-        item_pairs = pd.Series(Counter(pairs_generated)).rename("freq").to_frame("freq_AB")
-        item_pairs['support_AB'] = item_pairs['freq_AB'] / len(filtered_orders) * 100
+        # Calculate item pair frequency
+        with stage('count_pairs') as step:
+            item_pairs = count_pairs(items, engine, workers, min_support)
+            step['rows'] = len(item_pairs)
         logger.info("Current items pairs: " + str(len(item_pairs)))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return stats, item_pairs, len(filtered_orders)
+
+
+def merge_orientations(item_pairs):
+    """ Add up counts of a pair counted both as (A, B) and as (B, A)
+        Inputs:
+            item_pairs: dataframe of pair frequency 'freq_AB' (and 'freq_AB_error') indexed by item pair
+        Returns:
+            item_pairs: one row per unordered pair, in orientation and order of its first appearance
+    """
+    item_a = item_pairs.index.get_level_values(0).values
+    item_b = item_pairs.index.get_level_values(1).values
+    codes = pd.factorize(pd.MultiIndex.from_arrays([np.minimum(item_a, item_b), np.maximum(item_a, item_b)]))[0]
+    if len(codes) == 0 or codes.max() + 1 == len(codes):
+        return item_pairs
+    # Codes are numbered in order of first appearance, so grouped sums line up with first rows of each pair
+    first = np.unique(codes, return_index=True)[1]
+    merged = item_pairs.groupby(codes, sort=False).sum()
+    merged.index = item_pairs.index[first]
+    return merged
+
+
+def split_itemsets(items, cut, min_support, engine='counter', workers=1):
+    """ Count item and item pair frequencies of all orders and of training orders (the first rows of all orders),
+        with pairs of each row counted only once
+        Inputs:
+            items: raw data of orders, rows of an order have to be next to each other
+            cut: number of first rows that are training orders, e.g. 80% of rows
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            engine: pair counting engine, 'counter' or 'sparse'
+            workers: number of worker processes counting pairs
+        Returns:
+            counts: (stats, item_pairs, n_orders) of all orders, same as count_itemsets gives
+            train_counts: (stats, item_pairs, n_orders) of training orders, same as count_itemsets gives
+    """
+    try:
+        if engine == 'approx':
+            # Estimates of two parts can't be added up, pairs below min support in a part are already dropped
+            raise ValueError("Approximate pair counts can't be shared, use 'counter' or 'sparse'")
+        counts, train_counts = [], []
+        for part, out in [(items, counts), (items[:cut], train_counts)]:
+            with stage('filter_support') as step:
+                filtered, filtered_orders = update_filter_support(part, min_support)
+                step['rows'] = len(filtered)
+            out += [support(filtered, freq(filtered).to_frame("freq")), None, len(filtered_orders)]
+
+        # Count of a pair only depends on orders with both of its items, so pairs of items frequent in either part
+        # are counted once and each part keeps pairs of its own frequent items
+        frequent = counts[0].index.union(train_counts[0].index)
+
+        def part_pairs(part):
+            part = part[part.isin(frequent)]
+            order_size = freq(part.index)
+            part = part[part.index.isin(order_size[order_size >= 2].index)]
+            return count_pairs(part, engine, workers) if len(part) > 0 else None
+
+        def add_pairs(total, pairs):
+            if total is None or pairs is None:
+                return pairs if total is None else total
+            if engine == 'sparse':
+                # Keep orientation of pairs already counted, same as update_itemsets
+                pairs = orient_pairs(pairs, total)
+            return add_counts(total, pairs)
+
+        # An order cut by the split has rows on both sides, its pairs are counted whole for all orders
+        order_ids = items.index.values
+        split_order = order_ids[cut] if 0 < cut < len(items) and order_ids[cut - 1] == order_ids[cut] else None
+        in_split = order_ids == split_order
+        with stage('count_pairs') as step:
+            head_pairs = part_pairs(items[:cut][~in_split[:cut]])
+            train_pairs = add_pairs(head_pairs, part_pairs(items[:cut][in_split[:cut]]))
+            rest_pairs = add_pairs(part_pairs(items[in_split]), part_pairs(items[cut:][~in_split[cut:]]))
+            item_pairs = add_pairs(head_pairs, rest_pairs)
+            step['rows'] = len(items)
+        if item_pairs is None:
+            raise ValueError('No orders with 2 or more items above min support')
+
+        for out, pairs in [(counts, item_pairs), (train_counts, train_pairs)]:
+            if pairs is None:
+                pairs = item_pairs.iloc[:0]
+            keep = pairs.index.get_level_values(0).isin(out[0].index) & pairs.index.get_level_values(1).isin(out[0].index)
+            out[1] = pairs[keep]
+        logger.info("Item pairs of all orders: " + str(len(counts[1])) + ", of training orders: "
+                    + str(len(train_counts[1])))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return tuple(counts), tuple(train_counts)
+
+
+def build_rules(stats, item_pairs, n_orders, min_support):
+    """ Construct association rules table from item and item pair frequencies
+        Inputs:
+            stats: frequency and support of items in filtered orders
+            item_pairs: frequency of item pairs in filtered orders
+            n_orders: number of filtered orders
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+        Returns:
+            filtered_pairs: rules table with lift for item pairs in descending order,
+            with error bound of support 'support_AB_error' if pair frequencies are approximate
+    """
+    try:
+        # Support of a pair is the support of the unordered itemset, both orders are added up before it's filtered
+        item_pairs = merge_orientations(item_pairs)
+        error = item_pairs['freq_AB_error'] if 'freq_AB_error' in item_pairs else None
+        item_pairs = item_pairs[['freq_AB']].copy()
+        item_pairs['support_AB'] = item_pairs['freq_AB'] / n_orders * 100
+        if error is not None:
+            # Approximate support is never below the true support, and at most this much above it
+            item_pairs['support_AB_error'] = error / n_orders * 100
 
         # Filter out item pairs below min support
         filtered_pairs = item_pairs[item_pairs['support_AB'] >= min_support]
 
-        logger.info("Item pairs with support >= 0.01: " + str(len(filtered_pairs)))
+        logger.info("Item pairs with support >= " + str(min_support) + ": " + str(len(filtered_pairs)))
 
         # Construct association rules table and calculate confidence and lift
         filtered_pairs = filtered_pairs.reset_index().rename(columns={'level_0': 'itemA', 'level_1': 'itemB'})
-        filtered_pairs = merge_item_stats(filtered_pairs, stats)
+        # Item ids are kept as int32 product ids from here on, names are only added to the final table
+        filtered_pairs = filtered_pairs.astype({'itemA': np.int32, 'itemB': np.int32})
+        with stage('merge_item_stats') as step:
+            filtered_pairs = merge_item_stats(filtered_pairs, stats)
+            step['rows'] = len(filtered_pairs)
 
         filtered_pairs['confidence_AtoB'] = filtered_pairs['support_AB'] / filtered_pairs['support_A']
         filtered_pairs['confidence_BtoA'] = filtered_pairs['support_AB'] / filtered_pairs['support_B']
@@ -183,14 +481,301 @@ def association_rules(items, min_support):
 
     # Return association rules sorted by lift in descending order
     # Larger lift implies increase in the ratio of sale of B when A is sold
-    filtered_pairs = filtered_pairs.sort_values('lift', ascending=False)
+    with stage('sort_rules') as step:
+        filtered_pairs = filtered_pairs.sort_values('lift', ascending=False)
+        step['rows'] = len(filtered_pairs)
     logger.info("Rules table created with lift for item pairs in descending order")
 
     return filtered_pairs
 
 
+def association_rules(items, min_support, engine='counter', workers=1):
+    """ Generate associations rules for item pairs
+        Inputs:
+            items: raw data of orders
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            engine: pair counting engine, 'counter', 'sparse' or 'approx'
+            workers: number of worker processes counting pairs
+        Returns:
+            filtered_pairs: rules table with lift for item pairs in descending order
+    """
+    stats, item_pairs, n_orders = count_itemsets(items, min_support, engine, workers)
+    return build_rules(stats, item_pairs, n_orders, min_support)
+
+
+def sweep_rules(items, thresholds, engine='counter', workers=1):
+    """ Generate associations rules for several min support thresholds, counting item pairs only once
+        Inputs:
+            items: raw data of orders
+            thresholds: list of min support thresholds
+            engine: pair counting engine, 'counter', 'sparse' or 'approx'
+            workers: number of worker processes counting pairs
+        Returns:
+            Use yield to return min support and its rules table, from lowest to highest threshold,
+            rules are the same as association_rules for each threshold
+    """
+    try:
+        thresholds = sorted(set(thresholds))
+        # Pairs are counted at the lowest threshold, an order with both items of a pair always has 2 or more items
+        # above min support, so counts of pairs of items above a higher threshold stay the same
+        _, item_pairs, _ = count_itemsets(items, thresholds[0], engine, workers)
+        item_a = item_pairs.index.get_level_values(0)
+        item_b = item_pairs.index.get_level_values(1)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    for min_support in thresholds:
+        # Item frequencies and number of orders change with the threshold, they only take one pass over the items
+        filtered, filtered_orders = update_filter_support(items, min_support)
+        stats = support(filtered, freq(filtered).to_frame("freq"))
+        pairs = item_pairs[item_a.isin(stats.index) & item_b.isin(stats.index)]
+        yield min_support, build_rules(stats, pairs, len(filtered_orders), min_support)
+
+
+def stream_item_freq(path, memory_budget, nrows=None, cache_dir=None):
+    """ Count item frequencies and number of orders chunk by chunk
+        Inputs:
+            path: path to prior orders csv
+            memory_budget: memory budget for a chunk in MB
+            nrows: number of rows to read, read all rows if None
+            cache_dir: if given, read prior orders from the columnar cache
+        Returns:
+            raw_freq: frequency of all items
+            raw_orders: number of all orders
+    """
+    try:
+        raw_freq = None
+        raw_orders = 0
+        for items in read_order_chunks(path, memory_budget, nrows, cache_dir):
+            raw_freq = add_counts(raw_freq, items.value_counts())
+            raw_orders += items.index.nunique()
+        logger.info("Starting with total orders: " + str(raw_orders))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return raw_freq.rename('freq'), raw_orders
+
+
+def stream_itemsets(path, min_support, memory_budget, engine='counter', nrows=None, workers=1, raw_counts=None,
+                    cache_dir=None):
+    """ Count item and item pair frequencies chunk by chunk in two passes over the prior orders file
+        Inputs:
+            path: path to prior orders csv
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            memory_budget: memory budget for a chunk in MB
+            engine: pair counting engine, 'counter', 'sparse' or 'approx'
+            nrows: number of rows to read, read all rows if None
+            workers: number of worker processes counting pairs
+            raw_counts: item frequencies and number of orders from stream_item_freq, counted in a first pass if None
+            cache_dir: if given, read prior orders from the columnar cache
+        Returns:
+            stats: frequency and support of items in filtered orders
+            item_pairs: frequency of item pairs in filtered orders
+            n_orders: number of filtered orders
+        Only chunks of orders are bounded by the memory budget, running pair counts grow with the number of distinct
+        pairs of frequent items unless the 'approx' engine is used
+    """
+    try:
+        # First pass: item frequencies over all orders to find items above min support
+        if raw_counts is None:
+            raw_counts = stream_item_freq(path, memory_budget, nrows, cache_dir)
+        raw_freq, raw_orders = raw_counts
+        frequent = raw_freq[raw_freq / raw_orders * 100 >= min_support].index
+
+        # Second pass: frequencies of items and pairs in orders with >= 2 frequent items
+        item_freq = None
+        item_pairs = None
+        n_orders = 0
+        # Approximate counts of all chunks go into one sketch of fixed size
+        sketch = PairSketch(min_support) if engine == 'approx' else None
+        for items in read_order_chunks(path, memory_budget, nrows, cache_dir):
+            items = items[items.isin(frequent)]
+            order_size = items.index.value_counts()
+            items = items[items.index.isin(order_size[order_size >= 2].index)]
+            if len(items) == 0:
+                continue
+            n_orders += items.index.nunique()
+            item_freq = add_counts(item_freq, items.value_counts())
+            with stage('count_pairs') as step:
+                if sketch is not None:
+                    sketch_pairs(items, sketch)
+                else:
+                    item_pairs = add_counts(item_pairs, count_pairs(items, engine, workers))
+                step['rows'] = len(items)
+        if sketch is not None:
+            item_pairs = sketch.pairs()
+        logger.info("After filtering out items below min support and orders that have less than 2 items: "
+                    + str(n_orders) + " orders")
+        logger.info("Current items pairs: " + str(len(item_pairs)))
+
+        stats = item_freq.rename('freq').to_frame('freq')
+        stats['support'] = stats['freq'] / n_orders * 100
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return stats, item_pairs, n_orders
+
+
+def stream_association_rules(path, min_support, memory_budget, engine='counter', nrows=None, workers=1,
+                             cache_dir=None):
+    """ Generate associations rules for item pairs by streaming the prior orders file in bounded chunks
+        Inputs:
+            path: path to prior orders csv, rows of an order have to be next to each other
+            min_support: minimum confidence constraint that's applied to frequent itemsets in order to form rules
+            memory_budget: memory budget for a chunk in MB
+            engine: pair counting engine, 'counter', 'sparse' or 'approx'
+            nrows: number of rows to read, read all rows if None
+            workers: number of worker processes counting pairs
+            cache_dir: if given, read prior orders from the columnar cache
+        Returns:
+            rules table with lift for item pairs in descending order, same as association_rules
+    """
+    stats, item_pairs, n_orders = stream_itemsets(path, min_support, memory_budget, engine, nrows, workers,
+                                                  cache_dir=cache_dir)
+    return build_rules(stats, item_pairs, n_orders, min_support)
+
+
+def orient_pairs(item_pairs, reference):
+    """ Turn pairs around to the orientation they already have in reference counts
+        Inputs:
+            item_pairs: dataframe of pair frequency 'freq_AB' indexed by item pair
+            reference: dataframe of pair frequency indexed by item pair, e.g. counts of a saved state
+        Returns:
+            item_pairs: same counts, with (B, A) stored as (A, B) if reference only has (A, B), so that adding them
+            to reference keeps one row per pair
+    """
+    item_a = item_pairs.index.get_level_values(0).values
+    item_b = item_pairs.index.get_level_values(1).values
+    reverse = pd.MultiIndex.from_arrays([item_b, item_a])
+    swap = reverse.isin(reference.index) & ~item_pairs.index.isin(reference.index)
+    if not swap.any():
+        return item_pairs
+    index = pd.MultiIndex.from_arrays([np.where(swap, item_b, item_a), np.where(swap, item_a, item_b)])
+    item_pairs = pd.DataFrame({'freq_AB': item_pairs['freq_AB'].values}, index=index)
+    return item_pairs.groupby(level=[0, 1], sort=False).sum()
+
+
+def update_itemsets(state, items, engine='counter', workers=1):
+    """ Fold newly arrived orders into item and item pair frequencies of a saved state
+        Inputs:
+            state: state loaded by load_state
+            items: new orders, with order_id as index and item_id as value
+            engine: pair counting engine, 'counter' or 'sparse'
+            workers: number of worker processes counting pairs
+        Returns:
+            state: updated state, with same frequent items as before the update
+    """
+    try:
+        if engine == 'approx':
+            # Estimates can't be added to exact counts of the state
+            raise ValueError("Approximate pair counts can't be folded into a state, use 'counter' or 'sparse'")
+        min_support = state['min_support']
+        frequent = state['raw_freq'][state['raw_freq'] / state['raw_orders'] * 100 >= min_support].index
+
+        raw_freq = add_counts(state['raw_freq'], freq(items))
+        raw_orders = state['raw_orders'] + items.index.nunique()
+        now_frequent = raw_freq[raw_freq / raw_orders * 100 >= min_support].index
+        # Items never seen before have no previous orders to count, so they can join frequent items exactly,
+        # other items are kept as they were when the counts were built from scratch
+        frequent = frequent.union(now_frequent.difference(state['raw_freq'].index))
+        if not now_frequent.sort_values().equals(frequent.sort_values()):
+            logger.warning("Items above min support changed with new orders, run generate_rules to rebuild the state "
+                           "for exact counts")
+
+        # Filter out items below min support and orders that have less than 2 items
+        items = items[items.isin(frequent)]
+        order_size = freq(items.index)
+        items = items[items.index.isin(order_size[order_size >= 2].index)]
+        logger.info("New orders with at least 2 frequent items: " + str(items.index.nunique()))
+
+        n_orders = state['n_orders'] + items.index.nunique()
+        stats = add_counts(state['stats']['freq'], freq(items)).to_frame('freq')
+        stats['support'] = stats['freq'] / n_orders * 100
+        item_pairs = state['item_pairs']
+        if len(items) > 0:
+            new_pairs = count_pairs(items, engine, workers)
+            if engine == 'sparse':
+                # Sparse counts of new orders put the item seen first in them as item A, a pair that is already
+                # counted has to keep its stored orientation to be added up, same as shards in parallel_pairs
+                new_pairs = orient_pairs(new_pairs, item_pairs)
+            item_pairs = add_counts(item_pairs, new_pairs)
+
+        state = {'generation': state['generation'] + 1, 'min_support': min_support,
+                 'raw_freq': raw_freq, 'raw_orders': raw_orders,
+                 'stats': stats, 'n_orders': n_orders, 'item_pairs': item_pairs}
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return state
+
+
+def recommendation_table(rules, products, top_k=5):
+    """ Pick top k recommendations for each item from association rules, looking up partners of an item
+        from rules in both directions
+       Inputs:
+           rules: association rules table
+           products: products dataframe
+           top_k: number of recommendations for each item
+       Returns:
+           rec_table: table of recommendations for each item id, with 'NA' if an item has less than top k recommendations
+    """
+    try:
+        # top k partner ids of each item in one pass over the rule index
+        with stage('top_k') as step:
+            top = RuleIndex.from_rules(rules).top_k(top_k)
+            step['rows'] = len(top)
+        # list items with strongest rules first, the first partner of an item has its highest lift
+        first = top[top['rank'] == 0]
+        item_ids = first.item_id.values[np.lexsort((first.item_id.values, -first.lift.values))]
+        rec_ids = np.full((len(item_ids), top_k), -1, dtype=np.int32)
+        rec_ids[pd.Index(item_ids).get_indexer(top.item_id.values), top['rank'].values] = top.partner_id.values
+
+        # map item ids to names once for the whole table
+        with stage('map_names') as step:
+            names = products.set_index('product_id')['product_name']
+            rec_names = names.reindex(rec_ids.ravel()).fillna('NA').values.reshape(rec_ids.shape)
+            rec_table = pd.DataFrame(rec_names, columns=['recommendation' + str(i + 1) for i in range(top_k)])
+            rec_table.insert(0, 'item_name', names.reindex(item_ids).values)
+            rec_table.insert(0, 'item_id', item_ids)
+            rec_table = rec_table.dropna(subset=['item_name'])
+            step['rows'] = len(rec_table)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rec_table
+
+
+def rules_table(rules, products, top_k=None):
+    """ List partners of each item with their rank, lift and confidence, looking up partners of an item
+        from rules in both directions
+       Inputs:
+           rules: association rules table
+           products: products dataframe
+           top_k: number of partners for each item, all partners if None
+       Returns:
+           rank_table: table with item_id, item_name, rank (starting from 1), partner_id, partner_name, lift and
+           confidence of recommending partner given item
+    """
+    try:
+        rank_table = RuleIndex.from_rules(rules).top_k(top_k)
+        rank_table['rank'] += 1
+        # lift = support_AB / (support_A * support_B), so confidence of item -> partner is lift * support of partner
+        support = pd.concat([pd.Series(rules['support_A'].values, index=rules['itemA'].values),
+                             pd.Series(rules['support_B'].values, index=rules['itemB'].values)])
+        support = support[~support.index.duplicated()]
+        rank_table['confidence'] = rank_table['lift'].values * support.reindex(rank_table['partner_id'].values).values
+        names = products.set_index('product_id')['product_name']
+        rank_table.insert(1, 'item_name', names.reindex(rank_table['item_id'].values).values)
+        rank_table.insert(4, 'partner_name', names.reindex(rank_table['partner_id'].values).values)
+        rank_table = rank_table.dropna(subset=['item_name', 'partner_name'])
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rank_table
+
+
 def run_analysis(args):
-    """ Create top 5 recommendations table with generated association rules
+    """ Create top k recommendations table with generated association rules
        Inputs:
            orders: orders dataframe
            products: products dataframe
@@ -199,44 +784,106 @@ def run_analysis(args):
     """
 
     try:
-        orders = pd.read_csv(args.input1)
-        products = pd.read_csv(args.input2)
-        logger.info("Datasets read in successfully")
+        with stage('read_products') as step:
+            products = read_products(args.input2, args.cache_dir)
+            step['rows'] = len(products)
+        if args.stream:
+            # generate association rules reading prior orders chunk by chunk
+            with stage('stream_item_freq') as step:
+                raw_freq, raw_orders = stream_item_freq(args.input1, args.memory_budget, cache_dir=args.cache_dir)
+                step['rows'] = len(raw_freq)
+            with stage('stream_itemsets') as step:
+                stats, item_pairs, n_orders = stream_itemsets(args.input1, args.min_support, args.memory_budget,
+                                                              args.engine, workers=args.workers,
+                                                              raw_counts=(raw_freq, raw_orders), cache_dir=args.cache_dir)
+                step['rows'] = len(item_pairs)
+        else:
+            with stage('read_orders') as step:
+                orders = read_orders(args.input1, cache_dir=args.cache_dir)
+                step['rows'] = len(orders)
+            logger.info("Datasets read in successfully")
+
+            # Convert from DataFrame to a Series, with order_id as index and item_id as value
+            orders = orders.set_index('order_id')['product_id'].rename('item_id')
+            raw_freq, raw_orders = freq(orders), orders.index.nunique()
+            # generate association rules
+            with stage('count_itemsets') as step:
+                stats, item_pairs, n_orders = count_itemsets(orders, args.min_support, args.engine, args.workers)
+                step['rows'] = len(item_pairs)
+        with stage('build_rules') as step:
+            rules = build_rules(stats, item_pairs, n_orders, args.min_support)
+            step['rows'] = len(rules)
+        if args.state and args.engine == 'approx':
+            logger.warning("State is not saved for approximate pair counts, use 'counter' or 'sparse' engine")
+        elif args.state:
+            # keep counts so that new orders can be folded in with update_rules
+            with stage('save_state'):
+                save_state(args.state, {'generation': 0, 'min_support': args.min_support, 'raw_freq': raw_freq,
+                                        'raw_orders': raw_orders, 'stats': stats, 'n_orders': n_orders,
+                                        'item_pairs': item_pairs})
+        with stage('recommendation_table') as step:
+            rec_table = recommendation_table(rules, products, args.top_k)
+            step['rows'] = len(rec_table)
+        with stage('write_table') as step:
+            rec_table.to_csv(args.output)
+            step['rows'] = len(rec_table)
+        if args.rules_output is not None:
+            with stage('write_rules') as step:
+                rank_table = rules_table(rules, products)
+                rank_table.to_csv(args.rules_output, index=False)
+                step['rows'] = len(rank_table)
+        logger.info("Recommendation table generated successfully based on rules given")
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rec_table
+
+
+def run_update(args):
+    """ Update recommendations table with newly arrived orders, without reading previous orders again
+       Inputs:
+           state: state file saved by generate_rules or a previous update
+           orders: new orders dataframe
+           products: products dataframe
+       Returns:
+           rec_table: table of recommendations for each item
+    """
+
+    try:
+        with stage('load_state'):
+            state = load_state(args.state)
+        with stage('read_orders') as step:
+            orders = read_orders(args.input1)
+            step['rows'] = len(orders)
+        with stage('read_products') as step:
+            products = read_products(args.input2, args.cache_dir)
+            step['rows'] = len(products)
+        logger.info("New orders read in successfully: " + str(len(orders)) + " rows")
 
         # Convert from DataFrame to a Series, with order_id as index and item_id as value
         orders = orders.set_index('order_id')['product_id'].rename('item_id')
-        # generate association rules
-        rules = association_rules(orders, 0.01)
-        products = products.rename(columns={'product_id': 'item_id', 'product_name': 'item_name'})
-        rules_final = merge_item_name(rules, products).sort_values('lift', ascending=False)
-        # pick top 5 recommendations for each unique item
-        unique_B = rules_final.item_B.unique()
-        column_names = ["item_name", "recommendation1", "recommendation2", "recommendation3", "recommendation4",
-                        "recommendation5"]
-        ls = []
-        item_list = set()
-        for i in range(len(unique_B)):
-            temp = unique_B[i].replace(" ", "").lower()
-            if temp in item_list:
-                continue
-            item_list.add(temp)
-            # find all pairs related to current item
-            pairs = rules_final[rules_final.item_B == unique_B[i]].sort_values('lift', ascending=False)
-            # if there's less than pairs, choose number of pairs as top n recommendations, otherwise choose top 5
-            top_n = 5 if len(pairs) >= 5 else len(pairs)
-            pairs = pairs.head(top_n)
-            a = pairs['item_A'].to_list()
-            a.insert(0, unique_B[i])
-            # construct a list: item, rec1, rec2, rec3, rec4, rec5
-            row = a + ['NA'] * (6 - top_n - 1)
-            # list of list
-            ls.append(row)
-        rec_table = pd.DataFrame(ls, columns=column_names)
-        # remove bad values with duplicates
-        rec_table = rec_table[rec_table.item_name != "Macaroni and Cheese"]
-        rec_table.to_csv(args.output)
-        logger.info("Recommendation table generated successfully based on rules given")
+        with stage('update_itemsets') as step:
+            state = update_itemsets(state, orders, args.engine, args.workers)
+            step['rows'] = len(state['item_pairs'])
+        with stage('build_rules') as step:
+            rules = build_rules(state['stats'], state['item_pairs'], state['n_orders'], state['min_support'])
+            step['rows'] = len(rules)
+        with stage('save_state'):
+            save_state(args.state, state)
+
+        with stage('recommendation_table') as step:
+            rec_table = recommendation_table(rules, products, args.top_k)
+            step['rows'] = len(rec_table)
+        with stage('write_table') as step:
+            rec_table.to_csv(args.output)
+            step['rows'] = len(rec_table)
+        if args.rules_output is not None:
+            with stage('write_rules') as step:
+                rank_table = rules_table(rules, products)
+                rank_table.to_csv(args.rules_output, index=False)
+                step['rows'] = len(rank_table)
+        logger.info("Recommendation table updated successfully with new orders")
     except Exception as e:
         logger.error(e)
         raise Exception('Invalid input')
-    return rec_table
\ No newline at end of file
+    return rec_table
@@ -0,0 +1,131 @@
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Default size of the sketch: 4 rows of 2^20 counters take 32 MB no matter how many distinct pairs there are
+SKETCH_WIDTH = 2 ** 20
+SKETCH_DEPTH = 4
+# Maximum number of candidate frequent pairs kept next to the sketch
+MAX_CANDIDATES = 2 ** 20
+# Rows of orders whose pairs are counted exactly at once before being added to the sketch
+BATCH_ROWS = 100000
+
+
+class PairSketch:
+    """
+    Approximate item pair counts in fixed memory, with a Count-Min sketch holding counts of all pairs
+    and a bounded set of candidate pairs whose estimated count reached min support
+
+    Estimates never undercount, and overcount by at most error_bound() with probability 1 - exp(-depth),
+    a pair is added to candidates when its estimate reaches min support of orders seen so far,
+    so no frequent pair is missed unless candidates overflow max_candidates
+    """
+
+    def __init__(self, min_support=0, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, max_candidates=MAX_CANDIDATES):
+        if width < 2 or width & (width - 1) or depth < 1 or max_candidates < 1:
+            logger.warning('Sketch width has to be a power of 2, depth and max candidates at least 1')
+            raise Exception('Invalid input')
+        self.min_support = min_support
+        self.width = width
+        self.depth = depth
+        self.max_candidates = max_candidates
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        # Multiply-shift hashing, one odd multiplier per row, fixed seed so runs are reproducible
+        self.multipliers = np.random.RandomState(0).randint(1, 2 ** 62, size=depth).astype(np.uint64) * 2 + 1
+        self.shift = np.uint64(64 - int(np.log2(width)))
+        self.candidates = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self.n_orders = 0
+        self.evicted = 0
+
+    @staticmethod
+    def pair_keys(item_a, item_b):
+        """ Pack item pairs into one int64 key, same key for (A, B) and (B, A)
+        Inputs:
+            item_a, item_b: arrays of item ids
+        Returns:
+            array of pair keys
+        """
+        low = np.minimum(item_a, item_b).astype(np.int64)
+        high = np.maximum(item_a, item_b).astype(np.int64)
+        return (low << 32) | high
+
+    def buckets(self, keys):
+        """ Counter of each key in each row of the sketch
+        Inputs:
+            keys: array of pair keys
+        Returns:
+            depth x len(keys) array of counter positions
+        """
+        with np.errstate(over='ignore'):
+            return ((keys.astype(np.uint64)[None, :] * self.multipliers[:, None]) >> self.shift).astype(np.int64)
+
+    def estimate(self, keys):
+        """ Estimated count of pairs
+        Inputs:
+            keys: array of pair keys
+        Returns:
+            array of estimated counts, never below the true counts
+        """
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        pos = self.buckets(keys)
+        return np.min(self.table[np.arange(self.depth)[:, None], pos], axis=0)
+
+    def update(self, keys, counts, n_orders):
+        """ Add pair counts of a batch of orders
+        Inputs:
+            keys: array of distinct pair keys in the batch
+            counts: number of orders of the batch containing each pair
+            n_orders: number of orders in the batch
+        Returns:
+            None
+        """
+        self.n_orders += n_orders
+        self.total += int(counts.sum())
+        if len(keys) == 0:
+            return
+        pos = self.buckets(keys)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(pos[row], weights=counts, minlength=self.width).astype(np.int64)
+
+        # A frequent pair reaches min support of orders seen so far at the latest in its last batch
+        threshold = self.min_support * self.n_orders / 100
+        new = keys[self.estimate(keys) >= threshold]
+        self.candidates = np.union1d(self.candidates, new)
+        if len(self.candidates) > self.max_candidates:
+            # Keep candidates with highest estimates
+            keep = np.argpartition(-self.estimate(self.candidates), self.max_candidates - 1)[:self.max_candidates]
+            self.evicted += len(self.candidates) - self.max_candidates
+            self.candidates = np.sort(self.candidates[keep])
+
+    def error_bound(self):
+        """ Maximum overcount of an estimate, holding with probability 1 - exp(-depth)
+        Inputs:
+            None
+        Returns:
+            error bound in number of orders
+        """
+        return np.e / self.width * self.total
+
+    def pairs(self):
+        """ Candidate pairs with estimated count at or above min support of all orders seen
+        Inputs:
+            None
+        Returns:
+            item_pairs: dataframe of estimated pair frequency 'freq_AB' and its error bound 'freq_AB_error'
+            indexed by item pair, with the smaller item id as item A
+        """
+        if self.evicted > 0:
+            logger.warning(str(self.evicted) + " candidate pairs were evicted, frequent pairs may be missing, "
+                           "raise max_candidates")
+        est = self.estimate(self.candidates)
+        keep = est >= self.min_support * self.n_orders / 100
+        keys = self.candidates[keep]
+        index = pd.MultiIndex.from_arrays([keys >> 32, keys & 0xFFFFFFFF])
+        item_pairs = pd.DataFrame({'freq_AB': est[keep], 'freq_AB_error': self.error_bound()}, index=index)
+        logger.info("Approximate pair counts from " + str(self.n_orders) + " orders, error bound: "
+                    + str(round(self.error_bound(), 2)) + " orders")
+        return item_pairs
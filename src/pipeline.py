@@ -0,0 +1,143 @@
+import os
+import logging
+import pandas as pd
+from src.stream_orders import read_orders, read_products
+from src.market_basket_analysis import association_rules, split_itemsets, build_rules, recommendation_table, rules_table
+from src.scores import score_rules, write_score
+from src.data_cache import load_table
+from src.instrumentation import stage
+import src.recommender_db as db
+import src.stage_cache as scache
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['mine', 'score', 'store']
+
+
+def run_pipeline(args):
+    """ Mine recommendations on all data, score rules of training data on test data and store recommendations into
+        database in one process, datasets are read once, item pairs are counted once for mining and scoring and
+        tables are passed between stages without csv files
+    Inputs:
+        args that contain paths of prior orders, orders and products data, output paths, stages to skip,
+        rule mining options, database options and stage cache folder
+    Returns:
+        rec_table: table of recommendations for each item, None if mining is skipped
+    """
+    try:
+        skip = set(args.skip or [])
+        rec_table, rank_table = None, None
+        # Stages whose inputs, parameters and code are unchanged since a cached run are skipped
+        mine_key, score_key, mine_cached, score_cached = None, None, None, None
+        if args.stage_cache is not None:
+            if 'mine' not in skip:
+                mine_key = scache.stage_key('pipeline/mine', [args.input1, args.input3],
+                                            {'min_support': args.min_support, 'engine': args.engine,
+                                             'top_k': args.top_k, 'store_rules': args.store_rules})
+                mine_cached = scache.lookup(args.stage_cache, mine_key)
+            if 'score' not in skip:
+                score_key = scache.stage_key('pipeline/score', [args.input1, args.input2, args.input3],
+                                             {'min_support': args.min_support, 'engine': args.engine})
+                score_cached = scache.lookup(args.stage_cache, score_key)
+
+        if ('mine' not in skip and mine_cached is None) or ('score' not in skip and score_cached is None):
+            with stage('read_products') as step:
+                products = read_products(args.input3, args.cache_dir)
+                step['rows'] = len(products)
+            with stage('read_orders') as step:
+                prior = read_orders(args.input1, cache_dir=args.cache_dir)
+                step['rows'] = len(prior)
+            logger.info("Datasets read in successfully")
+            # Convert from DataFrame to a Series, with order_id as index and item_id as value
+            items = prior.set_index('order_id')['product_id'].rename('item_id')
+            # Same 80:20 train/test split as get_scores
+            cut = int(len(prior) * (80 / 100))
+
+        # Pairs are counted once for mining on all orders and scoring on training orders, if both stages run,
+        # approximate counts of the two can't be shared so they're mined separately
+        counts, train_counts = None, None
+        if 'mine' not in skip and mine_cached is None and 'score' not in skip and score_cached is None \
+                and args.engine != 'approx':
+            with stage('count_itemsets') as step:
+                counts, train_counts = split_itemsets(items, cut, args.min_support, args.engine, args.workers)
+                step['rows'] = len(counts[1])
+
+        if 'mine' not in skip:
+            with stage('mine'):
+                if mine_cached is not None:
+                    logger.info("Skipped mining, tables restored from stage cache entry " + mine_key)
+                    rec_table = pd.read_pickle(mine_cached['rec_table'])
+                    rank_table = pd.read_pickle(mine_cached['rank_table']) if 'rank_table' in mine_cached else None
+                else:
+                    with stage('association_rules') as step:
+                        if counts is not None:
+                            rules = build_rules(*counts, args.min_support)
+                        else:
+                            rules = association_rules(items, args.min_support, args.engine, args.workers)
+                        step['rows'] = len(rules)
+                    with stage('recommendation_table') as step:
+                        rec_table = recommendation_table(rules, products, args.top_k)
+                        step['rows'] = len(rec_table)
+                    if args.store_rules:
+                        with stage('rules_table') as step:
+                            rank_table = rules_table(rules, products)
+                            step['rows'] = len(rank_table)
+                    if mine_key is not None:
+                        artifacts = {'rec_table': rec_table}
+                        if rank_table is not None:
+                            artifacts['rank_table'] = rank_table
+                        scache.save(args.stage_cache, mine_key, artifacts, 'pipeline/mine')
+                        scache.evict(args.stage_cache, args.cache_budget, keep=mine_key)
+                # Tables are only written out if asked for, the store stage takes them from memory
+                if args.output is not None:
+                    rec_table.to_csv(args.output)
+                    logger.info("Recommendation table saved to file: " + args.output)
+                if args.rules_output is not None and rank_table is not None:
+                    rank_table.to_csv(args.rules_output, index=False)
+                    logger.info("Ranked rules saved to file: " + args.rules_output)
+
+        if 'score' not in skip:
+            with stage('score'):
+                if score_cached is not None:
+                    scores = pd.read_pickle(score_cached['scores'])
+                    logger.info("Skipped scoring, test score " + str(scores) + " restored from stage cache entry "
+                                + score_key)
+                else:
+                    with stage('read_orders_meta') as step:
+                        if args.cache_dir is not None:
+                            orders = load_table(args.input2, args.cache_dir)
+                        else:
+                            orders = pd.read_csv(args.input2)
+                        step['rows'] = len(orders)
+                    with stage('association_rules') as step:
+                        if train_counts is not None:
+                            train_rules = build_rules(*train_counts, args.min_support)
+                        else:
+                            train_rules = association_rules(items[:cut], args.min_support, args.engine,
+                                                            args.workers)
+                        step['rows'] = len(train_rules)
+                    scores = score_rules(train_rules, prior[cut:], orders, products, args.score_workers)
+                    if score_key is not None:
+                        scache.save(args.stage_cache, score_key, {'scores': scores}, 'pipeline/score')
+                        scache.evict(args.stage_cache, args.cache_budget, keep=score_key)
+                if args.score_output is not None:
+                    write_score(scores, args.score_output)
+
+        if 'store' not in skip:
+            with stage('store'):
+                if rec_table is None:
+                    # Mining was skipped, store tables written by an earlier run
+                    if args.output is None or not os.path.exists(args.output):
+                        raise ValueError('Mining is skipped, --output has to be a recommendation table to store')
+                    recs, ranks, source = args.output, args.rules_output if args.store_rules else None, args.output
+                else:
+                    recs, ranks, source = rec_table, rank_table, 'pipeline'
+                engine_string = db.create_engine_string(os.environ.get("SQLALCHEMY_DATABASE_URI"), args.rds)
+                db.create_db(engine_string)
+                db.swap_in(engine_string, recs, args.cache_dir if rec_table is None else None, args.batch_size,
+                           ranks, source)
+        logger.info("Pipeline finished, skipped stages: " + (', '.join(sorted(skip)) if skip else 'none'))
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return rec_table
@@ -0,0 +1,92 @@
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class RuleIndex:
+    """
+    Symmetric index of association rules, built once from a rules table
+
+    Each item id keeps all of its partners, no matter if the item was item A or item B of the rule,
+    partners of items[i] are partners[offsets[i]:offsets[i + 1]] sorted by lift in descending order
+    """
+
+    def __init__(self, items, offsets, partners, lifts):
+        self.items = items
+        self.offsets = offsets
+        self.partners = partners
+        self.lifts = lifts
+
+    @classmethod
+    def from_rules(cls, rules):
+        """ Build the index from a rules table
+        Inputs:
+            rules: association rules table with 'itemA', 'itemB' and 'lift'
+        Returns:
+            RuleIndex of all items in rules
+        """
+        try:
+            item_a = rules['itemA'].values.astype(np.int32)
+            item_b = rules['itemB'].values.astype(np.int32)
+            lift = rules['lift'].values.astype(np.float64)
+            # Add each rule in both directions
+            item = np.concatenate([item_a, item_b])
+            partner = np.concatenate([item_b, item_a])
+            lift = np.concatenate([lift, lift])
+            # build_rules merges both orders of a pair before lift is computed, so a pair only shows up twice in
+            # a table built some other way, its highest lift is kept then
+            pairs = pd.DataFrame({'item': item, 'partner': partner, 'lift': lift}).groupby(['item', 'partner'],
+                                                                                          sort=False)['lift'].max()
+            item = pairs.index.get_level_values(0).values.astype(np.int32)
+            partner = pairs.index.get_level_values(1).values.astype(np.int32)
+            lift = pairs.values
+            # Sort by item, then lift in descending order, then partner id so that ties are always in same order
+            order = np.lexsort((partner, -lift, item))
+            item, partner, lift = item[order], partner[order], lift[order]
+            items, starts = np.unique(item, return_index=True)
+            offsets = np.append(starts, len(item)).astype(np.int64)
+        except Exception as e:
+            logger.warning('Could not build rule index due to invalid input')
+            raise Exception('Invalid input')
+        logger.info("Rule index built with " + str(len(items)) + " items and " + str(len(partner)) + " partners")
+        return cls(items, offsets, partner, lift)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item_id):
+        pos = np.searchsorted(self.items, item_id)
+        return pos < len(self.items) and self.items[pos] == item_id
+
+    def lookup(self, item_id, top_k=None):
+        """ Find partners of an item
+        Inputs:
+            item_id: item id
+            top_k: number of partners to return, all partners if None
+        Returns:
+            partners: partner ids sorted by lift in descending order, empty if item is not in index
+            lifts: lift of each partner
+        """
+        pos = np.searchsorted(self.items, item_id)
+        if pos >= len(self.items) or self.items[pos] != item_id:
+            return self.partners[:0], self.lifts[:0]
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        if top_k is not None:
+            end = min(end, start + top_k)
+        return self.partners[start:end], self.lifts[start:end]
+
+    def top_k(self, top_k=None):
+        """ List top k partners of every item
+        Inputs:
+            top_k: number of partners for each item, all partners if None
+        Returns:
+            dataframe with item_id, rank (starting from 0), partner_id and lift
+        """
+        counts = np.diff(self.offsets)
+        item = np.repeat(self.items, counts)
+        rank = np.arange(len(self.partners)) - np.repeat(self.offsets[:-1], counts)
+        keep = rank < top_k if top_k is not None else np.ones(len(rank), dtype=bool)
+        return pd.DataFrame({'item_id': item[keep], 'rank': rank[keep], 'partner_id': self.partners[keep],
+                             'lift': self.lifts[keep]})
@@ -0,0 +1,76 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Version of the state file layout, bump it whenever arrays saved in the file change
+STATE_VERSION = 1
+
+
+def save_state(path, state):
+    """ Save item counts, pair counts and order totals of a rules run as a versioned state file
+    Inputs:
+        path: path to state file (.npz)
+        state: dictionary with
+            generation: number of updates folded into the state, 0 after a full run
+            min_support: minimum support the counts were filtered with
+            raw_freq, raw_orders: item frequencies and number of orders before filtering
+            stats, n_orders: item frequency and support, number of orders after filtering
+            item_pairs: frequency of item pairs after filtering
+    Returns:
+        None
+    """
+    try:
+        pairs = state['item_pairs']
+        arrays = {'version': np.int64(STATE_VERSION),
+                  'generation': np.int64(state['generation']),
+                  'min_support': np.float64(state['min_support']),
+                  'raw_item': state['raw_freq'].index.values.astype(np.int64),
+                  'raw_freq': state['raw_freq'].values.astype(np.int64),
+                  'raw_orders': np.int64(state['raw_orders']),
+                  'item': state['stats'].index.values.astype(np.int64),
+                  'item_freq': state['stats']['freq'].values.astype(np.int64),
+                  'n_orders': np.int64(state['n_orders']),
+                  'pair_A': pairs.index.get_level_values(0).values.astype(np.int64),
+                  'pair_B': pairs.index.get_level_values(1).values.astype(np.int64),
+                  'pair_freq': pairs['freq_AB'].values.astype(np.int64)}
+        # Write to a temporary file first so a failed run never leaves a half written state behind
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        logger.info("State (generation " + str(state['generation']) + ") saved to file: " + path)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+
+
+def load_state(path):
+    """ Load state file saved by save_state
+    Inputs:
+        path: path to state file (.npz)
+    Returns:
+        state: dictionary with same entries as given to save_state
+    """
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            if int(f['version']) != STATE_VERSION:
+                raise ValueError('State file version ' + str(int(f['version'])) + ' is not supported, expected '
+                                 + str(STATE_VERSION) + ', rerun generate_rules to rebuild it')
+            n_orders = int(f['n_orders'])
+            stats = pd.DataFrame({'freq': f['item_freq']}, index=f['item'])
+            stats['support'] = stats['freq'] / n_orders * 100
+            state = {'generation': int(f['generation']),
+                     'min_support': float(f['min_support']),
+                     'raw_freq': pd.Series(f['raw_freq'], index=f['raw_item'], name='freq'),
+                     'raw_orders': int(f['raw_orders']),
+                     'stats': stats,
+                     'n_orders': n_orders,
+                     'item_pairs': pd.DataFrame({'freq_AB': f['pair_freq']},
+                                                index=pd.MultiIndex.from_arrays([f['pair_A'], f['pair_B']]))}
+        logger.info("State (generation " + str(state['generation']) + ") loaded from file: " + path)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return state
@@ -1,10 +1,38 @@
 import pandas as pd
 import logging
 import numpy as np
-from src.market_basket_analysis import merge_item_name, association_rules
+import multiprocessing
+from src.market_basket_analysis import association_rules, stream_association_rules
+from src.stream_orders import read_orders, read_products, count_rows
+from src.rule_index import RuleIndex
+from src.data_cache import load_table
+from src.instrumentation import stage
 
 logger = logging.getLogger(__name__)
 
+# Recommendations shared read-only with scoring worker processes, set before the pool is started
+_lookup = None
+
+def index_rules(rules, products):
+    """ List rules of a symmetric rule index with item names, so that every item is looked up with all its partners
+       Input:
+           rules: association rules generated from training data
+           products: products dataframe
+        Returns:
+           train_rules_final: rules table with item looked up as 'item_B', its partner as 'item_A' and 'lift'
+    """
+    try:
+        index_table = RuleIndex.from_rules(rules).top_k()
+        names = products.set_index('product_id')['product_name']
+        train_rules_final = pd.DataFrame({'item_A': names.reindex(index_table.partner_id.values).values,
+                                          'item_B': names.reindex(index_table.item_id.values).values,
+                                          'lift': index_table.lift.values}).dropna()
+    except Exception as e:
+        logger.warning('Could not list rules of rule index due to invalid input')
+        raise Exception('Invalid input')
+    return train_rules_final
+
+
 def get_recommendation(train_rules_final, name):
     """ Generate top 5 recommendations for an item
        Input:
@@ -35,7 +63,28 @@ def get_recommendation(train_rules_final, name):
     return rec_table, top_n
 
 
-def get_scores(test_order, train_rules_final):
+def recommendation_lookup(train_rules_final):
+    """ Precompute top 5 recommendations of every item once
+       Input:
+           train_rules_final: association rules generated from training data
+        Returns:
+           lookup: dictionary of item name to list of item, rec1, rec2, rec3, rec4, rec5, same as the row given by
+           get_recommendation
+    """
+    try:
+        lookup = {}
+        # Rows of a group keep their order in the rules table, so sorting them gives same top 5 as get_recommendation
+        for name, pairs in train_rules_final.groupby('item_B', sort=False):
+            pairs = pairs.sort_values('lift', ascending=False)
+            top_n = 5 if len(pairs) >= 5 else len(pairs)
+            lookup[name] = [name] + pairs['item_A'].head(top_n).to_list() + ['NA'] * (5 - top_n)
+    except Exception as e:
+        logger.warning('Could not precompute recommendations due to invalid input')
+        raise Exception('Invalid input')
+    return lookup
+
+
+def get_scores(test_order, train_rules_final, lookup=None):
     """ Calculate the test score of recommendations generated for test data
        Give 5 recommendations for each item in order, and compare if there's a match with the following 4 items, so on and so forth.
        If there's a match, add 1 to score, then divided by total number of recommendations made to current order,
@@ -43,44 +92,170 @@ def get_scores(test_order, train_rules_final):
        Input:
            test_order: test data
            train_rules_final: association rules generated from training data
+           lookup: recommendations from recommendation_lookup, precomputed from train_rules_final if None
         Returns:
            scores: average score by each order
     """
     try:
-        scores = []
-        for item in test_order.groupby('order_id')['item_name']:
-            # get the current order and change it to list structure
-            curr_order = item[1].tolist()
-            # initialize the total score
-            total_score = 0
-            # count how many items is contained in the database
-            num_item = 0
-            for i in range(len(curr_order)):
-                if curr_order[i] in train_rules_final.item_B.tolist():
-                    num_item += 1
-                    # get the recommendation list of the current item
-                    recommendations, _ = get_recommendation(train_rules_final, curr_order[i])
-                    recommendations = recommendations.values.tolist()[0]
-                    # check if the recommendation is contained in the remaining list
-                    following_items = curr_order[i:]
-                    for item in recommendations:
-                        if item in following_items:
-                            total_score += 1
-
-            if not num_item == 0:
-                count = 0
-                if num_item > 5:
-                    count += (num_item - 5) * 5
-                    num_item = 5
-                for n in range(num_item + 1):
-                    count += n
-                scores.append(total_score / count)
+        if lookup is None:
+            with stage('recommendation_lookup') as step:
+                lookup = recommendation_lookup(train_rules_final)
+                step['rows'] = len(lookup)
+        order_ids = test_order['order_id'].values
+        # position of each item in its order
+        pos = test_order.groupby('order_id').cumcount().values
+        order_codes = np.unique(order_ids, return_inverse=True)[1]
+        n_orders = order_codes.max() + 1 if len(order_codes) > 0 else 0
+
+        # Map item names in test data to ids, recommendations not bought in any test order can't match
+        names = pd.Index(test_order['item_name'].dropna().unique())
+        name_codes = names.get_indexer(test_order['item_name'].values)
+        rec_items = pd.Index(list(lookup))
+        rec_ids = np.array([names.get_indexer(lookup[item]) for item in rec_items], dtype=np.int64).reshape(-1, 6)
+        item_codes = rec_items.get_indexer(test_order['item_name'].values)
+        in_lookup = item_codes >= 0
+
+        # Last position of each item in each order, an item matches if it's there at or after current position
+        keys = order_codes.astype(np.int64) * max(len(names), 1) + name_codes
+        bought = name_codes >= 0
+        last = pd.Series(pos[bought]).groupby(keys[bought]).max()
+        last_keys, last_pos = last.index.values, last.values
+
+        # One row for each recommendation made to an item in lookup
+        rec_order = np.repeat(order_codes[in_lookup], 6)
+        rec_pos = np.repeat(pos[in_lookup], 6)
+        rec_name = rec_ids[item_codes[in_lookup]].ravel()
+        rec_keys = rec_order.astype(np.int64) * max(len(names), 1) + rec_name
+        at = np.minimum(np.searchsorted(last_keys, rec_keys), max(len(last_keys) - 1, 0))
+        hit = (rec_name >= 0) & (last_keys[at] == rec_keys) & (last_pos[at] >= rec_pos) if len(last_keys) > 0 \
+            else np.zeros(len(rec_keys), dtype=bool)
+
+        total_score = np.bincount(rec_order, weights=hit, minlength=n_orders)
+        num_item = np.bincount(order_codes[in_lookup], minlength=n_orders)
+        # Number of recommendations that can match: first 5 items give 0 + 1 + ... + 5, 5 more for every item after that
+        top = np.minimum(num_item, 5)
+        count = np.maximum(num_item - 5, 0) * 5 + top * (top + 1) // 2
+        scored = num_item > 0
+        scores = (total_score[scored] / count[scored]).tolist()
     except Exception as e:
         logger.warning('Could not calculate scores for test dataset due to invalid input')
         raise Exception('Invalid input')
     return scores
 
 
+def _set_lookup(lookup):
+    """ Keep recommendations in a worker process that couldn't inherit them by fork
+    Inputs:
+        lookup: recommendations from recommendation_lookup
+    Returns:
+        None
+    """
+    global _lookup
+    _lookup = lookup
+
+
+def _score_shard(shard):
+    """ Score one shard of test orders in a worker process, with recommendations shared by the parent process
+    Inputs:
+        shard: test data of complete orders
+    Returns:
+        scores: average score by each order of the shard
+    """
+    return get_scores(shard, None, _lookup)
+
+
+def parallel_scores(test_order, train_rules_final, workers):
+    """ Calculate the test score of recommendations in worker processes, each one scoring a shard of test orders
+       Input:
+           test_order: test data
+           train_rules_final: association rules generated from training data
+           workers: number of worker processes
+        Returns:
+           scores: average score by each order, same as get_scores
+    """
+    try:
+        lookup = recommendation_lookup(train_rules_final)
+        # Sort by order id keeping items of an order in their order, so that shards hold complete orders
+        # and scores of shards joined in turn are in same order as scored in a single process
+        test_order = test_order.sort_values('order_id', kind='mergesort')
+        order_ids = test_order['order_id'].values
+        order_starts = np.flatnonzero(np.r_[True, order_ids[1:] != order_ids[:-1]])
+        targets = np.arange(1, workers) * len(test_order) // workers
+        bounds = np.unique(np.r_[0, order_starts[np.minimum(np.searchsorted(order_starts, targets),
+                                                            len(order_starts) - 1)], len(test_order)])
+        shards = [test_order.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        logger.info("Scoring test orders in " + str(len(shards)) + " shards")
+
+        global _lookup
+        _lookup = lookup
+        try:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                # Forked workers share recommendations with the parent process instead of getting a pickled copy
+                pool = multiprocessing.get_context('fork').Pool(workers)
+            else:
+                pool = multiprocessing.Pool(workers, initializer=_set_lookup, initargs=(lookup,))
+            with pool:
+                partial_scores = pool.map(_score_shard, shards)
+        finally:
+            # Don't keep recommendations alive in the parent process, also when scoring failed
+            _lookup = None
+        scores = [score for shard_scores in partial_scores for score in shard_scores]
+    except Exception as e:
+        logger.warning('Could not calculate scores in parallel due to invalid input')
+        raise Exception('Invalid input')
+    return scores
+
+
+def score_rules(rules, test_data, orders, products, score_workers=1):
+    """ Score rules mined from training orders on test orders
+      Input:
+          rules: association rules of training data
+          test_data: test prior orders dataframe
+          orders: orders dataframe
+          products: products dataframe
+          score_workers: number of worker processes scoring test orders
+       Returns:
+          scores: average score of test orders
+       """
+    # Look up partners of an item from rules in both directions
+    with stage('index_rules') as step:
+        train_rules_final = index_rules(rules, products).sort_values('lift', ascending=False)
+        step['rows'] = len(train_rules_final)
+    products = products.rename(columns={'product_name': 'item_name'})
+    logger.info("Training rules generated")
+
+    # Prior orders with user_id, product_id, product_name
+    with stage('prepare_test') as step:
+        test_order = pd.merge(test_data, products, how='left', on='product_id')
+        test_order = pd.merge(test_order, orders, how='left', on='order_id')
+        step['rows'] = len(test_order)
+
+    logger.info("Test data ready and calculating scores now ...")
+
+    with stage('get_scores') as step:
+        if score_workers > 1:
+            scores = np.nanmean(parallel_scores(test_order, train_rules_final, score_workers))
+        else:
+            scores = np.nanmean(get_scores(test_order, train_rules_final))
+        step['rows'] = len(test_order)
+    logger.info("Score from test data is: "+ str(scores))
+    return scores
+
+
+def write_score(scores, path):
+    """ Save test score to a text file
+      Input:
+          scores: average score of test orders
+          path: path to score file
+       Returns:
+          None
+       """
+    with open(path, 'w') as f:
+        f.write("Test score is: ")
+        f.write(str(scores))
+    logger.info("Test score saved to file: " + path)
+
+
 def run_scores(args):
     """ Generate test score of recommendations generated for test data
       Input:
@@ -92,38 +267,47 @@ def run_scores(args):
        """
 
     try:
-        prior = pd.read_csv(args.input1)
-        orders = pd.read_csv(args.input2)
-        products = pd.read_csv(args.input3)
-        logger.info("Datasets read in successfully")
-
-        # Do a 80:20 train/test split on data
-        train_data = prior.head(int(len(prior)*(80/100)))
-        test_data = prior[len(train_data):]
-        logger.info("Size of training data: "+ str(len(train_data)))
-        logger.info("Size of testing data: "+ str(len(test_data)))
-
-        # Convert from DataFrame to a Series, with order_id as index and item_id as value
-        train_data = train_data.set_index('order_id')['product_id'].rename('item_id')
-        rules = association_rules(train_data, 0.01)
-        products = products.rename(columns={'product_id': 'item_id', 'product_name': 'item_name'})
-        train_rules_final = merge_item_name(rules, products).sort_values('lift', ascending=False)
-        products = products.rename(columns={'item_id': 'product_id'})
-        logger.info("Training rules generated")
-
-        # Prior orders with user_id, product_id, product_name
-        test_order = pd.merge(test_data, products, how='left', on='product_id')
-        test_order = pd.merge(test_order, orders, how='left', on='order_id')
+        with stage('read_orders_meta') as step:
+            if args.cache_dir is not None:
+                orders = load_table(args.input2, args.cache_dir)
+            else:
+                orders = pd.read_csv(args.input2)
+            step['rows'] = len(orders)
+        with stage('read_products') as step:
+            products = read_products(args.input3, args.cache_dir)
+            step['rows'] = len(products)
 
-        logger.info("Test data ready and calculating scores now ...")
+        if args.stream:
+            # Do a 80:20 train/test split on data, training rules are generated chunk by chunk
+            with stage('read_orders') as step:
+                n_train = int(count_rows(args.input1, args.cache_dir)*(80/100))
+                test_data = read_orders(args.input1, skiprows=n_train, cache_dir=args.cache_dir)
+                step['rows'] = len(test_data)
+            logger.info("Size of training data: "+ str(n_train))
+            logger.info("Size of testing data: "+ str(len(test_data)))
+            with stage('association_rules') as step:
+                rules = stream_association_rules(args.input1, args.min_support, args.memory_budget, args.engine, n_train,
+                                                 args.workers, args.cache_dir)
+                step['rows'] = len(rules)
+        else:
+            with stage('read_orders') as step:
+                prior = read_orders(args.input1, cache_dir=args.cache_dir)
+                step['rows'] = len(prior)
+            logger.info("Datasets read in successfully")
 
-        scores = np.nanmean(get_scores(test_order, train_rules_final))
-        logger.info("Score from test data is: "+ str(scores))
+            # Do a 80:20 train/test split on data
+            train_data = prior.head(int(len(prior)*(80/100)))
+            test_data = prior[len(train_data):]
+            logger.info("Size of training data: "+ str(len(train_data)))
+            logger.info("Size of testing data: "+ str(len(test_data)))
 
-        with open(args.output, 'w') as f:
-            f.write("Test score is: ")
-            f.write(str(scores))
-        logger.info("Test score saved to file: " + args.output)
+            # Convert from DataFrame to a Series, with order_id as index and item_id as value
+            train_data = train_data.set_index('order_id')['product_id'].rename('item_id')
+            with stage('association_rules') as step:
+                rules = association_rules(train_data, args.min_support, args.engine, args.workers)
+                step['rows'] = len(rules)
+        scores = score_rules(rules, test_data, orders, products, args.score_workers)
+        write_score(scores, args.output)
 
     except Exception as e:
         logger.warning('Could not generate scores for test dataset due to invalid input')
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import glob
+import shutil
+import hashlib
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Version of the stage cache layout
+STAGE_CACHE_VERSION = 1
+# Disk budget of the stage cache in MB, least recently used entries are evicted above it
+CACHE_BUDGET = 1024
+# Output file arguments of run.py commands whose outputs are cached, commands writing to a database aren't cached
+CACHED_COMMANDS = {'generate_rules': ['output', 'rules_output', 'state'],
+                   'generate_itemsets': ['output'],
+                   'get_scores': ['output'],
+                   'evaluate': ['output'],
+                   'sweep': ['output']}
+# Arguments that don't change outputs of a command, left out of its key
+UNKEYED_ARGS = ['func', 'command', 'report', 'profile', 'profile_output', 'stage_cache', 'cache_budget', 'cache_dir',
+                'rules_cache', 'workers', 'score_workers']
+
+# Hash of the code, computed once per process
+_code_version = None
+
+
+def file_digest(path):
+    """ Hash of the content of a file
+    Inputs:
+        path: path to file
+    Returns:
+        sha1 hex digest of the file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_version():
+    """ Hash of the code of run.py and src modules, so that any code change gives new keys
+    Inputs:
+        None
+    Returns:
+        sha1 hex digest of the code
+    """
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        digest = hashlib.sha1()
+        for path in [os.path.join(root, 'run.py')] + sorted(glob.glob(os.path.join(root, 'src', '*.py'))):
+            if os.path.exists(path):
+                digest.update(file_digest(path).encode('utf-8'))
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def stage_key(stage, inputs, params):
+    """ Key of the outputs of a stage, same input files, parameters and code give the same key
+    Inputs:
+        stage: name of the stage
+        inputs: list of paths of input files
+        params: dictionary of parameters of the stage
+    Returns:
+        sha1 hex digest of stage name, content of input files, parameters and code version
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps({'version': STAGE_CACHE_VERSION, 'stage': stage, 'code': code_version(),
+                              'inputs': [file_digest(path) for path in inputs], 'params': params},
+                             sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def lookup(cache_dir, key):
+    """ Find cached artifacts of a stage and mark them as used
+    Inputs:
+        cache_dir: folder of the stage cache
+        key: key of the stage from stage_key
+    Returns:
+        artifacts: dictionary of artifact name and path to its cached file, None if the key isn't cached
+    """
+    folder = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    # Modification time of the manifest is the last time the entry was used
+    os.utime(manifest_path, None)
+    return {name: os.path.join(folder, file) for name, file in manifest['artifacts'].items()}
+
+
+def save(cache_dir, key, artifacts, stage=None):
+    """ Save artifacts of a stage under its key
+    Inputs:
+        cache_dir: folder of the stage cache
+        key: key of the stage from stage_key
+        artifacts: dictionary of artifact name and path of a file to copy, or a dataframe or value to pickle
+        stage: name of the stage, saved in the manifest
+    Returns:
+        artifacts: dictionary of artifact name and path to its cached file
+    """
+    try:
+        folder = os.path.join(cache_dir, key)
+        # Artifacts are written to a temporary folder first so a failed run never leaves a half written entry
+        tmp_folder = folder + '.tmp'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        files = {}
+        for name, value in artifacts.items():
+            if isinstance(value, str):
+                files[name] = name + os.path.splitext(value)[1]
+                shutil.copyfile(value, os.path.join(tmp_folder, files[name]))
+            else:
+                files[name] = name + '.pkl'
+                pd.to_pickle(value, os.path.join(tmp_folder, files[name]))
+        with open(os.path.join(tmp_folder, 'manifest.json'), 'w') as f:
+            json.dump({'version': STAGE_CACHE_VERSION, 'stage': stage, 'created': time.time(), 'artifacts': files}, f)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
+        logger.info("Stage " + str(stage) + " saved to cache: " + folder)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return {name: os.path.join(folder, file) for name, file in files.items()}
+
+
+def evict(cache_dir, budget_mb=CACHE_BUDGET, keep=None):
+    """ Delete least recently used entries until the stage cache fits in its disk budget
+    Inputs:
+        cache_dir: folder of the stage cache
+        budget_mb: disk budget in MB
+        keep: key of an entry that is never evicted, e.g. the one just saved
+    Returns:
+        evicted: list of keys of evicted entries
+    """
+    entries = []
+    for manifest_path in glob.glob(os.path.join(cache_dir, '*', 'manifest.json')):
+        folder = os.path.dirname(manifest_path)
+        if folder.endswith('.tmp'):
+            continue
+        size = sum(os.path.getsize(os.path.join(folder, file)) for file in os.listdir(folder))
+        entries.append((os.path.getmtime(manifest_path), os.path.basename(folder), size))
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, key, size in sorted(entries):
+        if total <= budget_mb * 1024 * 1024:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key))
+        total -= size
+        evicted.append(key)
+        logger.info("Evicted stage cache entry: " + key)
+    return evicted
+
+
+def run_cached(args):
+    """ Run a run.py command, or skip it and restore its output files if it ran before with same inputs, parameters
+        and code
+    Inputs:
+        args that contain the command, its arguments, stage cache folder and disk budget
+    Returns:
+        None
+    """
+    outputs = [name for name in CACHED_COMMANDS[args.command] if getattr(args, name, None) is not None]
+    options = {name: value for name, value in vars(args).items() if name not in UNKEYED_ARGS + outputs}
+    # Arguments naming existing files are inputs, everything else is a parameter
+    inputs = sorted(name for name, value in options.items() if isinstance(value, str) and os.path.isfile(value))
+    params = dict({name: value for name, value in options.items() if name not in inputs}, inputs=inputs)
+    key = stage_key(args.command, [options[name] for name in inputs], params)
+
+    artifacts = lookup(args.stage_cache, key)
+    if artifacts is not None and set(artifacts) == set(outputs):
+        for name in outputs:
+            shutil.copyfile(artifacts[name], getattr(args, name))
+        logger.info("Skipped " + args.command + ", outputs restored from stage cache entry " + key)
+        return
+    args.func(args)
+    save(args.stage_cache, key, {name: getattr(args, name) for name in outputs if os.path.exists(getattr(args, name))},
+         args.command)
+    evict(args.stage_cache, args.cache_budget, keep=key)
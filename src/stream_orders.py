@@ -0,0 +1,146 @@
+import pandas as pd
+import numpy as np
+import logging
+from src.data_cache import load_table, count_cached_rows
+
+logger = logging.getLogger(__name__)
+
+# Only the columns needed for market basket analysis are parsed, with compact dtypes
+ORDER_COLUMNS = ['order_id', 'product_id']
+ORDER_DTYPES = {'order_id': np.int32, 'product_id': np.int32}
+PRODUCT_COLUMNS = ['product_id', 'product_name']
+PRODUCT_DTYPES = {'product_id': np.int32, 'product_name': str}
+# Rough memory cost of one row while a chunk is parsed, filtered and its pairs are counted
+BYTES_PER_ROW = 64
+
+
+def read_orders(path, nrows=None, skiprows=None, cache_dir=None):
+    """ Read prior orders with only order id and product id columns
+    Inputs:
+        path: path to prior orders csv
+        nrows: number of rows to read, read all rows if None
+        skiprows: rows to skip at the start of the file (header row is always kept)
+        cache_dir: if given, load columns from the columnar cache instead of parsing the csv
+    Returns:
+        orders: prior orders dataframe with int32 order_id and product_id
+    """
+    try:
+        if cache_dir is not None:
+            start = skiprows or 0
+            stop = start + nrows if nrows is not None else None
+            orders = load_table(path, cache_dir, ORDER_COLUMNS, start, stop).astype(ORDER_DTYPES)
+        else:
+            if skiprows:
+                skiprows = range(1, skiprows + 1)
+            orders = pd.read_csv(path, usecols=ORDER_COLUMNS, dtype=ORDER_DTYPES, nrows=nrows, skiprows=skiprows)
+    except Exception as e:
+        logger.warning('Could not read orders from ' + str(path))
+        raise Exception('Invalid input')
+    return orders
+
+
+def read_products(path, cache_dir=None):
+    """ Read products with only product id and product name columns
+    Inputs:
+        path: path to products csv
+        cache_dir: if given, load columns from the columnar cache instead of parsing the csv
+    Returns:
+        products: products dataframe with int32 product_id and product_name
+    """
+    try:
+        if cache_dir is not None:
+            products = load_table(path, cache_dir, PRODUCT_COLUMNS).astype({'product_id': np.int32})
+        else:
+            products = pd.read_csv(path, usecols=PRODUCT_COLUMNS, dtype=PRODUCT_DTYPES)
+    except Exception as e:
+        logger.warning('Could not read products from ' + str(path))
+        raise Exception('Invalid input')
+    return products
+
+
+def chunk_rows(memory_budget):
+    """ Convert a memory budget into number of rows read per chunk
+    Inputs:
+        memory_budget: memory budget for a chunk in MB
+    Returns:
+        number of rows per chunk
+    """
+    return max(int(memory_budget * 1024 * 1024 / BYTES_PER_ROW), 1)
+
+
+def read_raw_chunks(path, chunksize, nrows=None, cache_dir=None):
+    """ Read prior orders in chunks of a fixed number of rows
+    Inputs:
+        path: path to prior orders csv
+        chunksize: number of rows per chunk
+        nrows: number of rows to read, read all rows if None
+        cache_dir: if given, slice chunks from the columnar cache instead of parsing the csv
+    Returns:
+        Use yield to return prior orders dataframe chunk by chunk
+    """
+    if cache_dir is None:
+        for chunk in pd.read_csv(path, usecols=ORDER_COLUMNS, dtype=ORDER_DTYPES, nrows=nrows, chunksize=chunksize):
+            yield chunk
+    else:
+        total = count_cached_rows(path, cache_dir)
+        if nrows is not None:
+            total = min(total, nrows)
+        for start in range(0, total, chunksize):
+            yield load_table(path, cache_dir, ORDER_COLUMNS, start, min(start + chunksize, total)).astype(ORDER_DTYPES)
+
+
+def read_order_chunks(path, memory_budget, nrows=None, cache_dir=None):
+    """ Read prior orders in chunks that only contain complete orders
+    Inputs:
+        path: path to prior orders csv, rows of an order have to be next to each other
+        memory_budget: memory budget for a chunk in MB
+        nrows: number of rows to read, read all rows if None
+        cache_dir: if given, slice chunks from the columnar cache instead of parsing the csv
+    Returns:
+        Use yield to return orders series with order_id as index and item_id as value chunk by chunk,
+        rows of the last order in a chunk are carried over to the next chunk so that no order is split
+    """
+    try:
+        carry = None
+        for chunk in read_raw_chunks(path, chunk_rows(memory_budget), nrows, cache_dir):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            # The last order may continue in next chunk
+            is_last = (chunk['order_id'] == chunk['order_id'].iloc[-1]).values
+            carry = chunk[is_last]
+            complete = chunk[~is_last]
+            if len(complete) > 0:
+                yield complete.set_index('order_id')['product_id'].rename('item_id')
+        if carry is not None and len(carry) > 0:
+            yield carry.set_index('order_id')['product_id'].rename('item_id')
+    except Exception as e:
+        logger.warning('Could not read order chunks from ' + str(path))
+        raise Exception('Invalid input')
+
+
+def add_counts(total, counts):
+    """ Add counts of a chunk to running totals
+    Inputs:
+        total: running totals, None before the first chunk
+        counts: counts of current chunk
+    Returns:
+        total: updated running totals, in order of first appearance, totals and counts are both copied while they're
+        added up so memory briefly holds twice the totals
+    """
+    if total is None:
+        return counts
+    return pd.concat([total, counts]).groupby(level=list(range(counts.index.nlevels)), sort=False).sum()
+
+
+def count_rows(path, cache_dir=None):
+    """ Count number of rows in prior orders file without loading it
+    Inputs:
+        path: path to prior orders csv
+        cache_dir: if given, take number of rows from the columnar cache
+    Returns:
+        number of data rows
+    """
+    if cache_dir is not None:
+        return count_cached_rows(path, cache_dir)
+    with open(path, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
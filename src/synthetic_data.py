@@ -0,0 +1,145 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Shape of the Instacart data: about 50K products in 134 aisles and 21 departments, 10 items per order on average
+# and 16 orders per user on average
+N_PRODUCTS = 49688
+N_AISLES = 134
+N_DEPARTMENTS = 21
+MEAN_BASKET = 10
+MEAN_USER_ORDERS = 16
+# Exponent of Zipf popularity of products
+ZIPF_EXPONENT = 1.0
+# Share of items picked as the companion of the item added before it, so that some pairs are bought together
+COMPANION_RATE = 0.2
+
+
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    """ Probability of each rank under Zipf's law
+    Inputs:
+        n: number of ranks
+        exponent: Zipf exponent, larger exponent puts more weight on top ranks
+    Returns:
+        array of n probabilities adding up to 1
+    """
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_products(n_products=N_PRODUCTS, seed=0):
+    """ Generate products dataframe in the layout of Instacart products data
+    Inputs:
+        n_products: number of products
+        seed: random seed
+    Returns:
+        products: dataframe with product_id, product_name, aisle_id and department_id
+    """
+    rng = np.random.RandomState(seed)
+    product_ids = np.arange(1, n_products + 1, dtype=np.int32)
+    aisle_ids = rng.randint(1, N_AISLES + 1, size=n_products).astype(np.int32)
+    products = pd.DataFrame({'product_id': product_ids,
+                             'product_name': ['Product ' + str(i) for i in product_ids],
+                             'aisle_id': aisle_ids,
+                             'department_id': (aisle_ids % N_DEPARTMENTS + 1).astype(np.int32)})
+    return products
+
+
+def generate_orders(n_rows, n_products=N_PRODUCTS, seed=0):
+    """ Generate prior orders and orders dataframes in the layout of Instacart data
+    Inputs:
+        n_rows: number of rows of prior orders, about 5% fewer are left after dropping products added twice to an order
+        n_products: number of products
+        seed: random seed
+    Returns:
+        prior: prior orders dataframe with order_id, product_id, add_to_cart_order and reordered,
+        product popularity follows Zipf's law and basket sizes a long tailed distribution
+        orders: orders dataframe with order_id, user_id, eval_set, order_number, order_dow, order_hour_of_day
+        and days_since_prior_order
+    """
+    try:
+        rng = np.random.RandomState(seed)
+        # Basket sizes: 1 + negative binomial with mean MEAN_BASKET, long tail of large baskets
+        sizes = 1 + rng.negative_binomial(2, 2 / (MEAN_BASKET + 1), size=int(n_rows / MEAN_BASKET * 1.2) + 10)
+        sizes = sizes[:np.searchsorted(np.cumsum(sizes), n_rows) + 1]
+        sizes[-1] -= max(sizes.sum() - n_rows, 0)
+        n_orders = len(sizes)
+
+        # Products are ranked by a random permutation, so popular products are spread over all ids
+        popularity = rng.permutation(n_products).astype(np.int32) + 1
+        products = popularity[rng.choice(n_products, size=n_rows, p=zipf_weights(n_products))]
+        # Some items are the companion of the item added before them in the same order
+        companions = rng.permutation(n_products).astype(np.int32) + 1
+        order_index = np.repeat(np.arange(n_orders, dtype=np.int32), sizes)
+        cart_order = np.arange(n_rows, dtype=np.int32) - np.repeat(np.cumsum(sizes) - sizes, sizes).astype(np.int32)
+        follow = (rng.random_sample(n_rows) < COMPANION_RATE) & (cart_order > 0)
+        products[follow] = companions[products[np.flatnonzero(follow) - 1] - 1]
+
+        # Users with geometric number of orders, in order of order id
+        user_orders = rng.geometric(1 / MEAN_USER_ORDERS, size=n_orders)
+        user_orders = user_orders[:np.searchsorted(np.cumsum(user_orders), n_orders) + 1]
+        user_orders[-1] -= user_orders.sum() - n_orders
+        user_ids = np.repeat(np.arange(1, len(user_orders) + 1, dtype=np.int32), user_orders)
+        order_number = (np.arange(n_orders) - np.repeat(np.cumsum(user_orders) - user_orders, user_orders) + 1)
+        order_ids = rng.permutation(n_orders).astype(np.int32) + 1
+        days = rng.randint(1, 31, size=n_orders).astype(float)
+        days[order_number == 1] = np.nan
+        orders = pd.DataFrame({'order_id': order_ids, 'user_id': user_ids, 'eval_set': 'prior',
+                               'order_number': order_number.astype(np.int32),
+                               'order_dow': rng.randint(0, 7, size=n_orders).astype(np.int32),
+                               'order_hour_of_day': rng.randint(0, 24, size=n_orders).astype(np.int32),
+                               'days_since_prior_order': days})
+
+        # Rows of an order are next to each other, in order of order id as in Instacart prior orders data
+        prior = pd.DataFrame({'order_id': order_ids[order_index], 'product_id': products,
+                              'add_to_cart_order': cart_order + 1,
+                              'reordered': (rng.random_sample(n_rows) < 0.59).astype(np.int32)})
+        # A product is in an order at most once
+        prior = prior.drop_duplicates(['order_id', 'product_id'])
+        prior['add_to_cart_order'] = prior.groupby('order_id').cumcount().values.astype(np.int32) + 1
+        prior = prior.sort_values('order_id', kind='mergesort').reset_index(drop=True)
+        logger.info("Generated " + str(len(prior)) + " rows of " + str(n_orders) + " orders from "
+                    + str(len(user_orders)) + " users")
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return prior, orders
+
+
+def write_dataset(output_dir, n_rows, n_products=N_PRODUCTS, seed=0):
+    """ Generate synthetic prior orders, orders and products data and write them as csv files
+    Inputs:
+        output_dir: folder to write order_products__prior.csv, orders.csv and products.csv into
+        n_rows: number of rows of prior orders
+        n_products: number of products
+        seed: random seed
+    Returns:
+        paths: dictionary of paths to prior orders, orders and products csv
+    """
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        prior, orders = generate_orders(n_rows, n_products, seed)
+        paths = {'prior': os.path.join(output_dir, 'order_products__prior.csv'),
+                 'orders': os.path.join(output_dir, 'orders.csv'),
+                 'products': os.path.join(output_dir, 'products.csv')}
+        prior.to_csv(paths['prior'], index=False)
+        orders.to_csv(paths['orders'], index=False)
+        generate_products(n_products, seed).to_csv(paths['products'], index=False)
+        logger.info("Synthetic dataset written to " + output_dir)
+    except Exception as e:
+        logger.error(e)
+        raise Exception('Invalid input')
+    return paths
+
+
+def run_synthetic(args):
+    """ Write a synthetic dataset in the layout of Instacart data
+    Inputs:
+        args that contain output folder, number of rows, number of products and random seed
+    Returns:
+        paths: dictionary of paths to prior orders, orders and products csv
+    """
+    return write_dataset(args.output_dir, args.rows, args.products, args.seed)
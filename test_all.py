@@ -1,11 +1,31 @@
 from collections import Counter
 
 import pytest
+import os
 import logging
+import argparse
 import pandas as pd
 import numpy as np
-from src.market_basket_analysis import freq, support, generate_pairs, merge_item_stats, merge_item_name, association_rules, update_filter_support
-from src.scores import get_recommendation, get_scores
+from src.market_basket_analysis import freq, support, generate_pairs, merge_item_stats, merge_item_name, association_rules, update_filter_support, sparse_pairs
+from src.market_basket_analysis import stream_association_rules, parallel_pairs, count_itemsets, build_rules, update_itemsets, recommendation_table, item_stats_arrays
+from src.market_basket_analysis import sweep_rules, rules_table, split_itemsets
+from src.rule_state import save_state, load_state
+from src.scores import get_recommendation, get_scores, index_rules, recommendation_lookup, parallel_scores
+from src.rule_index import RuleIndex
+from src.fpgrowth import frequent_itemsets, itemset_rules
+from itertools import combinations
+from src.stream_orders import read_order_chunks
+from src.data_cache import load_table
+from src.pair_sketch import PairSketch
+from src.evaluation import time_split, kfold_split, fold_rules, evaluate_fold
+from src.synthetic_data import generate_orders
+from src.benchmark import parse_size, benchmark_size
+from src.instrumentation import start_report, stage, write_report
+from src.recommender_db import Recommendation, create_db, get_session, add_rows, swap_in, rollback
+from src.recommender_db import add_rules, top_recommendations, Rule
+from src.pipeline import run_pipeline
+from src.stage_cache import stage_key, lookup, save, evict
+from src.app_index import RecommendationIndex, merge_partners
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -138,6 +158,43 @@ def test_merge_item_stats_unhappy():
         output = merge_item_stats(raw_data, stats)
 
 
+# happy test for function 'merge_item_stats' with no item stats
+def test_merge_item_stats_empty_happy():
+    """ Happy test for function 'merge_item_stats' with no item stats
+        No pair should be kept and the output should still have the stats columns
+        Function: Append stats (frequency, support) to each associated item
+    """
+    item_pairs = pd.DataFrame({'itemA': [33120], 'itemB': [28985], 'freq_AB': [1], 'support_AB': [100.0]})
+    stats = pd.DataFrame({'freq': [], 'support': []})
+    output = merge_item_stats(item_pairs, stats)
+
+    assert len(output) == 0 and output.columns.tolist() == ['itemA', 'itemB', 'freq_AB', 'support_AB', 'freq_A',
+                                                             'support_A', 'freq_B', 'support_B']
+
+
+# happy test for function 'item_stats_arrays'
+def test_item_stats_arrays_happy():
+    """ Happy test for function 'item_stats_arrays'
+        Return value of the function should be equal to manually calculated expected output
+        Function: Store stats (frequency, support) of items in dense arrays indexed by remapped item id
+    """
+    stats = pd.DataFrame([[3, 30.0], [1, 10.0], [2, 20.0]], index=[45918, 9327, 33120], columns=['freq', 'support'])
+    item_ids, item_freq, item_support = item_stats_arrays(stats)
+
+    assert item_ids.tolist() == [9327, 33120, 45918] and item_freq.tolist() == [1, 2, 3] \
+        and item_support.tolist() == [10.0, 20.0, 30.0]
+
+
+# unhappy test for function 'item_stats_arrays'
+def test_item_stats_arrays_unhappy():
+    """ Unhappy test for function 'item_stats_arrays'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = item_stats_arrays(raw_data)
+
+
 # happy test for function 'association_rules'
 def test_association_rules_happy():
     """ Happy test for function 'association_rules'
@@ -158,6 +215,7 @@ def test_association_rules_happy():
     expected_output = pd.DataFrame(data, index=[0, 1, 4, 2, 5, 7, 3, 6, 8, 9],
                                    columns=['itemA', 'itemB', 'freq_AB', 'support_AB', 'freq_A', 'support_A', 'freq_B',
                                             'support_B', 'confidence_AtoB', 'confidence_BtoA', 'lift'])
+    expected_output = expected_output.astype({'itemA': np.int32, 'itemB': np.int32})
     assert expected_output.equals(output)
 
 
@@ -171,6 +229,343 @@ def test_association_rules_unhappy():
         output = association_rules(raw_data, 0.01)
 
 
+# happy test for function 'sparse_pairs'
+def test_sparse_pairs_happy():
+    """ Happy test for function 'sparse_pairs'
+        Pair frequencies from the sparse matrix product should equal the pair counts of generate_pairs, regardless of pair order
+        Function: Count pairs of items from a sparse order x item incidence matrix
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    expected_output = Counter(frozenset(pair) for pair in generate_pairs(items))
+    output = sparse_pairs(items)
+    output = {frozenset(pair): freq_ab for pair, freq_ab in output['freq_AB'].items()}
+
+    assert expected_output == output
+
+
+# unhappy test for function 'sparse_pairs'
+def test_sparse_pairs_unhappy():
+    """ Unhappy test for function 'sparse_pairs'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = sparse_pairs(raw_data)
+
+
+# happy test for function 'association_rules' with sparse engine
+def test_association_rules_sparse_happy():
+    """ Happy test for function 'association_rules' with sparse engine
+        Rules table should be the same as the one counted with 'Counter'
+        Function: Generate associations rules for item pairs
+    """
+    expected_output = association_rules(test_cut, 0.01).sort_values(['itemA', 'itemB']).reset_index(drop=True)
+    output = association_rules(test_cut, 0.01, engine='sparse').sort_values(['itemA', 'itemB']).reset_index(drop=True)
+
+    assert expected_output.equals(output)
+
+
+# unhappy test for function 'association_rules' with unknown engine
+def test_association_rules_engine_unhappy():
+    """ Unhappy test for function 'association_rules' with unknown engine
+        The engine is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = association_rules(test_cut, 0.01, engine='invalid')
+
+
+# happy test for class 'PairSketch'
+def test_pair_sketch_happy():
+    """ Happy test for class 'PairSketch'
+        Estimates of a sketch much smaller than the number of pairs should never undercount,
+        and should overcount by no more than the error bound
+        Class: Approximate item pair counts in fixed memory
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    exact = sparse_pairs(items)
+    keys = PairSketch.pair_keys(exact.index.get_level_values(0).values, exact.index.get_level_values(1).values)
+    sketch = PairSketch(width=2 ** 12)
+    sketch.update(keys, exact['freq_AB'].values, items.index.nunique())
+    overcount = sketch.estimate(keys) - exact['freq_AB'].values
+
+    assert len(keys) > sketch.width and overcount.min() >= 0 and overcount.max() <= sketch.error_bound()
+
+
+# unhappy test for class 'PairSketch'
+def test_pair_sketch_unhappy():
+    """ Unhappy test for class 'PairSketch'
+        The sketch width is not a power of 2 so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = PairSketch(width=1000)
+
+
+# happy test for function 'association_rules' with approximate engine
+def test_association_rules_approx_happy():
+    """ Happy test for function 'association_rules' with approximate engine
+        A sketch large enough for the test data should find the same rules with the same lift,
+        with an error bound on support of each pair
+        Function: Generate associations rules for item pairs
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    expected_output = association_rules(items, 0.5, engine='sparse')
+    output = association_rules(items, 0.5, engine='approx')
+    expected_pairs = set(zip(np.minimum(expected_output.itemA, expected_output.itemB),
+                             np.maximum(expected_output.itemA, expected_output.itemB)))
+
+    assert set(zip(output.itemA, output.itemB)) == expected_pairs and (output.support_AB_error >= 0).all() \
+        and np.allclose(np.sort(output.lift.values), np.sort(expected_output.lift.values))
+
+
+# happy test for function 'sweep_rules'
+def test_sweep_rules_happy():
+    """ Happy test for function 'sweep_rules'
+        Rules of each threshold derived from one counting pass should be the same as mined for that threshold alone
+        Function: Generate associations rules for several min support thresholds, counting item pairs only once
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    output = list(sweep_rules(items, [1, 0.01, 0.5]))
+    expected_output = [(min_support, association_rules(items, min_support)) for min_support in [0.01, 0.5, 1]]
+
+    assert [min_support for min_support, _ in output] == [0.01, 0.5, 1] and \
+        all(rules.sort_values(['itemA', 'itemB']).reset_index(drop=True).equals(
+            expected.sort_values(['itemA', 'itemB']).reset_index(drop=True))
+            for (_, rules), (_, expected) in zip(output, expected_output))
+
+
+# unhappy test for function 'sweep_rules'
+def test_sweep_rules_unhappy():
+    """ Unhappy test for function 'sweep_rules'
+        The list of thresholds is empty so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = list(sweep_rules(test_cut, []))
+
+
+# happy test for function 'parallel_pairs'
+def test_parallel_pairs_happy():
+    """ Happy test for function 'parallel_pairs'
+        Rules from pairs counted in worker processes should be exactly the same as rules counted in one process
+        Function: Count pairs of items in worker processes, each one counting a shard of orders
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    for engine in ['counter', 'sparse']:
+        expected_output = association_rules(items, 0.01, engine)
+        output = association_rules(items, 0.01, engine, workers=3)
+
+        assert expected_output.equals(output)
+
+
+# unhappy test for function 'parallel_pairs'
+def test_parallel_pairs_unhappy():
+    """ Unhappy test for function 'parallel_pairs'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = parallel_pairs(raw_data, 2)
+
+
+# happy test for function 'read_order_chunks'
+def test_read_order_chunks_happy():
+    """ Happy test for function 'read_order_chunks'
+        Chunks read with a tiny memory budget should never split an order and should add up to the whole file
+        Function: Read prior orders in chunks that only contain complete orders
+    """
+    chunks = list(read_order_chunks('data/external/order_products__prior.csv', 0.001))
+    order_ids = [order_id for chunk in chunks for order_id in chunk.index.unique()]
+
+    assert len(chunks) > 1 and len(order_ids) == len(set(order_ids)) and sum(len(chunk) for chunk in chunks) == len(prior)
+
+
+# unhappy test for function 'read_order_chunks'
+def test_read_order_chunks_unhappy():
+    """ Unhappy test for function 'read_order_chunks'
+        The input path is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = list(read_order_chunks('data/external/missing.csv', 0.001))
+
+
+# happy test for function 'load_table'
+def test_load_table_happy(tmp_path):
+    """ Happy test for function 'load_table'
+        Columns loaded from the cache should be the same as parsed from the csv, and the cache should be rebuilt
+        once the source file changes
+        Function: Load columns of a csv file from its cache
+    """
+    path = str(tmp_path / 'products.csv')
+    products[:100].to_csv(path, index=False)
+    cache_dir = str(tmp_path / 'cache')
+    cached = load_table(path, cache_dir)
+    pd.testing.assert_frame_equal(cached, pd.read_csv(path), check_dtype=False)
+
+    products[:50].to_csv(path, index=False)
+    output = load_table(path, cache_dir, ['product_id', 'product_name'], start=10, stop=20)
+
+    assert len(load_table(path, cache_dir)) == 50 and output['product_id'].tolist() == products['product_id'][10:20].tolist() \
+        and output['product_name'].tolist() == products['product_name'][10:20].tolist()
+
+
+# happy test for function 'load_table' with files of the same name
+def test_load_table_same_name_happy(tmp_path):
+    """ Happy test for function 'load_table' with files of the same name
+        Files with the same name in different folders should each load their own columns from one cache folder
+        Function: Load columns of a csv file from its cache
+    """
+    os.makedirs(str(tmp_path / 'a'))
+    os.makedirs(str(tmp_path / 'b'))
+    products[:10].to_csv(str(tmp_path / 'a' / 'products.csv'), index=False)
+    products[10:30].to_csv(str(tmp_path / 'b' / 'products.csv'), index=False)
+    cache_dir = str(tmp_path / 'cache')
+    load_table(str(tmp_path / 'a' / 'products.csv'), cache_dir)
+    load_table(str(tmp_path / 'b' / 'products.csv'), cache_dir)
+
+    assert len(load_table(str(tmp_path / 'a' / 'products.csv'), cache_dir)) == 10 \
+        and len(load_table(str(tmp_path / 'b' / 'products.csv'), cache_dir)) == 20 and len(os.listdir(cache_dir)) == 2
+
+
+# unhappy test for function 'load_table'
+def test_load_table_unhappy(tmp_path):
+    """ Unhappy test for function 'load_table'
+        The input path is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = load_table('data/external/missing.csv', str(tmp_path))
+
+
+# happy test for function 'stream_association_rules'
+def test_stream_association_rules_happy():
+    """ Happy test for function 'stream_association_rules'
+        Rules generated chunk by chunk should be the same as rules generated on the whole file
+        Function: Generate associations rules for item pairs by streaming the prior orders file in bounded chunks
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    expected_output = association_rules(items, 0.01)
+    output = stream_association_rules('data/external/order_products__prior.csv', 0.01, 0.001)
+
+    pd.testing.assert_frame_equal(expected_output, output, check_dtype=False)
+
+
+# unhappy test for function 'stream_association_rules'
+def test_stream_association_rules_unhappy():
+    """ Unhappy test for function 'stream_association_rules'
+        The input path is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = stream_association_rules('data/external/missing.csv', 0.01, 0.001)
+
+
+# happy test for function 'update_itemsets'
+def test_update_itemsets_happy(tmp_path):
+    """ Happy test for function 'update_itemsets'
+        Rules from saved counts updated with new orders should be the same as rules generated on all orders
+        Function: Fold newly arrived orders into item and item pair frequencies of a saved state
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    # orders are sorted by order_id, later half arrives as new orders
+    split = items.index[len(items) // 2]
+    history = items[items.index < split]
+    new_orders = items[items.index >= split]
+    stats, item_pairs, n_orders = count_itemsets(history, 0.01)
+    save_state(str(tmp_path / 'state.npz'), {'generation': 0, 'min_support': 0.01, 'raw_freq': freq(history),
+                                             'raw_orders': history.index.nunique(), 'stats': stats,
+                                             'n_orders': n_orders, 'item_pairs': item_pairs})
+    state = update_itemsets(load_state(str(tmp_path / 'state.npz')), new_orders)
+    output = build_rules(state['stats'], state['item_pairs'], state['n_orders'], state['min_support'])
+    expected_output = association_rules(items, 0.01)
+
+    assert state['generation'] == 1
+    pd.testing.assert_frame_equal(expected_output, output, check_dtype=False)
+
+
+# happy test for function 'update_itemsets' with the sparse engine
+def test_update_itemsets_sparse_happy():
+    """ Happy test for function 'update_itemsets' with the sparse engine
+        New pairs should be added to stored pairs in their stored orientation, one row per pair as in a full count
+        Function: Fold newly arrived orders into item and item pair frequencies of a saved state
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    split = items.index[len(items) // 2]
+    history = items[items.index < split]
+    stats, item_pairs, n_orders = count_itemsets(history, 0.01, 'sparse')
+    state = update_itemsets({'generation': 0, 'min_support': 0.01, 'raw_freq': freq(history),
+                             'raw_orders': history.index.nunique(), 'stats': stats, 'n_orders': n_orders,
+                             'item_pairs': item_pairs}, items[items.index >= split], 'sparse')
+    _, expected_output, _ = count_itemsets(items, 0.01, 'sparse')
+
+    assert len(state['item_pairs']) == len(expected_output)
+    assert set(frozenset(pair) for pair in state['item_pairs'].index) == \
+        set(frozenset(pair) for pair in expected_output.index)
+
+
+# unhappy test for function 'update_itemsets'
+def test_update_itemsets_unhappy():
+    """ Unhappy test for function 'update_itemsets'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = update_itemsets(None, test_cut)
+
+
+# happy test for function 'frequent_itemsets'
+def test_frequent_itemsets_happy():
+    """ Happy test for function 'frequent_itemsets'
+        Frequent itemsets mined with FP-growth should be the same as counting every combination of each order
+        Function: Mine frequent itemsets of all lengths with FP-growth
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    output = frequent_itemsets(items, 0.5, max_len=4)
+    filtered, filtered_orders = update_filter_support(items, 0.5)
+    expected_output = Counter()
+    for order_id, order in filtered.groupby(level=0):
+        for length in range(1, 5):
+            expected_output.update(combinations(sorted(set(order.values)), length))
+    expected_output = {itemset: count for itemset, count in expected_output.items()
+                       if count / len(filtered_orders) * 100 >= 0.5}
+
+    assert expected_output == dict(zip(output['itemset'], output['freq'])) and output['length'].max() == 4
+
+
+# unhappy test for function 'frequent_itemsets'
+def test_frequent_itemsets_unhappy():
+    """ Unhappy test for function 'frequent_itemsets'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = frequent_itemsets(raw_data, 0.5)
+
+
+# happy test for function 'itemset_rules'
+def test_itemset_rules_happy():
+    """ Happy test for function 'itemset_rules'
+        Return value of the function should be equal to manually calculated expected output
+        Function: Generate association rules 'antecedent -> consequent' from frequent itemsets
+    """
+    output = itemset_rules(frequent_itemsets(test_cut, 0.01, max_len=3))
+    rule = output[(output.antecedent == (9327, 28985)) & (output.consequent == 33120)]
+
+    assert len(output) == 30 and rule[['freq', 'support', 'confidence', 'lift']].values.tolist() == [[1, 100.0, 1.0, 0.01]]
+
+
+# unhappy test for function 'itemset_rules'
+def test_itemset_rules_unhappy():
+    """ Unhappy test for function 'itemset_rules'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = itemset_rules(raw_data)
+
+
 # happy test for function 'merge_item_name'
 def test_merge_item_name_happy():
     """ Happy test for function 'merge_item_name'
@@ -208,6 +603,121 @@ def test_merge_item_name_unhappy():
         output = merge_item_name(rules, raw_data).sort_values('lift', ascending=False)
 
 
+# happy test for function 'recommendation_table'
+def test_recommendation_table_happy():
+    """ Happy test for function 'recommendation_table'
+        Return value of the function should be equal to manually calculated expected output
+        Function: Pick top k recommendations for each item from association rules
+    """
+    rules = association_rules(test_cut, 0.01)
+    output = recommendation_table(rules, products, top_k=3)
+    output = output[output.item_id == 9327].reset_index(drop=True)
+    data = [[9327, 'Garlic Powder', 'Michigan Organic Kale', 'Natural Sweetener', 'Organic Egg Whites']]
+    expected_output = pd.DataFrame(data, columns=['item_id', 'item_name', 'recommendation1', 'recommendation2',
+                                                  'recommendation3']).astype({'item_id': np.int32})
+
+    assert expected_output.equals(output)
+
+
+# unhappy test for function 'recommendation_table'
+def test_recommendation_table_unhappy():
+    """ Unhappy test for function 'recommendation_table'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    rules = association_rules(test_cut, 0.01)
+    with pytest.raises(Exception):
+        output = recommendation_table(rules, raw_data)
+
+
+# happy test for function 'rules_table'
+def test_rules_table_happy():
+    """ Happy test for function 'rules_table'
+        Every partner of an item should be listed with its rank, and confidence of the item's only order should be 1
+        Function: List partners of each item with their rank, lift and confidence
+    """
+    rules = association_rules(test_cut, 0.01)
+    output = rules_table(rules, products)
+    output = output[output.item_id == 9327].reset_index(drop=True)
+
+    assert list(output['rank']) == [1, 2, 3, 4] and list(output['partner_name'][:3]) == \
+        ['Michigan Organic Kale', 'Natural Sweetener', 'Organic Egg Whites'] and np.allclose(output['confidence'], 1)
+
+
+# unhappy test for function 'rules_table'
+def test_rules_table_unhappy():
+    """ Unhappy test for function 'rules_table'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    rules = association_rules(test_cut, 0.01)
+    with pytest.raises(Exception):
+        output = rules_table(rules, raw_data)
+
+
+# happy test for class 'RuleIndex'
+def test_rule_index_happy():
+    """ Happy test for class 'RuleIndex'
+        Every item should find all of its partners, no matter if it was item A or item B of the rules
+        Class: Symmetric index of association rules
+    """
+    rules = pd.DataFrame([[1, 2, 3.0], [3, 1, 5.0], [2, 1, 1.0], [2, 3, 0.5]], columns=['itemA', 'itemB', 'lift'])
+    index = RuleIndex.from_rules(rules)
+    partners, lifts = index.lookup(1)
+    top = index.top_k(1)
+
+    assert partners.tolist() == [3, 2] and lifts.tolist() == [5.0, 3.0] and index.lookup(2, 1)[0].tolist() == [1] \
+        and 4 not in index and len(index.lookup(4)[0]) == 0 and top.partner_id.tolist() == [3, 1, 1]
+
+
+# happy test for function 'build_rules'
+def test_build_rules_orientation_happy():
+    """ Happy test for function 'build_rules'
+        A pair counted as (A, B) and (B, A) should be one rule with the support of both orders added up, even if each
+        order alone is below min support
+        Function: Construct association rules table from item and item pair frequencies
+    """
+    stats = pd.DataFrame({'freq': [4, 4, 2], 'support': [40.0, 40.0, 20.0]}, index=[1, 2, 3])
+    item_pairs = pd.DataFrame({'freq_AB': [2, 1, 2]}, index=pd.MultiIndex.from_tuples([(1, 2), (1, 3), (2, 1)]))
+    output = build_rules(stats, item_pairs, 10, 30)
+
+    assert output[['itemA', 'itemB', 'freq_AB']].values.tolist() == [[1, 2, 4]] and output.lift.tolist() == [0.025]
+
+
+# unhappy test for class 'RuleIndex'
+def test_rule_index_unhappy():
+    """ Unhappy test for class 'RuleIndex'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = RuleIndex.from_rules(raw_data)
+
+
+# happy test for function 'index_rules'
+def test_index_rules_happy():
+    """ Happy test for function 'index_rules'
+        Every rule should be listed in both directions with item names
+        Function: List rules of a symmetric rule index with item names
+    """
+    rules = association_rules(test_cut, 0.01)
+    output = index_rules(rules, products)
+
+    assert len(output) == 2 * len(rules) and set(output[output.item_B == "Garlic Powder"].item_A) == \
+        {'Organic Egg Whites', 'Michigan Organic Kale', 'Coconut Butter', 'Natural Sweetener'}
+
+
+# unhappy test for function 'index_rules'
+def test_index_rules_unhappy():
+    """ Unhappy test for function 'index_rules'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    rules = association_rules(test_cut, 0.01)
+    with pytest.raises(Exception):
+        output = index_rules(rules, raw_data)
+
+
 # happy test for function 'get_recommendation'
 def test_get_recommendation_happy():
     """ Happy test for function 'get_recommendation'
@@ -234,6 +744,30 @@ def test_get_recommendation_unhappy():
         output = get_recommendation(test_cut, "Garlic Powder")
 
 
+# happy test for function 'recommendation_lookup'
+def test_recommendation_lookup_happy():
+    """ Happy test for function 'recommendation_lookup'
+        Precomputed recommendations of every item should be the same as given by get_recommendation
+        Function: Precompute top 5 recommendations of every item once
+    """
+    rules = association_rules(prior[:1000].set_index('order_id')['product_id'].rename('item_id'), 0.01)
+    train_rules_final = index_rules(rules, products).sort_values('lift', ascending=False)
+    output = recommendation_lookup(train_rules_final)
+
+    assert set(output) == set(train_rules_final.item_B) and \
+        all(output[name] == get_recommendation(train_rules_final, name)[0].values.tolist()[0] for name in output)
+
+
+# unhappy test for function 'recommendation_lookup'
+def test_recommendation_lookup_unhappy():
+    """ Unhappy test for function 'recommendation_lookup'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = recommendation_lookup(test_cut)
+
+
 # happy test for function 'get_scores'
 def test_get_scores_happy():
     """ Happy test for function 'get_scores'
@@ -266,3 +800,706 @@ def test_get_scores_unhappy():
     expected_output = None
     with pytest.raises(Exception):
         output = get_scores(test_cut, "Garlic Powder")
+
+
+# happy test for function 'parallel_scores'
+def test_parallel_scores_happy():
+    """ Happy test for function 'parallel_scores'
+        Scores from worker processes should be the same as scored in a single process
+        Function: Calculate the test score of recommendations in worker processes
+    """
+    rules = association_rules(prior[:1000].set_index('order_id')['product_id'].rename('item_id'), 0.01)
+    train_rules_final = index_rules(rules, products).sort_values('lift', ascending=False)
+    test_order = pd.merge(prior[1000:], products.rename(columns={'product_name': 'item_name'}), how='left', on='product_id')
+    expected_output = get_scores(test_order, train_rules_final)
+    output = parallel_scores(test_order, train_rules_final, 3)
+
+    assert expected_output == output
+
+
+# unhappy test for function 'parallel_scores'
+def test_parallel_scores_unhappy():
+    """ Unhappy test for function 'parallel_scores'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = parallel_scores(test_cut, "Garlic Powder", 2)
+
+
+# unhappy test for function 'parallel_scores' when scoring fails in workers
+def test_parallel_scores_cleanup_unhappy():
+    """ Unhappy test for function 'parallel_scores' when scoring fails in workers
+        Test orders have no item names so scoring should raise an exception error, and shared recommendations
+        should be released in the parent process
+    """
+    import src.scores
+    rules = pd.DataFrame({'item_A': ['Garlic Powder'], 'item_B': ['Coconut Butter'], 'lift': [1.0]})
+    with pytest.raises(Exception):
+        output = parallel_scores(prior[:100], rules, 2)
+    assert src.scores._lookup is None
+
+
+# happy test for function 'time_split'
+def test_time_split_happy():
+    """ Happy test for function 'time_split'
+        Only the last order of users with more than one order should be tested
+        Function: Split orders by time within each user
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    order_ids = items.index.unique()
+    # Users with 3 orders each, and every 10th order from a user with a single order
+    user_id = np.where(np.arange(len(order_ids)) % 10 == 0, -np.arange(len(order_ids)) - 1, np.arange(len(order_ids)) // 3)
+    meta = pd.DataFrame({'order_id': order_ids, 'user_id': user_id})
+    meta['order_number'] = meta.groupby('user_id').cumcount() + 1
+    n_user = meta.groupby('user_id')['order_number'].transform('max')
+    last = meta.loc[(n_user > 1) & (meta['order_number'] == n_user), 'order_id']
+    [(name, test_mask)] = time_split(items, meta)
+
+    assert name == 'time' and set(items.index[test_mask]) == set(last)
+
+
+# unhappy test for function 'time_split'
+def test_time_split_unhappy():
+    """ Unhappy test for function 'time_split'
+        Orders data doesn't cover any prior order so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = time_split(prior.set_index('order_id')['product_id'].rename('item_id'), orders)
+
+
+# happy test for function 'kfold_split'
+def test_kfold_split_happy():
+    """ Happy test for function 'kfold_split'
+        Every order should be tested in exactly one fold, with all of its rows
+        Function: Split orders into k folds
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    folds = kfold_split(items, 4)
+    tested = np.sum([test_mask for _, test_mask in folds], axis=0)
+    fold_orders = [set(items.index[test_mask]) for _, test_mask in folds]
+
+    assert len(folds) == 4 and (tested == 1).all() and \
+        all(not (a & b) for i, a in enumerate(fold_orders) for b in fold_orders[i + 1:])
+
+
+# unhappy test for function 'kfold_split'
+def test_kfold_split_unhappy():
+    """ Unhappy test for function 'kfold_split'
+        The number of folds is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = kfold_split(test_cut, 5)
+
+
+# happy test for function 'fold_rules'
+def test_fold_rules_happy(tmp_path):
+    """ Happy test for function 'fold_rules'
+        Rules loaded from the rules cache should be the same as mined
+        Function: Mine rules of a fold, or load them from the rules cache if mined before
+    """
+    items = prior[:1000].set_index('order_id')['product_id'].rename('item_id')
+    expected_output = fold_rules(items, 0.01, rules_cache=str(tmp_path)).reset_index(drop=True)
+    output = fold_rules(items, 0.01, rules_cache=str(tmp_path))
+
+    assert len(list(tmp_path.iterdir())) == 1 and np.array_equal(expected_output['lift'].values, output['lift'].values) \
+        and np.array_equal(expected_output['itemA'].values, output['itemA'].values)
+
+
+# unhappy test for function 'fold_rules'
+def test_fold_rules_unhappy(tmp_path):
+    """ Unhappy test for function 'fold_rules'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = fold_rules("Garlic Powder", 0.01, rules_cache=str(tmp_path))
+
+
+# happy test for function 'evaluate_fold'
+def test_evaluate_fold_happy():
+    """ Happy test for function 'evaluate_fold'
+        With names and lifts that rank partners the same way, the score should be the same as get_scores
+        Function: Compute precision@k, recall@k, hit rate and a get_scores style score in one pass over a test fold
+    """
+    rules = pd.DataFrame({'itemA': [1, 1, 2, 3], 'itemB': [2, 3, 3, 4], 'lift': [4.0, 3.0, 2.0, 1.0]})
+    names = pd.DataFrame({'product_id': [1, 2, 3, 4, 5], 'product_name': ['a', 'b', 'c', 'd', 'e']})
+    test = pd.Series([1, 2, 5, 3, 4, 2, 1, 5], index=[10, 10, 10, 11, 11, 11, 12, 12], name='item_id')
+    output = evaluate_fold(rules, test, 5)
+    test_order = pd.merge(test.reset_index().rename(columns={'index': 'order_id', 'item_id': 'product_id'}),
+                          names.rename(columns={'product_name': 'item_name'}), how='left', on='product_id')
+    expected_output = np.nanmean(get_scores(test_order, index_rules(rules, names).sort_values('lift', ascending=False)))
+
+    assert output['score'] == pytest.approx(expected_output) and output['precision'] == 0.5 \
+        and output['hit_rate'] == 0.625
+
+
+# unhappy test for function 'evaluate_fold'
+def test_evaluate_fold_unhappy():
+    """ Unhappy test for function 'evaluate_fold'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = evaluate_fold("Garlic Powder", test_cut)
+
+
+# happy test for function 'generate_orders'
+def test_generate_orders_happy():
+    """ Happy test for function 'generate_orders'
+        Synthetic orders should have the layout of prior orders and orders data, with rows of an order next to each other
+        and each product at most once in an order
+        Function: Generate prior orders and orders dataframes in the layout of Instacart data
+    """
+    syn_prior, syn_orders = generate_orders(20000, 1000, seed=1)
+    order_ids = syn_prior['order_id'].values
+    n_blocks = 1 + (order_ids[1:] != order_ids[:-1]).sum()
+
+    assert list(syn_prior.columns) == list(prior.columns.drop('Unnamed: 0')) and \
+        list(syn_orders.columns) == list(orders.columns.drop('Unnamed: 0')) and \
+        16000 < len(syn_prior) <= 20000 and n_blocks == syn_orders['order_id'].nunique() and \
+        not syn_prior.duplicated(['order_id', 'product_id']).any() and syn_prior['product_id'].between(1, 1000).all()
+
+
+# unhappy test for function 'generate_orders'
+def test_generate_orders_unhappy():
+    """ Unhappy test for function 'generate_orders'
+        The number of rows is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = generate_orders("Garlic Powder")
+
+
+# happy test for function 'parse_size'
+def test_parse_size_happy():
+    """ Happy test for function 'parse_size'
+        Return value of the function should be equal to manually calculated expected output
+        Function: Convert a dataset size like '100K' or '1M' into number of rows
+    """
+    assert [parse_size(size) for size in ['100K', '32M', '2.5m', '500']] == [100000, 32000000, 2500000, 500]
+
+
+# unhappy test for function 'parse_size'
+def test_parse_size_unhappy():
+    """ Unhappy test for function 'parse_size'
+        The input value is invalid so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = parse_size("Garlic Powder")
+
+
+# happy test for function 'benchmark_size'
+def test_benchmark_size_happy(tmp_path):
+    """ Happy test for function 'benchmark_size'
+        Stages should be measured in their own process, also when they count pairs in worker processes of their own
+        Function: Benchmark stages on a synthetic dataset of one size
+    """
+    output = benchmark_size('5K', str(tmp_path), stages=['generate_data', 'association_rules'], workers=2,
+                            n_products=200)
+
+    assert [result['stage'] for result in output] == ['generate_data', 'association_rules'] \
+        and output[1]['rows'] > 0 and all(result['peak_rss_mb'] > 0 for result in output)
+
+
+# unhappy test for function 'benchmark_size'
+def test_benchmark_size_unhappy(tmp_path):
+    """ Unhappy test for function 'benchmark_size'
+        The stage is unknown so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = benchmark_size('5K', str(tmp_path), stages=['Garlic Powder'], n_products=200)
+
+
+# happy test for function 'stage'
+def test_stage_happy(tmp_path):
+    """ Happy test for function 'stage'
+        Steps inside a step should be recorded as its sub-steps, with row counts and timing in the run report
+        Function: Record wall time, CPU time, peak memory and row count of a step
+    """
+    start_report()
+    with stage('generate_rules'):
+        association_rules(prior.set_index('order_id')['product_id'].rename('item_id'), 0.01)
+    report = write_report(str(tmp_path / 'report.json'))
+    steps = {step['step']: step for step in report['steps']}
+
+    assert report['steps'][0]['step'] == 'generate_rules' and 'generate_rules/count_pairs' in steps and \
+        steps['generate_rules/filter_support']['rows'] == 3233 and \
+        all(step['wall_seconds'] >= 0 and step['peak_rss_mb'] > 0 for step in report['steps'])
+
+
+# happy test for function 'stage' with repeated steps
+def test_stage_repeated_happy(tmp_path):
+    """ Happy test for function 'stage' with repeated steps
+        Steps run once per chunk should be added up into one entry of the run report
+        Function: Record wall time, CPU time, peak memory and row count of a step
+    """
+    start_report()
+    with stage('generate_rules'):
+        stream_association_rules('data/external/order_products__prior.csv', 0.01, 0.001)
+    report = write_report(str(tmp_path / 'report.json'))
+    steps = [step['step'] for step in report['steps']]
+
+    assert steps.count('generate_rules/count_pairs') == 1 and \
+        report['steps'][steps.index('generate_rules/count_pairs')]['runs'] > 1 and report['steps'][0]['runs'] == 1
+
+
+# unhappy test for function 'write_report'
+def test_write_report_unhappy(tmp_path):
+    """ Unhappy test for function 'write_report'
+        The output path is invalid so it should raise an exception error
+    """
+    expected_output = None
+    start_report()
+    with pytest.raises(Exception):
+        output = write_report(str(tmp_path / 'missing' / 'report.json'))
+
+
+# happy test for function 'add_rows'
+def test_add_rows_happy(tmp_path):
+    """ Happy test for function 'add_rows'
+        Rows should be inserted over several batches, and names that only differ in case should be inserted once
+        Function: Insert recommendation table into database batch by batch
+    """
+    rec = pd.DataFrame([['Banana'] + ['Apple'] * 5, ['Milk'] + ['Bread'] * 5, ['banana'] + ['Eggs'] * 5,
+                        ['Eggs'] + ['Milk'] * 5, ['Bread'] + ['Milk'] * 5],
+                       columns=['item_name'] + ['recommendation' + str(i) for i in range(1, 6)])
+    rec.to_csv(str(tmp_path / 'recommendations.csv'))
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    output = add_rows(str(tmp_path / 'recommendations.csv'), session, batch_size=2)
+    stored = session.query(Recommendation).all()
+    session.close()
+
+    assert output == 4 and sorted(row.item_name for row in stored) == ['Banana', 'Bread', 'Eggs', 'Milk'] and \
+        [row.recommendation1 for row in stored if row.item_name == 'Banana'] == ['Apple']
+
+
+# happy test for function 'add_rows' with less than 5 recommendations
+def test_add_rows_top_k_happy(tmp_path):
+    """ Happy test for function 'add_rows' with less than 5 recommendations
+        A table built with top_k < 5 should be stored with "nan" for the missing recommendations
+        Function: Insert recommendation table into database batch by batch
+    """
+    rec = pd.DataFrame([['Banana', 'Apple', 'Milk'], ['Milk', 'Bread', 'NA']],
+                       columns=['item_name', 'recommendation1', 'recommendation2'])
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    output = add_rows(rec, session)
+    stored = {row.item_name: row for row in session.query(Recommendation).all()}
+    session.close()
+
+    assert output == 2 and stored['Banana'].recommendation2 == 'Milk' and stored['Banana'].recommendation5 == 'nan' \
+        and stored['Milk'].recommendation2 == 'nan'
+
+
+# unhappy test for function 'add_rows' into the live table
+def test_add_rows_live_unhappy(tmp_path):
+    """ Unhappy test for function 'add_rows' into the live table
+        The last batch clashes with a stored item so it should raise an exception error, and no row of the load
+        should be left in the live table
+    """
+    rec = pd.DataFrame([['Banana'] + ['Apple'] * 5, ['Milk'] + ['Bread'] * 5, ['Eggs'] + ['Milk'] * 5],
+                       columns=['item_name'] + ['recommendation' + str(i) for i in range(1, 6)])
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    add_rows(rec[2:], session)
+    with pytest.raises(Exception):
+        output = add_rows(rec, session, batch_size=2)
+    stored = [row.item_name for row in session.query(Recommendation).all()]
+    session.close()
+    assert stored == ['Eggs']
+
+
+# unhappy test for function 'add_rows'
+def test_add_rows_unhappy(tmp_path):
+    """ Unhappy test for function 'add_rows'
+        The input table has no recommendation columns so it should raise an exception error
+    """
+    expected_output = None
+    pd.DataFrame({'item_name': ['Banana']}).to_csv(str(tmp_path / 'recommendations.csv'))
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    with pytest.raises(Exception):
+        output = add_rows(str(tmp_path / 'recommendations.csv'), session)
+    session.close()
+
+
+# happy test for function 'rollback'
+def test_rollback_happy(tmp_path):
+    """ Happy test for function 'rollback'
+        Second load should be swapped in for the first one, and rollback should bring the first one back
+        Function: Swap the previous version of the recommendation table back in
+    """
+    columns = ['item_name'] + ['recommendation' + str(i) for i in range(1, 6)]
+    pd.DataFrame([['Banana'] + ['Apple'] * 5], columns=columns).to_csv(str(tmp_path / 'v1.csv'))
+    pd.DataFrame([['Banana'] + ['Milk'] * 5, ['Milk'] + ['Bread'] * 5], columns=columns).to_csv(str(tmp_path / 'v2.csv'))
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, str(tmp_path / 'v1.csv'))
+    loaded = swap_in(engine_string, str(tmp_path / 'v2.csv'))
+    session = get_session(engine_string)
+    live_rows = session.query(Recommendation).count()
+    session.close()
+    output = rollback(engine_string)
+    session = get_session(engine_string)
+    stored = session.query(Recommendation).all()
+    session.close()
+
+    assert loaded == 2 and live_rows == 2 and output == 1 and len(stored) == 1 and stored[0].recommendation1 == 'Apple'
+
+
+# happy test for function 'swap_in' without ranked rules
+def test_swap_in_happy(tmp_path):
+    """ Happy test for function 'swap_in' without ranked rules
+        A load without ranked rules should replace ranked rules of an earlier load with empty tables, and rollback should
+        bring recommendations and ranked rules back together
+        Function: Load recommendation table into versioned shadow tables and swap them in for the live tables
+    """
+    rec = recommendation_table(association_rules(test_cut, 0.01), products, 5)
+    rules = rules_table(association_rules(test_cut, 0.01), products)
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, rec, rules_path=rules)
+    swap_in(engine_string, rec)
+    session = get_session(engine_string)
+    live_rules = session.query(Rule).count()
+    session.close()
+    rollback(engine_string)
+    session = get_session(engine_string)
+    output = session.query(Rule).count()
+    session.close()
+
+    assert live_rules == 0 and output == len(rules)
+
+
+# unhappy test for function 'rollback'
+def test_rollback_unhappy(tmp_path):
+    """ Unhappy test for function 'rollback'
+        Only one version was loaded so there's nothing to roll back to, it should raise an exception error
+    """
+    expected_output = None
+    columns = ['item_name'] + ['recommendation' + str(i) for i in range(1, 6)]
+    pd.DataFrame([['Banana'] + ['Apple'] * 5], columns=columns).to_csv(str(tmp_path / 'v1.csv'))
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, str(tmp_path / 'v1.csv'))
+    with pytest.raises(Exception):
+        output = rollback(engine_string)
+
+
+# happy test for function 'top_recommendations'
+def test_top_recommendations_happy(tmp_path):
+    """ Happy test for function 'top_recommendations'
+        Partners should come back in order of rank, no matter user input's in lower or upper case
+        Function: Top N partners of an item from the normalized rules schema
+    """
+    rules = rules_table(association_rules(test_cut, 0.01), products)
+    rules.to_csv(str(tmp_path / 'rules.csv'), index=False)
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    added = add_rules(str(tmp_path / 'rules.csv'), session, batch_size=7)
+    output = top_recommendations(session, ' GARLIC powder', 3)
+    session.close()
+
+    assert added == 20 and [name for name, lift, confidence in output] == \
+        ['Michigan Organic Kale', 'Natural Sweetener', 'Organic Egg Whites']
+
+
+# happy test for function 'top_recommendations' with items of the same name
+def test_top_recommendations_same_name_happy(tmp_path):
+    """ Happy test for function 'top_recommendations' with items of the same name
+        Items whose names only differ in case should not mix their partners, the one with the lowest id is looked up
+        Function: Top N partners of an item from the normalized rules schema
+    """
+    rules = pd.DataFrame({'item_id': [1, 1, 2, 2], 'item_name': ['Banana', 'Banana', 'BANANA', 'BANANA'],
+                          'rank': [1, 2, 1, 2], 'partner_id': [3, 4, 5, 6],
+                          'partner_name': ['Apple', 'Milk', 'Bread', 'Eggs'], 'lift': [4.0, 3.0, 9.0, 8.0],
+                          'confidence': [0.4, 0.3, 0.9, 0.8]})
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    add_rules(rules, session)
+    output = top_recommendations(session, 'banana', 5)
+    session.close()
+
+    assert [name for name, lift, confidence in output] == ['Apple', 'Milk']
+
+
+# unhappy test for function 'top_recommendations'
+def test_top_recommendations_unhappy(tmp_path):
+    """ Unhappy test for function 'top_recommendations'
+        The item has no rules so it should return an empty list
+    """
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    session = get_session(engine_string)
+    output = top_recommendations(session, 'Garlic Powder')
+    session.close()
+
+    assert output == []
+
+
+# happy test for function 'split_itemsets'
+def test_split_itemsets_happy():
+    """ Happy test for function 'split_itemsets'
+        Counts shared between all orders and training orders should give the same rules as counting each of them,
+        also when the split cuts an order in two
+        Function: Count item and item pair frequencies of all orders and of training orders
+    """
+    items = prior.set_index('order_id')['product_id'].rename('item_id')
+    cut = int(len(items) * 0.8)
+    counts, train_counts = split_itemsets(items, cut, 0.01, 'sparse')
+    rules, train_rules = build_rules(*counts, 0.01), build_rules(*train_counts, 0.01)
+
+    assert items.index[cut - 1] == items.index[cut]
+    for output, expected_output in [(rules, association_rules(items, 0.01, 'sparse')),
+                                    (train_rules, association_rules(items[:cut], 0.01, 'sparse'))]:
+        assert len(output) == len(expected_output) and \
+            dict(zip(map(frozenset, zip(output.itemA, output.itemB)), output.freq_AB)) == \
+            dict(zip(map(frozenset, zip(expected_output.itemA, expected_output.itemB)), expected_output.freq_AB))
+
+
+# unhappy test for function 'split_itemsets'
+def test_split_itemsets_unhappy():
+    """ Unhappy test for function 'split_itemsets'
+        Approximate counts can't be added up so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = split_itemsets(test_cut, 3, 0.01, 'approx')
+
+
+# happy test for function 'run_pipeline'
+def test_run_pipeline_happy(tmp_path):
+    """ Happy test for function 'run_pipeline'
+        Recommendation table and test score should be the same as generate_rules and get_scores give,
+        also when the second run restores them from the stage cache
+        Function: Mine, score and store recommendations in one process
+    """
+    args = argparse.Namespace(input1='data/external/order_products__prior.csv', input2='data/external/orders.csv',
+                              input3='data/external/products.csv', output=None, rules_output=None,
+                              score_output=str(tmp_path / 'scores.txt'), skip=['store'], min_support=0.01,
+                              engine='counter', workers=1, score_workers=1, top_k=5, store_rules=False, rds=False,
+                              batch_size=5000, cache_dir=None, stage_cache=str(tmp_path / 'stages'), cache_budget=1024)
+    run_pipeline(args)
+    output = run_pipeline(args)
+    expected_output = recommendation_table(association_rules(prior.set_index('order_id')['product_id'].rename('item_id'),
+                                                             0.01), products)
+
+    assert expected_output.equals(output) and \
+        open(str(tmp_path / 'scores.txt')).read() == "Test score is: 0.43618146272945035"
+
+
+# unhappy test for function 'run_pipeline'
+def test_run_pipeline_unhappy(tmp_path):
+    """ Unhappy test for function 'run_pipeline'
+        Mining is skipped and there's no recommendation table to store so it should raise an exception error
+    """
+    expected_output = None
+    args = argparse.Namespace(input1='data/external/order_products__prior.csv', input2='data/external/orders.csv',
+                              input3='data/external/products.csv', output=None, rules_output=None, score_output=None,
+                              skip=['mine', 'score'], min_support=0.01, engine='counter', workers=1, score_workers=1,
+                              top_k=5, store_rules=False, rds=False, batch_size=5000, cache_dir=None,
+                              stage_cache=None, cache_budget=1024)
+    with pytest.raises(Exception):
+        output = run_pipeline(args)
+
+
+# happy test for function 'evict'
+def test_evict_happy(tmp_path):
+    """ Happy test for function 'evict'
+        Least recently used entry should be evicted first, and an entry used again should be kept
+        Function: Delete least recently used entries until the stage cache fits in its disk budget
+    """
+    cache_dir = str(tmp_path / 'stages')
+    for i, key in enumerate(['a', 'b', 'c']):
+        save(cache_dir, key, {'table': pd.DataFrame({'x': np.arange(100000)})})
+        os.utime(os.path.join(cache_dir, key, 'manifest.json'), (i, i))
+    lookup(cache_dir, 'a')
+    size_mb = os.path.getsize(os.path.join(cache_dir, 'a', 'table.pkl')) / 1024 / 1024
+    output = evict(cache_dir, budget_mb=size_mb * 2.5)
+
+    assert output == ['b'] and sorted(os.listdir(cache_dir)) == ['a', 'c']
+
+
+# unhappy test for function 'stage_key'
+def test_stage_key_unhappy():
+    """ Unhappy test for function 'stage_key'
+        The input file doesn't exist so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = stage_key('generate_rules', ['data/external/missing.csv'], {'min_support': 0.01})
+
+
+# happy test for class 'RecommendationIndex'
+def test_recommendation_index_happy(tmp_path):
+    """ Happy test for class 'RecommendationIndex'
+        Items should be found in any case, and a new table version should be picked up by reload with the same engine
+        Class: In-memory index of the recommendation table with reload on new versions
+    """
+    columns = ['item_name'] + ['recommendation' + str(i) for i in range(1, 6)]
+    pd.DataFrame([['Banana', 'Apple', 'Milk', 'NA', 'NA', 'NA']], columns=columns).to_csv(str(tmp_path / 'v1.csv'))
+    pd.DataFrame([['Banana'] + ['Bread'] * 5], columns=columns).to_csv(str(tmp_path / 'v2.csv'))
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, str(tmp_path / 'v1.csv'))
+    rec_index = RecommendationIndex(engine_string, reload_seconds=0).start()
+    engine = rec_index.engine
+    first = rec_index.lookup('BANANA')
+    unchanged = rec_index.reload()
+    swap_in(engine_string, str(tmp_path / 'v2.csv'))
+    changed = rec_index.reload()
+    rec_index.stop()
+
+    assert first == ['Apple', 'Milk'] and not unchanged and changed and rec_index.lookup('banana') == ['Bread'] * 5 \
+        and rec_index.lookup('Milk') is None and rec_index.engine is engine
+
+
+# happy test for class 'RecommendationIndex' on a database without ranked rules
+def test_recommendation_index_no_rules_happy(tmp_path):
+    """ Happy test for class 'RecommendationIndex'
+        A database created before the Item and Rule tables only holds the recommendation table, the index should
+        still be built without partner vectors and items should be found by name
+    """
+    columns = ['item_name'] + ['recommendation' + str(i) for i in range(1, 6)]
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    Recommendation.__table__.create(get_session(engine_string).get_bind())
+    session = get_session(engine_string)
+    session.add(Recommendation(**dict(zip(columns, ['Banana', 'Apple', 'Milk', 'nan', 'nan', 'nan']))))
+    session.commit()
+    session.close()
+    rec_index = RecommendationIndex(engine_string, reload_seconds=0).start()
+    output = rec_index.recommend_batch(['banana', 33120])
+    rec_index.stop()
+
+    assert rec_index.lookup('Banana') == ['Apple', 'Milk'] and rec_index.snapshot[2] == {} and \
+        rec_index.snapshot[3] == {} and [item['found'] for item in output['items']] == [True, False] and \
+        output['basket'] == []
+
+
+# unhappy test for class 'RecommendationIndex'
+def test_recommendation_index_unhappy(tmp_path):
+    """ Unhappy test for class 'RecommendationIndex'
+        There's no recommendation table in the database so it should raise an exception error
+    """
+    expected_output = None
+    with pytest.raises(Exception):
+        output = RecommendationIndex('sqlite:///' + str(tmp_path / 'empty.db'), reload_seconds=0).start()
+
+
+# happy test for function 'merge_partners'
+def test_merge_partners_happy():
+    """ Happy test for function 'merge_partners'
+        Lifts of a partner shared by basket items should add up with 'sum' and not with 'max',
+        and items already in the basket should be left out
+        Function: Merge partner vectors of basket items with a heap based k-way merge
+    """
+    vectors = [(('milk', 'bread', 'eggs'), ('Milk', 'Bread', 'Eggs'), (5.0, 3.0, 1.0)),
+               (('bread', 'banana', 'jam'), ('Bread', 'Banana', 'Jam'), (4.0, 2.5, 2.0))]
+    output_sum = merge_partners(vectors, {'banana', 'milk'}, top_n=3, merge='sum')
+    output_max = merge_partners(vectors, {'banana', 'milk'}, top_n=3, merge='max')
+
+    assert output_sum == [('Bread', 7.0), ('Jam', 2.0), ('Eggs', 1.0)] and \
+        output_max == [('Bread', 4.0), ('Jam', 2.0), ('Eggs', 1.0)]
+
+
+# unhappy test for function 'merge_partners'
+def test_merge_partners_unhappy():
+    """ Unhappy test for function 'merge_partners'
+        The merge is invalid so it should raise an exception error
+    """
+    expected_output = None
+    vectors = [(('milk',), ('Milk',), (5.0,))]
+    with pytest.raises(Exception):
+        output = merge_partners(vectors, set(), merge='mean')
+
+
+# happy test for function 'recommend_batch'
+def test_recommend_batch_happy(tmp_path):
+    """ Happy test for function 'recommend_batch'
+        Items should be found by name in any case or by id as integer or string, items that aren't found should be
+        flagged,
+        and the basket should leave out requested items
+        Function: Recommend top N partners of many items and of all of them as a basket
+    """
+    rules = association_rules(test_cut, 0.01)
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, recommendation_table(rules, products), rules_path=rules_table(rules, products))
+    rec_index = RecommendationIndex(engine_string, reload_seconds=0).start()
+    output = rec_index.recommend_batch(['GARLIC POWDER', 33120, 'Garlic Salt', ' 33120 '], top_n=2)
+
+    assert [item['found'] for item in output['items']] == [True, True, False, True] and \
+        output['items'][3]['recommendations'] == output['items'][1]['recommendations'] and \
+        [rec['name'] for rec in output['items'][0]['recommendations']] == ['Michigan Organic Kale', 'Natural Sweetener'] \
+        and len(output['basket']) == 2 and all(rec['name'] not in ['Garlic Powder', 'Organic Egg Whites']
+                                               for rec in output['basket'])
+
+
+# unhappy test for function 'recommend_batch'
+def test_recommend_batch_unhappy(tmp_path):
+    """ Unhappy test for function 'recommend_batch'
+        The merge is invalid so it should raise an exception error
+    """
+    expected_output = None
+    rules = association_rules(test_cut, 0.01)
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, recommendation_table(rules, products), rules_path=rules_table(rules, products))
+    rec_index = RecommendationIndex(engine_string, reload_seconds=0).start()
+    with pytest.raises(Exception):
+        output = rec_index.recommend_batch(['Garlic Powder'], merge='mean')
+
+
+def api_client(tmp_path, monkeypatch):
+    """ Test client of the Flask app, with its index built from rules of the test orders """
+    rules = association_rules(test_cut, 0.01)
+    engine_string = 'sqlite:///' + str(tmp_path / 'test.db')
+    create_db(engine_string)
+    swap_in(engine_string, recommendation_table(rules, products), rules_path=rules_table(rules, products))
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', engine_string)
+    import app
+    monkeypatch.setattr(app, 'rec_index', RecommendationIndex(engine_string, reload_seconds=0).start())
+    return app.app.test_client()
+
+
+# happy test for route '/api/recommendations'
+def test_api_recommendations_happy(tmp_path, monkeypatch):
+    """ Happy test for route '/api/recommendations'
+        A batch of names and ids should come back with recommendations of each item and of the basket
+        Route: Recommend for many items in one request, as JSON
+    """
+    client = api_client(tmp_path, monkeypatch)
+    response = client.post('/api/recommendations', json={'items': ['Garlic Powder', '33120', 'Garlic Salt'],
+                                                         'top_n': 2, 'merge': 'max'})
+    output = response.get_json()
+
+    assert response.status_code == 200 and [item['found'] for item in output['items']] == [True, True, False] \
+        and len(output['basket']) == 2
+
+
+# unhappy test for route '/api/recommendations'
+def test_api_recommendations_unhappy(tmp_path, monkeypatch):
+    """ Unhappy test for route '/api/recommendations'
+        Items that aren't a list, a batch over the size limit, a top_n out of range or not an integer and an unknown
+        merge should all be rejected with status 400
+    """
+    client = api_client(tmp_path, monkeypatch)
+    payloads = [{'items': 'Garlic Powder'}, [], {'items': ['Garlic Powder'] * 1001},
+                {'items': ['Garlic Powder'], 'top_n': 0}, {'items': ['Garlic Powder'], 'top_n': 51},
+                {'items': ['Garlic Powder'], 'top_n': '5'}, {'items': ['Garlic Powder'], 'top_n': True},
+                {'items': ['Garlic Powder'], 'merge': 'mean'}]
+    responses = [client.post('/api/recommendations', json=payload) for payload in payloads]
+
+    assert all(response.status_code == 400 and 'error' in response.get_json() for response in responses)